@@ -0,0 +1,3 @@
+"""
+Benchmarks of the wtmse pipeline on synthetic Sentinel-like data
+"""
@@ -0,0 +1,226 @@
+"""
+Benchmark the sentinel2 pipeline stages and the end to end tile generation
+on synthetic Sentinel-like rasters, results are saved as JSON.
+
+python3 -m benchmarks.bench_pipeline --output bench.json [--size 10980] [--compare previous.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import platform
+import subprocess
+
+
+LOGGER = logging.getLogger("wtmse-benchmark")
+ZONE_NAME = "31TCJ"
+# Toulouse, in 31TCJ
+CENTER_LON_LAT = (1.44, 43.60)
+ZOOM_LEVELS = range(9, 15)
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of the process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024. * 1024.)
+    return peak / 1024.
+
+
+def git_commit():
+    """
+    Return the commit benchmarked
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(results, name, function, calls=1):
+    """
+    Call function calls times and record wall time, throughput and peak RSS
+    """
+    if calls == 0:
+        LOGGER.warning("%s skipped, nothing to measure", name)
+        return None
+    start = time.time()
+    for index in range(calls):
+        function(index)
+    wall_time = time.time() - start
+    results[name] = {
+        "calls": calls,
+        "wall_s": wall_time,
+        "mean_s": wall_time / calls,
+        "throughput_per_s": calls / wall_time if wall_time > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    LOGGER.info("%-28s %6s calls %10.4fs mean %10.4fs peak rss %8.1fMB",
+                name, calls, wall_time, wall_time / calls, results[name]["peak_rss_mb"])
+    return results[name]
+
+
+def tiles_around_center(tms_z, count):
+    """
+    Return up to count tiles around the benchmark center, inside the zone
+    """
+    from utils.tms_helper import xyz_from_lon_lat
+    from generator.sentinel2.sentinel_tile_seeder import zones_for_tile
+    center_x, center_y = xyz_from_lon_lat(CENTER_LON_LAT[0], CENTER_LON_LAT[1], tms_z)
+    tiles = []
+    radius = 0
+    while len(tiles) < count and radius < 16:
+        for tms_x in range(center_x - radius, center_x + radius + 1):
+            for tms_y in range(center_y - radius, center_y + radius + 1):
+                if max(abs(tms_x - center_x), abs(tms_y - center_y)) != radius:
+                    continue
+                if len(tiles) < count and zones_for_tile(tms_x, tms_y, tms_z) == [ZONE_NAME]:
+                    tiles.append((tms_x, tms_y))
+        radius = radius + 1
+    return tiles
+
+
+def bench_stages(results, work_dir, iterations):
+    """
+    Benchmark each stage of the pipeline
+    """
+    from benchmarks.synthetic import SyntheticProductProvider, SYNTHETIC_DATE
+    from utils.tms_helper import bbox_from_xyz, xyz_from_lon_lat
+    from generator.sentinel2.sentinel_tile_generator import ZONES_FEATURES
+    from generator.sentinel2.utils.sentinel_downloader import find_zone
+    from generator.sentinel2.utils.tile_generator import create_raster_from_band, create_png_from_raster, \
+        get_x_y_for_lon_lat, extract_tile
+
+    randomizer = random.Random(0)
+    points = [(CENTER_LON_LAT[0] + randomizer.uniform(-0.4, 0.4), CENTER_LON_LAT[1] + randomizer.uniform(-0.4, 0.4))
+              for _ in range(iterations)]
+    measure(results, "find_zone", lambda index: find_zone(ZONES_FEATURES, *points[index]), iterations)
+
+    tiles = [xyz_from_lon_lat(lon, lat, 14) for lon, lat in points]
+    measure(results, "bbox_from_xyz", lambda index: bbox_from_xyz(tiles[index][0], tiles[index][1], 14), iterations)
+
+    measure(results, "synthetic_bands",
+            lambda index: SyntheticProductProvider().find_product_in_zone(ZONE_NAME, SYNTHETIC_DATE, [4, 3, 2]))
+    bands = SyntheticProductProvider().find_product_in_zone(ZONE_NAME, SYNTHETIC_DATE, [4, 3, 2])
+
+    raster_path = os.path.join(work_dir, "stage_raster.tif")
+    measure(results, "create_raster_from_band",
+            lambda index: create_raster_from_band(bands[4], bands[3], bands[2], raster_path))
+
+    png_path = os.path.join(work_dir, "stage_raster.png")
+    measure(results, "create_png_from_raster",
+            lambda index: create_png_from_raster(raster_path, png_path))
+
+    measure(results, "get_x_y_for_lon_lat",
+            lambda index: get_x_y_for_lon_lat(raster_path, points[index][0], points[index][1]), iterations)
+
+    for tms_z in ZOOM_LEVELS:
+        zoom_tiles = tiles_around_center(tms_z, 4)
+        corners = []
+        for tms_x, tms_y in zoom_tiles:
+            bbox = bbox_from_xyz(tms_x, tms_y, tms_z)
+            corners.append((get_x_y_for_lon_lat(raster_path, bbox[0][0], bbox[0][1]),
+                            get_x_y_for_lon_lat(raster_path, bbox[0][0], bbox[1][1]),
+                            get_x_y_for_lon_lat(raster_path, bbox[1][0], bbox[0][1]),
+                            get_x_y_for_lon_lat(raster_path, bbox[1][0], bbox[1][1])))
+        tile_path = os.path.join(work_dir, "stage_tile_{}.png".format(tms_z))
+        measure(results, "extract_tile_z{}".format(tms_z),
+                lambda index: extract_tile(png_path, *(corners[index] + (tile_path,))), len(corners))
+
+
+def bench_generate_tile(results, tiles_by_zoom):
+    """
+    Benchmark the end to end tile generation, cold then warm cache
+    """
+    from generator.sentinel2 import sentinel_tile_generator
+    from generator.sentinel2.sentinel_tile_generator import SentinelTileGenerator
+    from benchmarks.synthetic import SyntheticProductProvider
+
+    sentinel_tile_generator.MAXIMUM_SLEEP = 3600
+    SentinelTileGenerator.ProductProviderClass = SyntheticProductProvider
+    generator = SentinelTileGenerator()
+
+    measure(results, "generate_tile_first_scene",
+            lambda index: generator.generate_tile(*(tiles_around_center(14, 1)[0] + (14, {}))))
+    for tms_z in ZOOM_LEVELS:
+        tiles = tiles_around_center(tms_z, tiles_by_zoom)
+        for cache in ("cold", "warm"):
+            measure(results, "generate_tile_z{}_{}".format(tms_z, cache),
+                    lambda index: generator.generate_tile(tiles[index][0], tiles[index][1], tms_z, {}), len(tiles))
+
+
+def compare(results, previous_path):
+    """
+    Print the ratio between the current and the previous results
+    """
+    with open(previous_path, 'r') as previous_file:
+        previous = json.load(previous_file)
+    LOGGER.info("Compare with %s (commit %s)", previous_path, previous.get("commit"))
+    for name, stage in sorted(results["stages"].items()):
+        previous_stage = previous.get("stages", {}).get(name)
+        if previous_stage is None or not previous_stage["mean_s"]:
+            continue
+        ratio = stage["mean_s"] / previous_stage["mean_s"]
+        LOGGER.info("%-28s %8.4fs -> %8.4fs x%.2f%s", name, previous_stage["mean_s"], stage["mean_s"], ratio,
+                    "  REGRESSION" if ratio > 1.2 else "")
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the sentinel2 pipeline on synthetic rasters")
+    parser.add_argument('--size', type=int, default=10980, help="synthetic raster size in pixels")
+    parser.add_argument('--iterations', type=int, default=200, help="calls of the fast stages")
+    parser.add_argument('--tiles', type=int, default=8, help="tiles generated by zoom level")
+    parser.add_argument('--work-dir', help="directory of the synthetic data and cache, removed at the end if not given")
+    parser.add_argument('--output', default="bench.json", help="JSON result file")
+    parser.add_argument('--compare', help="previous JSON result file to compare with")
+    parser.add_argument('--skip-stages', action='store_true', help="only benchmark generate_tile")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=os.getenv('WTMSE_LOG_LEVEL', 'INFO').upper())
+
+    work_dir = arguments.work_dir or tempfile.mkdtemp(prefix="wtmse_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    # the generator cache is the temporary directory
+    tempfile.tempdir = work_dir
+
+    from benchmarks.synthetic import SyntheticProductProvider
+    SyntheticProductProvider.directory = work_dir
+    SyntheticProductProvider.size = arguments.size
+
+    results = {
+        "commit": git_commit(),
+        "date": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "size": arguments.size,
+        "stages": {},
+    }
+    try:
+        if not arguments.skip_stages:
+            bench_stages(results["stages"], work_dir, arguments.iterations)
+        bench_generate_tile(results["stages"], arguments.tiles)
+    finally:
+        if arguments.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(arguments.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    LOGGER.info("Results saved in %s", arguments.output)
+    if arguments.compare:
+        compare(results, arguments.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,201 @@
+"""
+Load test of a running wtmse server, replay TMS access patterns of map clients:
+viewport bursts, panning and zooming. The scenario is played on a cold cache
+then replayed on the warm cache, latency percentiles, "not yet ready" rate
+and throughput are reported for both.
+
+python3 -m benchmarks.load_test --url http://localhost:5000 --users 10 --actions 20 --output load.json
+"""
+
+import os
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from utils.tms_helper import xyz_from_lon_lat
+
+
+LOGGER = logging.getLogger("wtmse-load-test")
+NOT_READY_HEADER = 'X-WTMSE-Status'
+# parallel connections of a browser
+CONNECTIONS_BY_USER = 6
+
+
+def percentile(values, rank):
+    """
+    Return the nearest rank percentile of the values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(math.ceil(rank / 100. * len(values))) - 1))
+    return values[index]
+
+
+def viewport(center_x, center_y, tms_z, width, height):
+    """
+    Return the tiles of a viewport around the center
+    """
+    return [(tms_x, tms_y, tms_z)
+            for tms_x in range(center_x - width // 2, center_x - width // 2 + width)
+            for tms_y in range(center_y - height // 2, center_y - height // 2 + height)]
+
+
+def build_session(randomizer, center, min_zoom, max_zoom, actions, width, height):
+    """
+    Build the viewports requested by a map user: start on a viewport, then pan and zoom
+    """
+    tms_z = randomizer.randint(min_zoom, max_zoom)
+    center_x, center_y = xyz_from_lon_lat(center[0], center[1], tms_z)
+    viewports = [viewport(center_x, center_y, tms_z, width, height)]
+    for _ in range(actions):
+        action = randomizer.choice(['pan', 'pan', 'pan', 'zoom_in', 'zoom_out'])
+        if action == 'zoom_in' and tms_z < max_zoom:
+            tms_z = tms_z + 1
+            center_x, center_y = center_x * 2 + randomizer.randint(0, 1), center_y * 2 + randomizer.randint(0, 1)
+        elif action == 'zoom_out' and tms_z > min_zoom:
+            tms_z = tms_z - 1
+            center_x, center_y = center_x // 2, center_y // 2
+        else:
+            center_x = center_x + randomizer.randint(-2, 2)
+            center_y = center_y + randomizer.randint(-1, 1)
+        viewports.append(viewport(center_x, center_y, tms_z, width, height))
+    return viewports
+
+
+class LoadTest:
+    """
+    Replay the users sessions against the server and collect the responses
+    """
+
+    def __init__(self, url, generator_name, arguments, think_time):
+        """
+        init
+        """
+        self.url = url.rstrip('/')
+        self.generator_name = generator_name
+        self.arguments = arguments
+        self.think_time = think_time
+        self.__results = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def session(self):
+        """
+        Return the HTTP session of the current thread
+        """
+        if not hasattr(self.__local, 'session'):
+            self.__local.session = requests.Session()
+        return self.__local.session
+
+    def request_tile(self, tile):
+        """
+        Request a tile and record its latency and status
+        """
+        tms_x, tms_y, tms_z = tile
+        url = "{}/{}/{}/{}/{}".format(self.url, self.generator_name, tms_x, tms_y, tms_z)
+        start = time.time()
+        try:
+            response = self.session().get(url, params=self.arguments, timeout=300)
+            status = response.status_code
+            not_ready = response.headers.get(NOT_READY_HEADER) == 'not-ready'
+        except requests.RequestException:
+            status = None
+            not_ready = False
+        latency = time.time() - start
+        with self.__lock:
+            self.__results.append((latency, status, not_ready))
+
+    def play_user(self, viewports, executor):
+        """
+        Request the viewports of a user, each viewport is a burst of parallel requests
+        """
+        for tiles in viewports:
+            list(executor.map(self.request_tile, tiles))
+            time.sleep(self.think_time)
+
+    def play(self, sessions):
+        """
+        Play all the sessions in parallel, return the report of the run
+        """
+        self.__results = []
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(sessions) * CONNECTIONS_BY_USER) as executor:
+            users = [threading.Thread(target=self.play_user, args=(viewports, executor)) for viewports in sessions]
+            for user in users:
+                user.start()
+            for user in users:
+                user.join()
+        duration = time.time() - start
+
+        latencies = [latency for latency, _, _ in self.__results]
+        statuses = {}
+        for _, status, _ in self.__results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        not_ready = sum(1 for _, _, result_not_ready in self.__results if result_not_ready)
+        return {
+            "requests": len(self.__results),
+            "duration_s": duration,
+            "throughput_per_s": len(self.__results) / duration if duration > 0 else None,
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+            "p99_s": percentile(latencies, 99),
+            "max_s": max(latencies) if latencies else None,
+            "not_ready_rate": not_ready / float(len(self.__results)) if self.__results else None,
+            "statuses": statuses,
+        }
+
+
+def main():
+    """
+    Run the load test on cold then warm cache
+    """
+    parser = argparse.ArgumentParser(description="Load test of a wtmse server")
+    parser.add_argument('--url', default="http://localhost:5000", help="wtmse server url")
+    parser.add_argument('--generator', default="sentinel2")
+    parser.add_argument('--center', default="1.44,43.60", help="lon,lat of the sessions start")
+    parser.add_argument('--min-zoom', type=int, default=11)
+    parser.add_argument('--max-zoom', type=int, default=14)
+    parser.add_argument('--users', type=int, default=10, help="parallel map users")
+    parser.add_argument('--actions', type=int, default=20, help="pan and zoom actions by user")
+    parser.add_argument('--viewport', default="4x3", help="viewport size in tiles")
+    parser.add_argument('--think-time', type=float, default=0.5, help="pause between two actions in seconds")
+    parser.add_argument('--date', help="date argument of the requests YYYYMMDD")
+    parser.add_argument('--zone', help="zone argument of the requests")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON result file")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=os.getenv('WTMSE_LOG_LEVEL', 'INFO').upper())
+
+    width, height = map(int, arguments.viewport.split('x'))
+    center = tuple(map(float, arguments.center.split(',')))
+    randomizer = random.Random(arguments.seed)
+    sessions = [build_session(randomizer, center, arguments.min_zoom, arguments.max_zoom,
+                              arguments.actions, width, height) for _ in range(arguments.users)]
+    request_arguments = {}
+    if arguments.date:
+        request_arguments['date'] = arguments.date
+    if arguments.zone:
+        request_arguments['zone'] = arguments.zone
+
+    load_test = LoadTest(arguments.url, arguments.generator, request_arguments, arguments.think_time)
+    report = {}
+    for cache in ("cold", "warm"):
+        report[cache] = load_test.play(sessions)
+        LOGGER.info("%s cache: %s requests, %.1f req/s, p50 %.3fs p95 %.3fs p99 %.3fs, not ready %.1f%%, statuses %s",
+                    cache, report[cache]["requests"], report[cache]["throughput_per_s"] or 0,
+                    report[cache]["p50_s"] or 0, report[cache]["p95_s"] or 0, report[cache]["p99_s"] or 0,
+                    100 * (report[cache]["not_ready_rate"] or 0), report[cache]["statuses"])
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,230 @@
+"""
+Local stand-in of the PEPS catalogue and download server,
+implement the search.json subset used by PEPSSentinelProductDownloader
+and serve zipped synthetic products with configurable latency and bandwidth.
+
+python3 -m benchmarks.mock_peps --port 8090 --dates 20180620,20180625 --size 2048
+WTMSE_PEPSSENTINELPRODUCTDOWNLOADER_URL=http://localhost:8090/resto/api/collections/S2ST/search.json python3 wtmse.py
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import zipfile
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from benchmarks.synthetic import ZONE_GEOREFERENCING, create_synthetic_band
+
+
+LOGGER = logging.getLogger("wtmse-mock-peps")
+SEARCH_PATH = '/resto/api/collections/S2ST/search.json'
+DOWNLOAD_PATH = '/download/'
+PRODUCT_BANDS = [2, 3, 4, 8]
+CHUNK_SIZE = 64 * 1024
+
+
+def product_id(zone_name, date_product):
+    """
+    Return the PEPS product id of the zone and date
+    """
+    date_string = date_product.strftime('%Y%m%d')
+    return "S2A_MSIL1C_{}T105031_N0206_R051_T{}_{}T125716".format(date_string, zone_name, date_string)
+
+
+class MockPEPSCatalogue:
+    """
+    Catalogue of the synthetic products, products zips are built on first download
+    """
+
+    def __init__(self, work_dir, zones, dates, size):
+        """
+        init
+        """
+        self.work_dir = work_dir
+        self.zones = zones
+        self.dates = sorted(dates, reverse=True)
+        self.size = size
+        self.__lock = threading.Lock()
+
+    def search(self, zone_name, start_date=None, completion_date=None, max_records=None):
+        """
+        Return the products of the zone between the dates, the most recent first
+        """
+        if zone_name not in self.zones:
+            return []
+        products = []
+        for date_product in self.dates:
+            if start_date is not None and date_product < start_date.date():
+                continue
+            if completion_date is not None and date_product > completion_date.date():
+                continue
+            products.append((product_id(zone_name, date_product), zone_name, date_product))
+        if max_records is not None:
+            products = products[:max_records]
+        return products
+
+    def find(self, identifier):
+        """
+        Return the (zone, date) of a product id, None if unknown
+        """
+        for zone_name in self.zones:
+            for date_product in self.dates:
+                if product_id(zone_name, date_product) == identifier:
+                    return zone_name, date_product
+        return None
+
+    def product_zip(self, identifier):
+        """
+        Return the path of the product zip, build it if needed
+        """
+        zone_name, date_product = self.find(identifier)
+        zip_path = os.path.join(self.work_dir, identifier + '.zip')
+        with self.__lock:
+            if os.path.isfile(zip_path):
+                return zip_path
+            date_string = date_product.strftime('%Y%m%d')
+            img_data = os.path.join(identifier + '.SAFE', 'GRANULE',
+                                    'L1C_T{}_A015000_{}T105031'.format(zone_name, date_string), 'IMG_DATA')
+            temporary_zip = zip_path + '.tmp'
+            with zipfile.ZipFile(temporary_zip, 'w', zipfile.ZIP_STORED) as product:
+                for band in PRODUCT_BANDS:
+                    # GeoTIFF content, GDAL open the band whatever its extension
+                    band_name = 'T{}_{}T105031_B{:02d}.jp2'.format(zone_name, date_string, band)
+                    band_path = os.path.join(self.work_dir, band_name)
+                    create_synthetic_band(band_path, zone_name, band, self.size)
+                    product.write(band_path, os.path.join(img_data, band_name))
+                    os.remove(band_path)
+            os.rename(temporary_zip, zip_path)
+            return zip_path
+
+
+class MockPEPSRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle the catalogue and download requests
+    """
+    catalogue = None
+    latency = 0.
+    bandwidth = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+    def send_json(self, content):
+        """
+        Send a json response
+        """
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """
+        Route the request
+        """
+        time.sleep(MockPEPSRequestHandler.latency)
+        url = urlparse(self.path)
+        if url.path == SEARCH_PATH:
+            self.handle_search(parse_qs(url.query))
+        elif url.path.startswith(DOWNLOAD_PATH):
+            self.handle_download(url.path[len(DOWNLOAD_PATH):])
+        else:
+            self.send_error(404)
+
+    def handle_search(self, query):
+        """
+        Answer search.json with the tileid, maxRecords, startDate and completionDate parameters
+        """
+        def parse_date(name):
+            if name not in query:
+                return None
+            return datetime.strptime(query[name][0][:10], '%Y-%m-%d')
+
+        max_records = int(query['maxRecords'][0]) if 'maxRecords' in query else None
+        zone_name = query.get('tileid', [''])[0]
+        products = MockPEPSRequestHandler.catalogue.search(zone_name, parse_date('startDate'),
+                                                           parse_date('completionDate'), max_records)
+        host = self.headers.get('Host', 'localhost')
+        features = []
+        for identifier, _, date_product in products:
+            features.append({
+                'id': identifier,
+                'properties': {
+                    'startDate': date_product.strftime('%Y-%m-%dT10:50:31.024Z'),
+                    'services': {'download': {'url': 'http://{}{}{}'.format(host, DOWNLOAD_PATH, identifier)}},
+                },
+            })
+        self.send_json({'type': 'FeatureCollection', 'features': features})
+
+    def handle_download(self, identifier):
+        """
+        Stream the product zip, throttled to the configured bandwidth
+        """
+        if MockPEPSRequestHandler.catalogue.find(identifier) is None:
+            return self.send_error(404)
+        zip_path = MockPEPSRequestHandler.catalogue.product_zip(identifier)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(os.path.getsize(zip_path)))
+        self.end_headers()
+        with open(zip_path, 'rb') as product:
+            for chunk in iter(lambda: product.read(CHUNK_SIZE), b''):
+                self.wfile.write(chunk)
+                if MockPEPSRequestHandler.bandwidth:
+                    time.sleep(len(chunk) / MockPEPSRequestHandler.bandwidth)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each request in a thread
+    """
+    daemon_threads = True
+
+
+def main():
+    """
+    Run the mock PEPS server
+    """
+    parser = argparse.ArgumentParser(description="Mock PEPS catalogue and download server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--zones', default=",".join(sorted(ZONE_GEOREFERENCING)), help="zones served")
+    parser.add_argument('--dates', default="20180620", help="acquisition dates served YYYYMMDD")
+    parser.add_argument('--size', type=int, default=10980, help="synthetic bands size in pixels")
+    parser.add_argument('--latency', type=float, default=0., help="latency added to each request in seconds")
+    parser.add_argument('--bandwidth', type=float, default=None, help="download bandwidth in bytes per second")
+    parser.add_argument('--work-dir', help="directory of the product zips, removed at the end if not given")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=os.getenv('WTMSE_LOG_LEVEL', 'INFO').upper())
+
+    work_dir = arguments.work_dir or tempfile.mkdtemp(prefix="wtmse_mock_peps_")
+    os.makedirs(work_dir, exist_ok=True)
+    dates = [datetime.strptime(date_string, '%Y%m%d').date() for date_string in arguments.dates.split(',')]
+    MockPEPSRequestHandler.catalogue = MockPEPSCatalogue(work_dir, arguments.zones.split(','), dates, arguments.size)
+    MockPEPSRequestHandler.latency = arguments.latency
+    MockPEPSRequestHandler.bandwidth = arguments.bandwidth
+
+    server = ThreadingHTTPServer((arguments.host, arguments.port), MockPEPSRequestHandler)
+    LOGGER.info("Mock PEPS server on http://%s:%s%s", arguments.host, arguments.port, SEARCH_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if arguments.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
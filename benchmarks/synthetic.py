@@ -0,0 +1,83 @@
+"""
+Synthetic Sentinel-like data, uint16 UTM rasters georeferenced as real S2 zones
+"""
+
+import os
+import logging
+from datetime import date
+import numpy as np
+from osgeo import gdal, osr
+from generator.sentinel2.sentinel_product_provider import SentinelProductProvider
+
+
+LOGGER = logging.getLogger("wtmse-benchmark")
+SENTINEL_SIZE = 10980
+SENTINEL_RESOLUTION = 10.
+SYNTHETIC_DATE = date(2018, 6, 20)
+# zone name -> (EPSG code, upper left x, upper left y) of the S2 tiling grid
+ZONE_GEOREFERENCING = {
+    "31TCJ": (32631, 300000., 4900020.),
+    "31TDJ": (32631, 399960., 4900020.),
+    "31TCH": (32631, 300000., 4800000.),
+}
+
+
+def create_synthetic_band(path, zone_name="31TCJ", band=4, size=SENTINEL_SIZE, seed=0):
+    """
+    Write a synthetic band, a smooth signal with noise covering the zone footprint.
+    The resolution is adapted so a smaller size keep the zone footprint.
+    """
+    epsg, upper_left_x, upper_left_y = ZONE_GEOREFERENCING[zone_name]
+    resolution = SENTINEL_RESOLUTION * SENTINEL_SIZE / size
+    LOGGER.info("Create synthetic band B%02d of %s in %s (%sx%s)", band, zone_name, path, size, size)
+
+    dataset = gdal.GetDriverByName('GTiff').Create(path, size, size, 1, gdal.GDT_UInt16)
+    dataset.SetGeoTransform((upper_left_x, resolution, 0., upper_left_y, 0., -resolution))
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(epsg)
+    dataset.SetProjection(spatial_reference.ExportToWkt())
+
+    random = np.random.RandomState(seed + band)
+    columns = np.arange(size, dtype=np.float32)[None, :]
+    block_size = 1024
+    for row in range(0, size, block_size):
+        rows = np.arange(row, min(size, row + block_size), dtype=np.float32)[:, None]
+        values = 2000. + 700. * np.sin(columns / 700. + band) + 700. * np.cos(rows / 500.)
+        values = values + random.randint(0, 300, (rows.shape[0], size))
+        dataset.GetRasterBand(1).WriteArray(values.astype(np.uint16), 0, row)
+    dataset.FlushCache()
+    dataset = None
+    return path
+
+
+def synthetic_band_path(directory, zone_name, date_product, band):
+    """
+    Return the path of a synthetic band, named as the S2 L1C band files
+    """
+    return os.path.join(directory, "T{}_{}T105031_B{:02d}.tif".format(zone_name, date_product.strftime('%Y%m%d'), band))
+
+
+class SyntheticProductProvider(SentinelProductProvider):
+    """
+    Product provider serving synthetic bands, created on first use
+    """
+    directory = None
+    size = SENTINEL_SIZE
+    product_date = SYNTHETIC_DATE
+
+    def last_image_date_for_zone(self, zone_name):
+        if zone_name not in ZONE_GEOREFERENCING:
+            return None
+        return SyntheticProductProvider.product_date
+
+    def product_exist(self, zone_name, date_product):
+        return zone_name in ZONE_GEOREFERENCING and date_product == SyntheticProductProvider.product_date
+
+    def find_product_in_zone(self, zone_name, date_product, bands=[2, 3, 4]):
+        products = {}
+        for band in bands:
+            path = synthetic_band_path(SyntheticProductProvider.directory, zone_name, date_product, band)
+            if not os.path.isfile(path):
+                create_synthetic_band(path, zone_name, band, SyntheticProductProvider.size)
+            products[band] = path
+        return products
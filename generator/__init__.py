@@ -1,5 +1,9 @@
+"""
+Generators are declared by product type, the name of their module or package,
+their modules are imported by the generator factory on the first request of the type
+"""
 import pkgutil
+from generator.generator_factory import GeneratorFactory
 
 __path__ = pkgutil.extend_path(__path__, __name__)
-for importer, modname, ispkg in pkgutil.walk_packages(path=__path__, prefix=__name__ + '.'):
-    __import__(modname)
+GeneratorFactory.get_instance().declare_generators(__path__, __name__ + '.')
@@ -2,18 +2,69 @@
 Provide the generator inteface and the factory
 """
 import abc
+import pkgutil
+import importlib
+import threading
 from utils.exception import GeneratorNotFound
 
 
 class Generator(abc.ABC):
     """
     Generator interface
+    Generators declare their product type in PRODUCT_TYPE and the tile formats
+    they can encode in TILE_FORMATS, the format is requested with the format argument.
+    Generators are built once by the factory and shared between requests
     """
 
+    PRODUCT_TYPE = None
+    TILE_FORMATS = ("png",)
+
     @abc.abstractmethod
-    def generate_tile(self, tms_x, tms_y, tms_z, arguments):
+    def generate_tile(self, tms_x, tms_y, tms_z, arguments, trace=None):
+        """
+        Generate tile for the given x, y, z,
+        the trace of the request records the spans of the generation
+        """
+        pass
+
+    def prepare_tile(self, tms_x, tms_y, tms_z, arguments, trace=None):
+        """
+        Request the tile for the given x, y, z without waiting for it,
+        return the tile path and True if the tile is already available
+        """
+        return self.generate_tile(tms_x, tms_y, tms_z, arguments, trace), True
+
+    def canonical_arguments(self, arguments):
+        """
+        Return the arguments in a canonical form, the requests of the same tile
+        shall have the same canonical arguments. The arguments are kept as they are by default
+        """
+        return dict(arguments)
+
+    def check_arguments(self, arguments):
+        """
+        Raise ValueError or DataCannotBeComputed if the arguments cannot be parsed,
+        the arguments are not checked by default
+        """
+        pass
+
+    def is_tile_empty(self, tms_x, tms_y, tms_z):
+        """
+        Return True if the generator is known to have no data for the given x, y, z,
+        it shall answer without computation
+        """
+        return False
+
+    def add_tile_listener(self, tile_path, callback):
+        """
+        Call callback when the tile is available, generators without
+        notification let the caller poll the tile path
+        """
+        pass
+
+    def remove_tile_listener(self, tile_path, callback):
         """
-        Generate tile for the given x, y, z
+        Remove a callback added with add_tile_listener
         """
         pass
 
@@ -42,31 +93,66 @@ class Generator(abc.ABC):
 class GeneratorFactory:
     """
     Generator Factory is a singleton, use get_instance function
-    Return the registered generator for the given type
+    Return the registered generator for the given type,
+    generator modules are imported on the first request of their type
+    and generators are built once
     """
 
     instance = None
+    __instance_lock = threading.Lock()
 
     def __init__(self):
         """
         init
         """
         self.generator_map = {}
+        self.generator_modules = {}
+        self.generator_instances = {}
+        self.__lock = threading.RLock()
+
+    def declare_generator(self, product_type, module_name):
+        """
+        declare the module which register the generator for the given type,
+        the module is imported on the first build of the type
+        """
+        self.generator_modules[product_type] = module_name
+
+    def declare_generators(self, path, prefix):
+        """
+        declare the generator modules and packages found in the path, by their name,
+        they are listed without being imported
+        """
+        for _, module_name, _ in pkgutil.iter_modules(path, prefix):
+            product_type = module_name[len(prefix):]
+            if product_type != "generator_factory":
+                self.declare_generator(product_type, module_name)
 
     def register_generator(self, generator):
         """
         register a generator in the generator factory
         """
-        product_type = generator().product_type()
+        product_type = generator.PRODUCT_TYPE
+        if product_type is None:
+            product_type = generator().product_type()
         self.generator_map[product_type] = generator
 
     def build_generator(self, product_type):
         """
         return the generator for the given type
         """
-        if product_type not in self.generator_map:
-            raise GeneratorNotFound("Impossible to find generator for {}".format( product_type) )
-        return self.generator_map[product_type]()
+        generator = self.generator_instances.get(product_type)
+        if generator is not None:
+            return generator
+        with self.__lock:
+            if product_type in self.generator_instances:
+                return self.generator_instances[product_type]
+            if product_type not in self.generator_map and product_type in self.generator_modules:
+                importlib.import_module(self.generator_modules[product_type])
+            if product_type not in self.generator_map:
+                raise GeneratorNotFound("Impossible to find generator for {}".format( product_type) )
+            generator = self.generator_map[product_type]()
+            self.generator_instances[product_type] = generator
+            return generator
 
     @staticmethod
     def get_instance():
@@ -74,5 +160,7 @@ class GeneratorFactory:
         return the instance of the factory
         """
         if GeneratorFactory.instance is None:
-            GeneratorFactory.instance = GeneratorFactory()
+            with GeneratorFactory.__instance_lock:
+                if GeneratorFactory.instance is None:
+                    GeneratorFactory.instance = GeneratorFactory()
         return GeneratorFactory.instance
@@ -1,8 +1,20 @@
+import os
 from generator import generator_factory
 from generator.sentinel2.sentinel_tile_generator import SentinelTileGenerator
 from generator.sentinel2.sentinel_tile_producer import SentinelTileProducer
 from generator.sentinel2.sentinel_product_provider import SentinelProductProvider, PEPSSentinelProductDownloader
+from generator.sentinel2.sentinel_product_provider import LocalArchiveSentinelProductProvider
+
+PRODUCT_PROVIDERS = {
+    "peps": PEPSSentinelProductDownloader,
+    "local": LocalArchiveSentinelProductProvider,
+}
+
+PRODUCT_PROVIDER = os.getenv('WTMSE_PRODUCT_PROVIDER', 'peps').lower()
+if PRODUCT_PROVIDER not in PRODUCT_PROVIDERS:
+    raise ValueError("WTMSE_PRODUCT_PROVIDER {} not supported, use one of {}".format(
+        PRODUCT_PROVIDER, ", ".join(sorted(PRODUCT_PROVIDERS))))
 
 generator_factory = generator_factory.GeneratorFactory.get_instance()
-SentinelTileGenerator.ProductProviderClass = PEPSSentinelProductDownloader
-generator_factory.register_generator(SentinelTileGenerator)
\ No newline at end of file
+SentinelTileGenerator.ProductProviderClass = PRODUCT_PROVIDERS[PRODUCT_PROVIDER]
+generator_factory.register_generator(SentinelTileGenerator)
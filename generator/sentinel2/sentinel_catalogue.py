@@ -0,0 +1,157 @@
+"""
+Sentinel catalogue, keep the latest acquisition date of the zones
+and refresh the hot zones in background
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from datetime import datetime
+from utils.file_lock import atomic_path
+from utils.metrics import REGISTRY
+from .sentinel_tile_producer import Tile, SentinelImageProducer
+
+
+LOGGER = logging.getLogger("wtmse")
+LATEST_DATE_INDEX = os.getenv('WTMSE_LATEST_DATE_INDEX', os.path.join(tempfile.gettempdir(), "wtmse_latest_dates.json"))
+LATEST_DATE_MAX_AGE = float(os.getenv('WTMSE_LATEST_DATE_MAX_AGE', 24 * 3600))
+HOT_ZONES = [zone_name for zone_name in os.getenv('WTMSE_HOT_ZONES', '').split(',') if zone_name]
+CATALOGUE_REFRESH_INTERVAL = float(os.getenv('WTMSE_CATALOGUE_REFRESH_INTERVAL', 1800))
+CATALOGUE_REFRESH = REGISTRY.counter("wtmse_catalogue_refresh_total", "Hot zones catalogue refreshes", ["result"])
+
+
+class LatestDateIndex:
+    """
+    Latest date index, zone name -> latest acquisition date and the time it was checked.
+    The index is shared by the threads and persisted in a JSON file shared by the processes
+    """
+
+    def __init__(self, index_path=LATEST_DATE_INDEX, max_age=LATEST_DATE_MAX_AGE):
+        """
+        init
+        """
+        self.index_path = index_path
+        self.max_age = max_age
+        self.__dates = {}
+        self.__loaded_mtime = None
+        self.__lock = threading.Lock()
+
+    def __reload(self):
+        """
+        Reload the index if the file was written by another process, the lock shall be held
+        """
+        try:
+            mtime = os.stat(self.index_path).st_mtime
+        except OSError:
+            return
+        if mtime == self.__loaded_mtime:
+            return
+        try:
+            with open(self.index_path, 'r') as index_file:
+                content = json.load(index_file)
+            self.__dates = dict((zone_name, (checked_at, datetime.strptime(date_string, '%Y-%m-%d').date()))
+                                for zone_name, (checked_at, date_string) in content.items())
+            self.__loaded_mtime = mtime
+        except (OSError, ValueError, TypeError) as err:
+            LOGGER.error("Impossible to read latest date index %s: %s", self.index_path, err)
+
+    def __save(self):
+        """
+        Write the index, the lock shall be held
+        """
+        content = dict((zone_name, (checked_at, found_date.strftime('%Y-%m-%d')))
+                       for zone_name, (checked_at, found_date) in self.__dates.items())
+        try:
+            with atomic_path(self.index_path) as temporary_path:
+                with open(temporary_path, 'w') as index_file:
+                    json.dump(content, index_file, indent=1, sort_keys=True)
+            self.__loaded_mtime = os.stat(self.index_path).st_mtime
+        except OSError as err:
+            LOGGER.error("Impossible to write latest date index %s: %s", self.index_path, err)
+
+    def get(self, zone_name):
+        """
+        Return the latest date of the zone, None if unknown or checked more than max_age ago
+        """
+        with self.__lock:
+            self.__reload()
+            if zone_name not in self.__dates:
+                return None
+            checked_at, found_date = self.__dates[zone_name]
+            if time.time() - checked_at > self.max_age:
+                return None
+            return found_date
+
+    def set(self, zone_name, found_date):
+        """
+        Store the latest date of the zone, return True if the date changed
+        """
+        if isinstance(found_date, datetime):
+            found_date = found_date.date()
+        with self.__lock:
+            self.__reload()
+            previous = self.__dates.get(zone_name, (None, None))[1]
+            self.__dates[zone_name] = (time.time(), found_date)
+            self.__save()
+        return previous != found_date
+
+
+class SentinelCatalogueRefresher(threading.Thread):
+    """
+    Sentinel catalogue refresher, poll the catalogue for the hot zones,
+    update the latest date index and prepare the scene of a new acquisition
+    before the first request
+    """
+
+    def __init__(self, generator, latest_dates, zone_names=HOT_ZONES, interval=CATALOGUE_REFRESH_INTERVAL):
+        """
+        init
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.generator = generator
+        self.latest_dates = latest_dates
+        self.zone_names = zone_names
+        self.interval = interval
+
+    def warm_up(self, zone_name, found_date):
+        """
+        Request the scene preparation, download and big image, with the default render arguments
+        """
+        bands, first_clip, second_clip, third_clip, _, _ = self.generator.parse_arguments({})
+        scene = Tile(zone_name, found_date, None, None, bands, first_clip, second_clip, third_clip)
+        if not os.path.isfile(scene.big_png_path()):
+            LOGGER.info("Warm up scene %s %s", zone_name, found_date)
+            SentinelImageProducer.produce_request(scene)
+
+    def refresh(self, zone_name):
+        """
+        Refresh the latest date of a zone
+        """
+        try:
+            found_date = self.generator.product_provider.last_image_date_for_zone(zone_name)
+        except Exception as err:
+            CATALOGUE_REFRESH.inc(result="error")
+            LOGGER.error("Impossible to refresh the catalogue of zone %s: %s", zone_name, err)
+            return
+        if found_date is None:
+            CATALOGUE_REFRESH.inc(result="error")
+            return
+        if isinstance(found_date, datetime):
+            found_date = found_date.date()
+        changed = self.latest_dates.set(zone_name, found_date)
+        CATALOGUE_REFRESH.inc(result="changed" if changed else "unchanged")
+        if changed:
+            LOGGER.info("New acquisition for zone %s: %s", zone_name, found_date)
+        self.warm_up(zone_name, found_date)
+
+    def run(self):
+        """
+        Refresh the hot zones forever
+        """
+        while True:
+            for zone_name in self.zone_names:
+                self.refresh(zone_name)
+            time.sleep(self.interval)
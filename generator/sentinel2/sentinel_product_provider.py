@@ -9,11 +9,15 @@ import os.path
 import tempfile
 import zipfile
 import glob
+import time
+import threading
 from requests.auth import HTTPBasicAuth
 import requests
 from datetime import datetime, timedelta, date
+from utils.metrics import stage_timer
+from utils.file_lock import produce_once, atomic_path
+from utils.archive_manifest import ArchiveManifest
 
-logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger("sentinel-product-provider")
 
 
@@ -32,6 +36,18 @@ class SentinelProductProvider:
             LOGGER.debug("Try date time : %s", date_buffer)
         return date_buffer
 
+    def image_dates_for_zone(self, zone_name, date_from, date_to):
+        """
+        Found the images available for the zone name between the dates
+        """
+        dates = []
+        date_buffer = date_from
+        while date_buffer <= date_to:
+            if self.product_exist(zone_name, date_buffer):
+                dates.append(date_buffer)
+            date_buffer = date_buffer + timedelta(days=1)
+        return dates
+
     @abc.abstractmethod
     def product_exist(self, zone_name, date):
         raise NotImplementedError()
@@ -102,7 +118,11 @@ class SentinelProductDownloader(SentinelProductProvider):
                     LOGGER.info("Retrieve band downloaded in cache : %s",
                                 file_path)
                 else:
-                    file_path, headers = urllib.request.urlretrieve(url, file_path)
+                    def download():
+                        with atomic_path(file_path) as temporary_path:
+                            urllib.request.urlretrieve(url, temporary_path)
+                    if not produce_once(file_path, download):
+                        return None
                     LOGGER.info("Band downloaded : %s", file_path)
                 return file_path
             except urllib.error.HTTPError:
@@ -122,7 +142,9 @@ class PEPSSentinelProductDownloader(SentinelProductProvider):
     def __init__(self):
         USER_ENV_KEY = ('WTMSE'+'_'+self.__class__.__name__+'_USER').upper()
         PASSWORD_ENV_KEY = ('WTMSE'+'_'+self.__class__.__name__+'_PASSWORD').upper()
-        
+        URL_ENV_KEY = ('WTMSE'+'_'+self.__class__.__name__+'_URL').upper()
+
+        self.base_url = os.getenv(URL_ENV_KEY, PEPSSentinelProductDownloader.BASE_URL)
 
         self.peps_user = os.getenv(USER_ENV_KEY)
         self.peps_password = os.getenv(PASSWORD_ENV_KEY)
@@ -137,9 +159,10 @@ class PEPSSentinelProductDownloader(SentinelProductProvider):
         """
         params = {'tileid' : zone_name, 'maxRecords' : 1}
 
-        url_string = PEPSSentinelProductDownloader.BASE_URL + '?' + urllib.parse.urlencode(params)
+        url_string = self.base_url + '?' + urllib.parse.urlencode(params)
         try:
-            json_result = urllib.request.urlopen(url_string).read()
+            with stage_timer("catalogue"):
+                json_result = urllib.request.urlopen(url_string).read()
             results = json.loads(json_result.decode("utf-8"))
             for feature in results.get('features', []):
                 datestr = feature['properties']['startDate']
@@ -149,6 +172,24 @@ class PEPSSentinelProductDownloader(SentinelProductProvider):
         except urllib.error.HTTPError:
             return None
 
+    def image_dates_for_zone(self, zone_name, date_from, date_to):
+        """
+        Found the images available for the zone name between the dates
+        """
+        params = {'tileid' : zone_name, 'maxRecords' : 500,
+                  'startDate' : date_from.strftime('%Y-%m-%d') + 'T00:00:00.000Z',
+                  'completionDate' : date_to.strftime('%Y-%m-%d') + 'T23:59:00.000Z'}
+
+        url_string = self.base_url + '?' + urllib.parse.urlencode(params)
+        try:
+            with stage_timer("catalogue"):
+                json_result = urllib.request.urlopen(url_string).read()
+            results = json.loads(json_result.decode("utf-8"))
+            return sorted(set(datetime.strptime(feature['properties']['startDate'][:10], '%Y-%m-%d').date()
+                              for feature in results.get('features', [])))
+        except urllib.error.HTTPError:
+            return []
+
     @abc.abstractmethod
     def product_exist(self, zone_name, date):
         #&startDate=2018-11-20T00:00:00.000Z&completionDate=2018-11-20T23:59:00.000Z
@@ -161,9 +202,10 @@ class PEPSSentinelProductDownloader(SentinelProductProvider):
         complet_date_end = 'T23:59:00.000Z'
         params = {'tileid' : zone_name, 'maxRecords' : 1, 'startDate' : datestr+start_date_end, 'completionDate':datestr+complet_date_end}
 
-        url_string = PEPSSentinelProductDownloader.BASE_URL + '?' + urllib.parse.urlencode(params)
+        url_string = self.base_url + '?' + urllib.parse.urlencode(params)
         try:
-            json_result = urllib.request.urlopen(url_string).read()
+            with stage_timer("catalogue"):
+                json_result = urllib.request.urlopen(url_string).read()
             results = json.loads(json_result.decode("utf-8"))
             return len(results.get('features', [])) > 0
         except urllib.error.HTTPError:
@@ -177,9 +219,10 @@ class PEPSSentinelProductDownloader(SentinelProductProvider):
 
         params = {'tileid' : zone_name, 'maxRecords' : 1, 'startDate' : datestr+start_date_end, 'completionDate':datestr+complet_date_end}
 
-        url_string = PEPSSentinelProductDownloader.BASE_URL + '?' + urllib.parse.urlencode(params)
+        url_string = self.base_url + '?' + urllib.parse.urlencode(params)
         try:
-            json_result = urllib.request.urlopen(url_string).read()
+            with stage_timer("catalogue"):
+                json_result = urllib.request.urlopen(url_string).read()
             results = json.loads(json_result.decode("utf-8"))
             features = results.get('features', [])
             if len(features) == 1:
@@ -192,15 +235,24 @@ class PEPSSentinelProductDownloader(SentinelProductProvider):
                     LOGGER.info("Retrieve band downloaded in cache : %s",
                                 folder_path)
                 else:
-                    r = requests.get(feature['properties']['services']['download']['url'], auth=HTTPBasicAuth(self.peps_user, self.peps_password), stream=True)
-                    if r.status_code == 200:
-                        with open(file_path, 'wb') as f:
-                            for chunk in r:
-                                f.write(chunk)
-                        LOGGER.info("Band downloaded : %s", file_path)
-                        zip_ref = zipfile.ZipFile(file_path, 'r')
-                        zip_ref.extractall(folder_path)
-                        zip_ref.close()
+                    def download():
+                        if not os.path.isfile(file_path):
+                            with stage_timer("download"):
+                                r = requests.get(feature['properties']['services']['download']['url'], auth=HTTPBasicAuth(self.peps_user, self.peps_password), stream=True)
+                                if r.status_code != 200:
+                                    LOGGER.error("Impossible to download %s: %s", file_name, r.status_code)
+                                    return
+                                with atomic_path(file_path) as temporary_path:
+                                    with open(temporary_path, 'wb') as f:
+                                        for chunk in r:
+                                            f.write(chunk)
+                                LOGGER.info("Band downloaded : %s", file_path)
+                        with stage_timer("unzip"):
+                            with atomic_path(folder_path) as temporary_path:
+                                zip_ref = zipfile.ZipFile(file_path, 'r')
+                                zip_ref.extractall(temporary_path)
+                                zip_ref.close()
+                    produce_once(folder_path, download)
                 
                 products = {}
                 for band in bands:
@@ -218,6 +270,96 @@ class PEPSSentinelProductDownloader(SentinelProductProvider):
             return None
 
 
+class LocalArchiveSentinelProductProvider(SentinelProductProvider):
+    """
+    Local archive product provider, serve the bands of the SAFE products unzipped in a local directory
+    and the bands downloaded by the sentinel product downloader, without network.
+    The bands are found in the archive manifest, scanned in background at start then every refresh interval
+    """
+    REFRESH_INTERVAL = 300
+
+    def __init__(self):
+        ARCHIVE_ENV_KEY = ('WTMSE'+'_'+self.__class__.__name__+'_DIR').upper()
+        MANIFEST_ENV_KEY = ('WTMSE'+'_'+self.__class__.__name__+'_MANIFEST').upper()
+        REFRESH_ENV_KEY = ('WTMSE'+'_'+self.__class__.__name__+'_REFRESH').upper()
+
+        self.archive_dir = os.getenv(ARCHIVE_ENV_KEY, os.path.join(tempfile.gettempdir(), "wtmse_archive"))
+        manifest_path = os.getenv(MANIFEST_ENV_KEY, os.path.join(tempfile.gettempdir(), "wtmse_archive_manifest.json"))
+        self.refresh_interval = float(os.getenv(REFRESH_ENV_KEY, LocalArchiveSentinelProductProvider.REFRESH_INTERVAL))
+        if not os.path.isdir(self.archive_dir):
+            LOGGER.error('Set env key %s to the archive directory, %s is not a directory', ARCHIVE_ENV_KEY, self.archive_dir)
+        self.manifest = ArchiveManifest(self.archive_dir, manifest_path)
+        if not self.manifest.load():
+            LOGGER.info("Archive %s is being indexed in %s", self.archive_dir, manifest_path)
+        refresher = threading.Thread(target=self.__refresh_loop, daemon=True)
+        refresher.start()
+
+    def refresh(self):
+        """
+        Update the manifest with the products added or removed since the last refresh
+        """
+        with stage_timer("catalogue"):
+            changed = self.manifest.refresh()
+        if changed:
+            self.manifest.save()
+        return changed
+
+    def __refresh_loop(self):
+        """
+        Refresh the manifest now then every refresh interval,
+        the first scan walks the whole archive unless a manifest was loaded, the next ones only the modified directories
+        """
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                LOGGER.exception("Impossible to refresh the archive manifest of %s", self.archive_dir)
+            if self.refresh_interval <= 0:
+                return
+            time.sleep(self.refresh_interval)
+
+    def last_image_date_for_zone(self, zone_name):
+        """
+        Found last image available for the zone name, None if the zone is not in the archive
+        """
+        date_string = self.manifest.latest_date(zone_name)
+        if date_string is None:
+            return None
+        return datetime.strptime(date_string, '%Y%m%d').date()
+
+    def image_dates_for_zone(self, zone_name, date_from, date_to):
+        """
+        Found the images available for the zone name between the dates
+        """
+        date_from_string = date_from.strftime('%Y%m%d')
+        date_to_string = date_to.strftime('%Y%m%d')
+        return [datetime.strptime(date_string, '%Y%m%d').date() for date_string in self.manifest.dates(zone_name)
+                if date_from_string <= date_string <= date_to_string]
+
+    def product_exist(self, zone_name, date):
+        """
+        Verify if product exist in the given zone for the given date
+        """
+        return self.manifest.bands(zone_name, date.strftime('%Y%m%d')) is not None
+
+    def find_product_in_zone(self, zone_name, date_product, bands=[2, 3, 4]):
+        """
+        Return the paths of the bands of the product, None if the product is not in the archive
+        """
+        product = self.manifest.bands(zone_name, date_product.strftime('%Y%m%d'))
+        if product is None:
+            LOGGER.error("Impossible to find product of zone %s at %s in %s", zone_name, date_product, self.archive_dir)
+            return None
+        products = {}
+        for band in bands:
+            products[band] = product.get(band)
+            # a band removed since the last refresh
+            if products[band] is not None and not os.path.isfile(products[band]):
+                products[band] = None
+            if products[band] is None:
+                LOGGER.error("Impossible to find band B%02d of zone %s at %s", band, zone_name, date_product)
+        return products
+
 
 if __name__ == "__main__":
     dl = PEPSSentinelProductDownloader()
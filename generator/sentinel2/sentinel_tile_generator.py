@@ -2,31 +2,86 @@
 Sentinel tile generator, implement the tile generator interface for copernicus S2 data
 """
 
-import time
 import logging
 import os
+import threading
 import tempfile
 import datetime
-from datetime import date
+import shapely.wkt
 from generator.generator_factory import Generator
 from utils.tms_helper import bbox_from_xyz
-from utils.exception import DataCannotBeComputed, DataNotYetReady
-from .utils.sentinel_downloader import read_zones_from_data_file, find_zone
-from .sentinel_tile_producer import Tile, SentinelImageProducer
+from utils.exception import DataCannotBeComputed, DataNotYetReady, TileOutOfCoverage, InvalidExpression
+from utils.coverage import CoverageMask
+from utils.metrics import REGISTRY
+from utils.tracing import span
+from utils.band_math import BandExpression, parse_range, COLORMAPS, DEFAULT_COLORMAP, DEFAULT_RANGE
+from utils.composite import DEFAULT_PERCENTILE
+from utils.blob_store import BlobPruner, BLOB_STORE
+from .utils.sentinel_downloader import read_zones_from_data_file, find_zone, GRANULE_KML_FILE
+from .utils.tile_generator import TILE_BLOBS
+from .sentinel_tile_producer import Tile, SentinelImageProducer, SentinelTileProducer, format_number
+from .sentinel_tile_prefetcher import SentinelTilePrefetcher, PREFETCH
+from .sentinel_catalogue import LatestDateIndex, SentinelCatalogueRefresher, HOT_ZONES
 from .sentinel_product_provider import SentinelProductProvider, SentinelProductDownloader
 
 
-logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger("wtmse")
 ZONES_FEATURES = read_zones_from_data_file()
 MAXIMUM_SLEEP = 60
+MIN_ZOOM = 9
+MAX_ZOOM = 14
+DEFAULT_BANDS = [4, 3, 2]
+DEFAULT_CLIP = (0., 2500.)
+PYRAMID = os.getenv('WTMSE_PYRAMID', '').lower() in ('1', 'true', 'yes')
+TILE_CACHE = REGISTRY.counter("wtmse_tile_cache_total", "Tiles found in the cache", ["result"])
+
+
+def zones_geometries(zones_features):
+    """
+    Iterate over the geometries of the zones
+    """
+    for zones_x in zones_features.values():
+        for zones_y in zones_x.values():
+            for zone in zones_y:
+                yield shapely.wkt.loads(zone.geometry.to_wkt())
+
+
+def build_coverage_mask(zones_features):
+    """
+    Build the coverage mask of the zones in background, the bitmap is kept in the temporary directory
+    for the zones file it was built from
+    """
+    coverage = CoverageMask(MIN_ZOOM, MAX_ZOOM)
+    cache_path = os.path.join(tempfile.gettempdir(), "wtmse_coverage_{}_{}.bin".format(
+        MIN_ZOOM, int(os.path.getmtime(GRANULE_KML_FILE))))
+    coverage.build_in_background(zones_geometries(zones_features), cache_path)
+    return coverage
+
+
+def zones_under_tile(bbox):
+    """
+    Return the names of the zones under the tile corners, the zone of the tile center first
+    """
+    center = ((bbox[0][0] + bbox[1][0]) / 2., (bbox[0][1] + bbox[1][1]) / 2.)
+    zones = []
+    for longitude, latitude in (center, bbox[0], bbox[1], (bbox[0][0], bbox[1][1]), (bbox[1][0], bbox[0][1])):
+        zone = find_zone(ZONES_FEATURES, longitude, latitude)
+        if zone is not None and zone.name not in zones:
+            zones.append(zone.name)
+    return zones
+
+
+COVERAGE = build_coverage_mask(ZONES_FEATURES)
+LATEST_DATES = LatestDateIndex()
+
 
 class SentinelTileGenerator(Generator):
     """
     Sentinel tile generator, implement the tile generator interface for copernicus S2 data
     """
-    __last_date_for_today = {}
     ProductProviderClass = None
+    PRODUCT_TYPE = "sentinel2"
+    TILE_FORMATS = ("png", "jpg", "webp")
 
     def __init__(self):
         """
@@ -38,6 +93,14 @@ class SentinelTileGenerator(Generator):
         self.__blank_file = os.path.join(self.__dir_path, 'data', 'blank.png')
         self.product_provider = SentinelTileGenerator.ProductProviderClass()
         SentinelImageProducer.ProductProviderClass = SentinelTileGenerator.ProductProviderClass
+        SentinelImageProducer.product_provider = self.product_provider
+        self.pyramid = PYRAMID
+        self.prefetcher = SentinelTilePrefetcher(self, ZONES_FEATURES, MAX_ZOOM) if PREFETCH else None
+        SentinelTileProducer.prefetcher = self.prefetcher
+        if HOT_ZONES:
+            SentinelCatalogueRefresher(self, LATEST_DATES).start()
+        if BLOB_STORE:
+            BlobPruner(TILE_BLOBS).start()
 
     def get_data_not_yet_ready_file(self):
         LOGGER.debug("Data not yet ready, send %s", self.__blank_file)
@@ -48,23 +111,53 @@ class SentinelTileGenerator(Generator):
         return self.__error_file
 
 
-    def generate_file_name(self, zone_name, date, tms_x, tms_y, tms_z, bands, first_clip, second_clip, third_clip):
+    def generate_file_name(self, zone_name, date, tms_x, tms_y, tms_z, bands, first_clip, second_clip, third_clip, tile_format="png",
+                           composite=None):
         file_name = zone_name + "_" + \
         str(date.year) + "_" + str(date.month) +  "_" + str(date.day) + \
         "_" + str(tms_x) + "_" + str(tms_y) + "_" + str(tms_z) + \
         "_"+str(bands[0])+"_"+str(bands[1])+"_"+str(bands[2])+ \
         "_"+str(first_clip[0])+"_" +str(first_clip[1])+ \
         "_"+str(second_clip[0])+"_"+str(second_clip[1])+ \
-        "_"+str(third_clip[0])+"_" +str(third_clip[1])+ \
-        ".png"
+        "_"+str(third_clip[0])+"_" +str(third_clip[1])
+        if composite is not None:
+            file_name = file_name + "_" + composite[0].strftime('%Y%m%d') + "_" + composite[1].strftime('%Y%m%d') + \
+                "_p" + format_number(composite[2])
+        return file_name + "." + tile_format
+
+    def generate_band_math_file_name(self, zone_name, date, tms_x, tms_y, tms_z, band_math, tile_format="png"):
+        expression, value_range, colormap = band_math
+        file_name = zone_name + "_" + \
+        str(date.year) + "_" + str(date.month) +  "_" + str(date.day) + \
+        "_" + str(tms_x) + "_" + str(tms_y) + "_" + str(tms_z) + \
+        "_expr_" + expression.key() + \
+        "_" + str(value_range[0]) + "_" + str(value_range[1]) + \
+        "_" + colormap + \
+        "." + tile_format
         return file_name
     
+    def build_tile(self, zone_name, found_date, tms_x, tms_y, tms_z, bands, first_clip, second_clip, third_clip, tile_format="png",
+                   band_math=None, composite=None):
+        """
+        Return the tile request of the given x, y, z in the zone image,
+        or rendered from a band expression when band_math (expression, range, colormap) is given,
+        or in the composite image when composite (date_from, date_to, percentile) is given
+        """
+        if band_math is None:
+            file_name = self.generate_file_name(zone_name, found_date, tms_x, tms_y, tms_z, bands, first_clip, second_clip, third_clip, tile_format,
+                                                composite)
+        else:
+            file_name = self.generate_band_math_file_name(zone_name, found_date, tms_x, tms_y, tms_z, band_math, tile_format)
+            bands = list(band_math[0].bands)
+        return Tile(zone_name, found_date, bbox_from_xyz(tms_x, tms_y, tms_z), os.path.join(tempfile.gettempdir(), file_name),
+                    bands, first_clip, second_clip, third_clip, tms_x, tms_y, tms_z, band_math=band_math, composite=composite)
+
     def parse_arguments(self, arguments):
         """
         Parse argument function
         """
-        bands = [4,3,2]
-        first_clip = (0., 2500.)
+        bands = DEFAULT_BANDS
+        first_clip = DEFAULT_CLIP
         second_clip = first_clip
         third_clip = first_clip
         zone_name = None
@@ -76,7 +169,7 @@ class SentinelTileGenerator(Generator):
         def parse_clip(arg_string):        
             if arg_string in arguments:
                 return tuple(map(float,arguments.get(arg_string, '0,2500').split(',')))
-            return (0., 2500.)
+            return DEFAULT_CLIP
         
         first_clip = parse_clip('first_clip')
         second_clip = parse_clip('second_clip')
@@ -90,68 +183,247 @@ class SentinelTileGenerator(Generator):
             date_requested = datetime.datetime.strptime(date_requested, '%Y%m%d').date()
 
         return bands, first_clip, second_clip, third_clip, zone_name, date_requested
+
+    def check_arguments(self, arguments):
+        """
+        Parse the arguments as prepare_tile does, raise ValueError or DataCannotBeComputed if they cannot be parsed
+        """
+        self.parse_arguments(arguments)
+        self.parse_format(arguments)
+        if self.parse_band_math(arguments) is not None and self.parse_composite(arguments) is not None:
+            raise DataCannotBeComputed("Band math tiles shall be from one date")
+
+    def canonical_arguments(self, arguments):
+        """
+        Return the arguments parsed and written back in one form, without the defaults and the unknown arguments,
+        the arguments which cannot be parsed are kept as they are
+        """
+        try:
+            bands, first_clip, second_clip, third_clip, zone_name, date_requested = self.parse_arguments(arguments)
+            tile_format = self.parse_format(arguments)
+            band_math = self.parse_band_math(arguments)
+            composite = self.parse_composite(arguments)
+        except (ValueError, DataCannotBeComputed):
+            return dict(arguments)
+        canonical = {}
+        if band_math is not None:
+            expression, value_range, colormap = band_math
+            canonical["expr"] = "".join(expression.expression.split())
+            if value_range != DEFAULT_RANGE:
+                canonical["range"] = ",".join(format_number(value) for value in value_range)
+            if colormap != DEFAULT_COLORMAP:
+                canonical["colormap"] = colormap
+        else:
+            if list(bands) != DEFAULT_BANDS:
+                canonical["bands"] = ",".join(str(band) for band in bands)
+            for name, clip in (("first_clip", first_clip), ("second_clip", second_clip), ("third_clip", third_clip)):
+                if clip != DEFAULT_CLIP:
+                    canonical[name] = ",".join(format_number(value) for value in clip)
+        if zone_name is not None:
+            canonical["zone"] = zone_name
+        if date_requested is not None:
+            canonical["date"] = date_requested.strftime('%Y%m%d')
+        if composite is not None:
+            canonical["date_from"] = composite[0].strftime('%Y%m%d')
+            # without date_to the composite follows the days
+            if "date_to" in arguments:
+                canonical["date_to"] = composite[1].strftime('%Y%m%d')
+            if composite[2] != DEFAULT_PERCENTILE:
+                canonical["percentile"] = format_number(composite[2])
+        if tile_format != "png":
+            canonical["format"] = tile_format
+        return canonical
+
+    def parse_format(self, arguments):
+        """
+        Return the requested tile format, png by default
+        """
+        tile_format = arguments.get("format", "png")
+        if tile_format not in SentinelTileGenerator.TILE_FORMATS:
+            raise DataCannotBeComputed("Format {} not supported".format(tile_format))
+        return tile_format
+
+    def parse_band_math(self, arguments):
+        """
+        Return the (expression, range, colormap) of the expr render mode, None for the bands render mode
+        """
+        if "expr" not in arguments:
+            return None
+        expression = BandExpression(arguments.get("expr"))
+        value_range = parse_range(arguments["range"]) if "range" in arguments else DEFAULT_RANGE
+        colormap = arguments.get("colormap", DEFAULT_COLORMAP)
+        if colormap not in COLORMAPS:
+            raise InvalidExpression("Colormap {} not supported".format(colormap))
+        return expression, value_range, colormap
+
+    def parse_composite(self, arguments):
+        """
+        Return the (date_from, date_to, percentile) of the composite render mode, None for a single date.
+        date_to is today by default
+        """
+        if "date_from" not in arguments and "date_to" not in arguments:
+            return None
+        if "date" in arguments:
+            raise DataCannotBeComputed("date and date_from, date_to shall not be requested together")
+        try:
+            date_from = datetime.datetime.strptime(arguments.get("date_from", ""), '%Y%m%d').date()
+            date_to = datetime.datetime.strptime(arguments["date_to"], '%Y%m%d').date() \
+                if "date_to" in arguments else datetime.date.today()
+            percentile = float(arguments.get("percentile", DEFAULT_PERCENTILE))
+        except ValueError as err:
+            raise DataCannotBeComputed("Invalid composite arguments: {}".format(err))
+        if date_from > date_to or not 0. <= percentile <= 100.:
+            raise DataCannotBeComputed("Composite needs date_from <= date_to and a percentile between 0 and 100")
+        return date_from, date_to, percentile
         
-    def generate_tile(self, tms_x, tms_y, tms_z, arguments):
+    def prepare_tile(self, tms_x, tms_y, tms_z, arguments, trace=None):
         """
-        generate tile implementation, use an sentinel tile producer to treat data
+        prepare tile implementation, request the tile to the sentinel tile producer without waiting,
+        the requested tile carries the trace through the producers
         """
 
-        if (tms_z < 9) or (tms_z > 14):
+        if (tms_z < MIN_ZOOM) or (tms_z > MAX_ZOOM):
             LOGGER.debug("Image shall be between 9 < z < 14 ")
-            raise DataCannotBeComputed("Image shall be between 9 < z < 14 ")
+            raise TileOutOfCoverage("Image shall be between 9 < z < 14 ")
         bbox = bbox_from_xyz(tms_x, tms_y, tms_z)
         zone_top = find_zone(ZONES_FEATURES, bbox[0][0], bbox[0][1])
         zone_bottom = find_zone(ZONES_FEATURES, bbox[1][0], bbox[1][1])
         if zone_bottom is None or zone_top is None:
-            raise DataCannotBeComputed("Impossible to find zone ")
+            COVERAGE.mark_empty(tms_x, tms_y, tms_z)
+            raise TileOutOfCoverage("Impossible to find zone ")
         LOGGER.debug("Zone top: %s", zone_top.name)
         LOGGER.debug("Zone bottom: %s", zone_bottom.name)
 
-        if zone_top.name == zone_bottom.name:
-            found_date = None
+        bands, first_clip, second_clip, third_clip, zone_name, date_requested = self.parse_arguments(arguments)
+        tile_format = self.parse_format(arguments)
+        band_math = self.parse_band_math(arguments)
+        composite = self.parse_composite(arguments)
+        if band_math is not None and composite is not None:
+            raise DataCannotBeComputed("Band math tiles shall be from one date")
 
-            bands, first_clip, second_clip, third_clip, zone_name, found_date = self.parse_arguments(arguments)
+        def scene_date(scene_zone):
+            if composite is not None:
+                return composite[1]
+            return date_requested or self.latest_date(scene_zone)
 
+        if zone_top.name == zone_bottom.name:
             if zone_name is not None and zone_name != zone_bottom.name:
                 raise DataCannotBeComputed("Data not requested")
             zone_name = zone_top.name
-            if found_date is None:
-                if zone_top.name not in SentinelTileGenerator.__last_date_for_today:
-                        found_date = self.product_provider.last_image_date_for_zone(zone_name)
-                        SentinelTileGenerator.__last_date_for_today[zone_top.name] = (date.today(),found_date)
-                else:
-                    if SentinelTileGenerator.__last_date_for_today[zone_top.name][0] != date.today():
-                        found_date = self.product_provider.last_image_date_for_zone(zone_name)
-                        SentinelTileGenerator.__last_date_for_today[zone_top.name] = (date.today(),found_date)
-                    else:
-                        found_date = SentinelTileGenerator.__last_date_for_today[zone_top.name][1]
-                if found_date is None:
-                    raise DataCannotBeComputed("Impossible to find date for zone")
-
-            file_name = self.generate_file_name(zone_name ,found_date,tms_x,tms_y,tms_z,bands, first_clip, second_clip, third_clip)
-            file_path = os.path.join(tempfile.gettempdir(), file_name)
-
-            if os.path.isfile(file_path):
-                return file_path
-
-            tile = Tile(zone_name, found_date, bbox, file_path, bands, first_clip, second_clip, third_clip)
-            SentinelImageProducer.produce_request(tile)
+            found_date = scene_date(zone_name)
+            tile = self.build_tile(zone_name, found_date, tms_x, tms_y, tms_z, bands, first_clip, second_clip, third_clip, tile_format,
+                                   band_math, composite)
+        elif band_math is not None:
+            raise DataCannotBeComputed("Band math tiles shall be in one zone")
+        else:
+            zones = self.tile_zones(bbox)
+            if zone_name is not None:
+                if zone_name not in zones:
+                    raise DataCannotBeComputed("Data not requested")
+                zones = [zone_name]
+            scenes = [Tile(mosaic_zone, scene_date(mosaic_zone), None, None,
+                           bands, first_clip, second_clip, third_clip, composite=composite) for mosaic_zone in zones]
+            tile = self.build_mosaic_tile(scenes, tms_x, tms_y, tms_z, tile_format)
+        file_path = tile.file_path
+
+        if os.path.isfile(file_path):
+            TILE_CACHE.inc(result="hit")
+            if self.prefetcher is not None:
+                self.prefetcher.tile_served(tile)
+            return file_path, True
+        TILE_CACHE.inc(result="miss")
+
+        # band math and mosaic tiles are rendered from the tile windows, as fast as from children
+        if self.pyramid and tms_z < MAX_ZOOM and band_math is None and tile.mosaic is None:
+            children = [self.build_tile(zone_name, found_date, child_x, child_y, tms_z + 1,
+                                        bands, first_clip, second_clip, third_clip, tile_format, None, composite)
+                        for child_y in (2 * tms_y, 2 * tms_y + 1)
+                        for child_x in (2 * tms_x, 2 * tms_x + 1)]
+            # without any cached child, four extracts cost more than one direct render
+            if any(os.path.isfile(child.file_path) for child in children):
+                tile.children = children
+        tile.trace = trace
+        SentinelImageProducer.produce_request(tile)
+        return file_path, False
+
+    def latest_date(self, zone_name):
+        """
+        Return the latest acquisition date of the zone
+        """
+        found_date = LATEST_DATES.get(zone_name)
+        if found_date is None:
+            found_date = self.product_provider.last_image_date_for_zone(zone_name)
+            if found_date is not None:
+                LATEST_DATES.set(zone_name, found_date)
+        if found_date is None:
+            raise DataCannotBeComputed("Impossible to find date for zone")
+        return found_date
+
+    def tile_zones(self, bbox):
+        """
+        Return the names of the zones under the tile corners, the zone of the tile center first
+        """
+        return zones_under_tile(bbox)
+
+    def build_mosaic_tile(self, scenes, tms_x, tms_y, tms_z, tile_format="png"):
+        """
+        Return the tile request of the given x, y, z mosaicked from the scenes of several zones,
+        the first scene wins where the zones overlap
+        """
+        first_scene = scenes[0]
+        file_name = "mosaic_" + "_".join(scene.scene_name() for scene in scenes) + \
+            "_" + str(tms_x) + "_" + str(tms_y) + "_" + str(tms_z) + \
+            "_" + str(first_scene.bands[0]) + "_" + str(first_scene.bands[1]) + "_" + str(first_scene.bands[2]) + \
+            "_" + str(first_scene.first_clip[0]) + "_" + str(first_scene.first_clip[1]) + \
+            "_" + str(first_scene.second_clip[0]) + "_" + str(first_scene.second_clip[1]) + \
+            "_" + str(first_scene.third_clip[0]) + "_" + str(first_scene.third_clip[1]) + \
+            "." + tile_format
+        return Tile(first_scene.zone_name, first_scene.found_date, bbox_from_xyz(tms_x, tms_y, tms_z),
+                    os.path.join(tempfile.gettempdir(), file_name), first_scene.bands, first_scene.first_clip,
+                    first_scene.second_clip, first_scene.third_clip, tms_x, tms_y, tms_z, mosaic=scenes,
+                    composite=first_scene.composite)
+
+    def is_tile_empty(self, tms_x, tms_y, tms_z):
+        return not COVERAGE.covers(tms_x, tms_y, tms_z)
 
+    def add_tile_listener(self, tile_path, callback):
+        SentinelTileProducer.tile_done.add_listener(tile_path, callback)
+
+    def remove_tile_listener(self, tile_path, callback):
+        SentinelTileProducer.tile_done.remove_listener(tile_path, callback)
+
+    def generate_tile(self, tms_x, tms_y, tms_z, arguments, trace=None):
+        """
+        generate tile implementation, use an sentinel tile producer to treat data
+        and wait for the tile, the wait ends when the producers are done with the tile or failed
+        """
+        with span(trace, "prepare"):
+            file_path, ready = self.prepare_tile(tms_x, tms_y, tms_z, arguments, trace)
+        if ready:
+            return file_path
+
+        tile_done = threading.Event()
+        self.add_tile_listener(file_path, tile_done.set)
+        try:
             actual_sleep = 0
-            while not os.path.exists(file_path) and actual_sleep < MAXIMUM_SLEEP:
-                time.sleep(1)
-                actual_sleep = actual_sleep + 1
-
-            if os.path.isfile(file_path):
-                return file_path
-            LOGGER.debug("Data not yet ready")
-            raise DataNotYetReady("File not yet ready, retry later")
-        else:
-            raise DataCannotBeComputed("Image shall be in the same tile")
+            with span(trace, "wait"):
+                while not os.path.exists(file_path) and actual_sleep < MAXIMUM_SLEEP and \
+                        (trace is None or not trace.errors):
+                    # the listener is called once, when the tile is produced or cannot be
+                    if tile_done.wait(1):
+                        break
+                    actual_sleep = actual_sleep + 1
+        finally:
+            self.remove_tile_listener(file_path, tile_done.set)
+
+        if os.path.isfile(file_path):
+            return file_path
+        LOGGER.debug("Data not yet ready")
+        raise DataNotYetReady("File not yet ready, retry later")
 
 
     def product_type(self,):
         """
         return sentinel2 string
         """
-        return "sentinel2"
+        return SentinelTileGenerator.PRODUCT_TYPE
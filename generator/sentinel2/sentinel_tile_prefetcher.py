@@ -0,0 +1,156 @@
+"""
+Sentinel tile prefetcher, render the tiles a map client will likely request next
+"""
+
+import os
+import queue
+import logging
+import threading
+from collections import OrderedDict
+import shapely.wkt
+from shapely.geometry import Point
+from utils.metrics import REGISTRY
+from .utils.sentinel_downloader import find_zone_by_name
+from .sentinel_tile_producer import SentinelTileProducer, PREFETCH_PRIORITY
+
+
+LOGGER = logging.getLogger("wtmse")
+PREFETCH = os.getenv('WTMSE_PREFETCH', '').lower() in ('1', 'true', 'yes')
+PREFETCH_BUDGET = int(os.getenv('WTMSE_PREFETCH_BUDGET', 64))
+PREFETCH_RING = int(os.getenv('WTMSE_PREFETCH_RING', 1))
+PREFETCHED_SIZE = 10000
+SERVED_QUEUE_SIZE = 1000
+PREFETCH_TILES = REGISTRY.counter("wtmse_prefetch_tiles_total", "Tiles handled by the prefetcher", ["result"])
+PREFETCH_HITS = REGISTRY.counter("wtmse_prefetch_hits_total", "Prefetched tiles requested by a client")
+
+
+class SentinelTilePrefetcher:
+    """
+    Sentinel tile prefetcher, after a tile is served queue low priority renders of the ring
+    of neighbours and of the children of the next zoom level, in the same scene and with the same parameters.
+    At most budget prefetched tiles are waiting in the tile producers queue.
+    The served tiles are handed to the prefetch thread, the requests do not wait for the prefetch,
+    and mosaic tiles are not prefetched, they have no scene image to extract from
+    """
+
+    def __init__(self, generator, zones_features, max_zoom, budget=PREFETCH_BUDGET, ring=PREFETCH_RING):
+        """
+        init
+        """
+        self.generator = generator
+        self.zones_features = zones_features
+        self.max_zoom = max_zoom
+        self.budget = budget
+        self.ring = ring
+        self.__zone_geometries = {}
+        self.__pending = set()
+        self.__prefetched = OrderedDict()
+        self.__surrounded = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__served = queue.Queue(SERVED_QUEUE_SIZE)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def zone_geometry(self, zone_name):
+        """
+        Return the geometry of the zone
+        """
+        if zone_name not in self.__zone_geometries:
+            zone = find_zone_by_name(self.zones_features, zone_name)
+            self.__zone_geometries[zone_name] = None if zone is None else shapely.wkt.loads(zone.geometry.to_wkt())
+        return self.__zone_geometries[zone_name]
+
+    def candidates(self, tile):
+        """
+        Return the (x, y, z) of the neighbours and children of the tile
+        """
+        tiles_count = 1 << tile.tms_z
+        for tms_y in range(tile.tms_y - self.ring, tile.tms_y + self.ring + 1):
+            for tms_x in range(tile.tms_x - self.ring, tile.tms_x + self.ring + 1):
+                if (tms_x, tms_y) != (tile.tms_x, tile.tms_y) and 0 <= tms_x < tiles_count and 0 <= tms_y < tiles_count:
+                    yield tms_x, tms_y, tile.tms_z
+        if tile.tms_z < self.max_zoom:
+            for tms_y in (2 * tile.tms_y, 2 * tile.tms_y + 1):
+                for tms_x in (2 * tile.tms_x, 2 * tile.tms_x + 1):
+                    yield tms_x, tms_y, tile.tms_z + 1
+
+    def prefetch_around(self, tile):
+        """
+        Queue the prefetch of the tiles around the served tile
+        """
+        if tile.tms_z is None:
+            return
+        with self.__lock:
+            if tile.file_path in self.__surrounded:
+                return
+            self.__surrounded[tile.file_path] = True
+            while len(self.__surrounded) > PREFETCHED_SIZE:
+                self.__surrounded.popitem(last=False)
+        zone_geometry = self.zone_geometry(tile.zone_name)
+        if zone_geometry is None:
+            return
+        tile_format = os.path.splitext(tile.file_path)[1][1:]
+        for tms_x, tms_y, tms_z in self.candidates(tile):
+            candidate = self.generator.build_tile(tile.zone_name, tile.found_date, tms_x, tms_y, tms_z, tile.bands,
+                                                  tile.first_clip, tile.second_clip, tile.third_clip, tile_format,
+                                                  tile.band_math, tile.composite)
+            bbox = candidate.bbox
+            if not Point(bbox[0][0], bbox[0][1]).within(zone_geometry) or \
+                    not Point(bbox[1][0], bbox[1][1]).within(zone_geometry):
+                continue
+            if os.path.isfile(candidate.file_path):
+                continue
+            with self.__lock:
+                if candidate.file_path in self.__pending:
+                    continue
+                if len(self.__pending) >= self.budget:
+                    PREFETCH_TILES.inc(result="over_budget")
+                    return
+                self.__pending.add(candidate.file_path)
+            candidate.prefetch = True
+            PREFETCH_TILES.inc(result="queued")
+            SentinelTileProducer.produce_request(candidate, PREFETCH_PRIORITY)
+
+    def done(self, tile, dropped=False):
+        """
+        A prefetched tile left the tile producers queue
+        """
+        rendered = not dropped and os.path.isfile(tile.file_path)
+        with self.__lock:
+            self.__pending.discard(tile.file_path)
+            if rendered:
+                self.__prefetched[tile.file_path] = True
+                while len(self.__prefetched) > PREFETCHED_SIZE:
+                    self.__prefetched.popitem(last=False)
+        PREFETCH_TILES.inc(result="dropped" if dropped else "rendered" if rendered else "failed")
+
+    def schedule(self, tile):
+        """
+        Hand the tile to the prefetch thread without waiting, the tile is skipped when the thread is late
+        """
+        if tile.mosaic is not None:
+            return
+        try:
+            self.__served.put_nowait(tile)
+        except queue.Full:
+            PREFETCH_TILES.inc(result="skipped")
+
+    def tile_served(self, tile):
+        """
+        A tile is served from the cache, count it if it was prefetched and prefetch around it
+        """
+        with self.__lock:
+            prefetched = self.__prefetched.pop(tile.file_path, None)
+        if prefetched:
+            PREFETCH_HITS.inc()
+        self.schedule(tile)
+
+    def run(self):
+        """
+        Prefetch around the served tiles forever
+        """
+        while True:
+            tile = self.__served.get()
+            try:
+                self.prefetch_around(tile)
+            except Exception as err:
+                LOGGER.exception("Impossible to prefetch around %s: %s", tile.file_path, err)
@@ -4,20 +4,55 @@ Sentinel tile producer module
 import os
 import tempfile
 import logging
-from threading import Thread
-from queue import Queue
+import itertools
+from collections import OrderedDict
+from threading import Thread, Lock
+from queue import Queue, PriorityQueue
+from utils.completion import CompletionRegistry
+from utils.file_lock import produce_once, atomic_path
+from utils.metrics import REGISTRY, stage_timer
+from utils.memory_budget import MEMORY_BUDGET
+from utils.tracing import span
 from .sentinel_product_provider import SentinelProductProvider, SentinelProductDownloader
-from .utils.tile_generator import get_x_y_for_lon_lat, create_raster_from_band, extract_tile, create_png_from_raster
+from .utils.tile_generator import get_x_y_for_lon_lat, create_raster_from_band, create_png_from_raster
+from .utils.tile_generator import read_image, extract_tile_from_image, create_tile_from_children
+from .utils.tile_generator import map_raw_array, write_raw_array, downsample_image
+from .utils.tile_generator import band_stack_memory, stretch_memory, image_memory, overviews_memory, extract_memory
+from .utils.tile_generator import band_math_memory, create_tile_from_expression, mosaic_memory, create_mosaic_tile
+from .utils.tile_generator import composite_raster_memory, create_composite_raster
+from utils.composite import composite_dates
+from utils.tms_helper import mercator_bbox_from_xyz
 
 
-logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger("wtmse")
+PRODUCER_IN_FLIGHT = REGISTRY.gauge("wtmse_producer_in_flight", "Tiles in progress in the producers", ["producer"])
+SCENE_CACHE = REGISTRY.counter("wtmse_scene_cache_total", "Scene artefacts found in the cache", ["artefact", "result"])
+REQUEST_PRIORITY = 0
+PREFETCH_PRIORITY = 1
+MEMMAP_SCENES = os.getenv('WTMSE_MEMMAP_SCENES', '').lower() in ('1', 'true', 'yes')
+OVERVIEW_LEVELS = int(os.getenv('WTMSE_OVERVIEW_LEVELS', 4))
+
+
+def format_number(value):
+    """
+    Return the shortest text giving back the number, without the .0 of the integers
+    """
+    text = repr(float(value))
+    return text[:-2] if text.endswith(".0") else text
+
 
 class Tile:
     """
-    Tile class, represent a tile request
+    Tile class, represent a tile request,
+    a tile with children is built from its four children tiles of the next zoom level,
+    a tile with band_math (expression, range, colormap) is rendered from the band windows without the big png,
+    a mosaic tile is rendered from the raster windows of the mosaic scenes, the first scene wins,
+    a composite tile (date_from, date_to, percentile) is extracted from the composite scene of the dates,
+    a requested tile carries the trace of its request through the producers
     """
-    def __init__(self, zone_name, found_date, bbox, file_path, bands, first_clip, second_clip, third_clip):
+    def __init__(self, zone_name, found_date, bbox, file_path, bands, first_clip, second_clip, third_clip,
+                 tms_x=None, tms_y=None, tms_z=None, children=None, band_math=None, mosaic=None, composite=None,
+                 trace=None):
         self.zone_name = zone_name
         self.found_date = found_date
         self.bbox = bbox
@@ -27,6 +62,66 @@ class Tile:
         self.second_clip = second_clip
         self.third_clip = third_clip
         self.bands_path = None
+        self.tms_x = tms_x
+        self.tms_y = tms_y
+        self.tms_z = tms_z
+        self.children = children
+        self.band_math = band_math
+        self.mosaic = mosaic
+        self.composite = composite
+        self.trace = trace
+        self.prefetch = False
+
+    def scene_array_path(self, level):
+        """
+        Return the path of the raw array of the big png, level 0 is the full resolution,
+        each overview level halve the previous one
+        """
+        return self.big_png_path()[:-len(".png")] + "_" + str(level) + ".npy"
+
+    def children_cached(self):
+        """
+        Return True if the tile can be built from its children without the big png
+        """
+        return bool(self.children) and all(os.path.isfile(child.file_path) for child in self.children)
+
+    def scene_name(self):
+        """
+        Return the name of the scene of the tile, its zone and date or its zone and composite
+        """
+        if self.composite is not None:
+            date_from, date_to, percentile = self.composite
+            return self.zone_name + "_" + date_from.strftime('%Y%m%d') + "_" + date_to.strftime('%Y%m%d') + \
+                "_p" + format_number(percentile)
+        return self.zone_name + "_" + \
+            str(self.found_date.year) + "_" + \
+            str(self.found_date.month) + "_" + str(self.found_date.day)
+
+    def raster_path(self):
+        """
+        Return the path of the big raster stacking the tile bands
+        """
+        tiff_name = self.scene_name() + \
+            "_"+str(self.bands[0])+"_"+str(self.bands[1])+"_"+str(self.bands[2])
+        return os.path.join(tempfile.gettempdir(), tiff_name)
+
+    def big_png_path(self):
+        """
+        Return the path of the big png clipped for the tile
+        """
+        big_png_name = self.scene_name() + \
+            "_"+str(self.bands[0])+"_"+str(self.bands[1])+"_"+str(self.bands[2])+ \
+            "_"+str(self.first_clip[0])+"_"+str(self.first_clip[1])+ \
+            "_"+str(self.second_clip[0])+"_"+str(self.second_clip[1])+ \
+            "_"+str(self.third_clip[0])+"_"+str(self.third_clip[1])+ \
+            ".png"
+        return os.path.join(tempfile.gettempdir(), big_png_name)
+
+    def trace_id(self):
+        """
+        Return the trace id of the tile request, - for the tiles not requested by a client
+        """
+        return "-" if self.trace is None else self.trace.trace_id
 
 
 class SentinelImageProducer(Thread):
@@ -36,7 +131,9 @@ class SentinelImageProducer(Thread):
 
     tile_to_product = Queue()
     __sentinel_tile_produce_instance = None
+    __start_lock = Lock()
     ProductProviderClass = None
+    product_provider = None
 
     def __init__(self):
         """
@@ -49,67 +146,207 @@ class SentinelImageProducer(Thread):
         """
         Add a tile request in the queue
         """
-        SentinelImageProducer.tile_to_product.put(tile)
-        if SentinelImageProducer.__sentinel_tile_produce_instance == None:
-            SentinelImageProducer.__sentinel_tile_produce_instance = SentinelImageProducer()
-            SentinelImageProducer.__sentinel_tile_produce_instance.start()
+        SentinelImageProducer.start_producers()
+        if tile.children_cached():
+            SentinelTileProducer.produce_request(tile)
+        else:
+            if tile.trace is not None:
+                tile.trace.queued("image")
+            SentinelImageProducer.tile_to_product.put(tile)
+
+    @staticmethod
+    def start_producers():
+        """
+        Start the image producer and the tile producers on the first request
+        """
+        with SentinelImageProducer.__start_lock:
+            if SentinelImageProducer.__sentinel_tile_produce_instance == None:
+                SentinelImageProducer.__sentinel_tile_produce_instance = SentinelImageProducer()
+                SentinelImageProducer.__sentinel_tile_produce_instance.start()
+
+                for i in range(0,5):
+                    tile_producer = SentinelTileProducer()
+                    tile_producer.start()
+
+    @staticmethod
+    def get_product_provider():
+        """
+        Return the product provider shared by the image producer
+        """
+        if SentinelImageProducer.product_provider is None:
+            SentinelImageProducer.product_provider = SentinelImageProducer.ProductProviderClass()
+        return SentinelImageProducer.product_provider
+
+    @staticmethod
+    def find_bands(tile):
+        """
+        Download the bands of the tile and keep their paths in the tile, return True if all the bands are found
+        """
+        product_provider = SentinelImageProducer.get_product_provider()
+        tile.bands_path = product_provider.find_product_in_zone(tile.zone_name, tile.found_date, tile.bands)
+        if tile.bands_path is None or any(tile.bands_path.get(band) is None for band in tile.bands):
+            LOGGER.error("Bands %s of %s not found", tile.bands, tile.file_path)
+            return False
+        return True
+
+    @staticmethod
+    def prepare_raster(tile):
+        """
+        Produce the big raster stacking the tile bands, return True if the raster exists
+        """
+        tile_bands = tile.bands
+        tiff_path = tile.raster_path()
+
+        def produce_raster():
+            if tile.composite is not None:
+                return SentinelImageProducer.produce_composite_raster(tile, tiff_path)
+            product_provider = SentinelImageProducer.get_product_provider()
+            bands = product_provider.find_product_in_zone(tile.zone_name, tile.found_date, tile_bands)
+            with MEMORY_BUDGET.reserve(band_stack_memory(bands[tile_bands[0]]), "band_stack"):
+                with atomic_path(tiff_path) as temporary_path:
+                    create_raster_from_band(
+                        bands[tile_bands[0]], bands[tile_bands[1]], bands[tile_bands[2]], temporary_path)
+
+        if os.path.isfile(tiff_path):
+            SCENE_CACHE.inc(artefact="raster", result="hit")
+        else:
+            SCENE_CACHE.inc(artefact="raster", result="miss")
+            if not produce_once(tiff_path, produce_raster):
+                LOGGER.error("Raster %s not produced", tiff_path)
+                return False
+        return True
+
+    @staticmethod
+    def produce_composite_raster(tile, tiff_path):
+        """
+        Produce the composite raster of the tile from the images of the zone between the composite dates
+        """
+        date_from, date_to, percentile = tile.composite
+        product_provider = SentinelImageProducer.get_product_provider()
+        bands_by_date = []
+        for image_date in composite_dates(product_provider.image_dates_for_zone(tile.zone_name, date_from, date_to)):
+            bands = product_provider.find_product_in_zone(tile.zone_name, image_date, tile.bands)
+            if bands is None or any(bands.get(band) is None for band in tile.bands):
+                LOGGER.error("Bands %s of zone %s at %s not found, date skipped", tile.bands, tile.zone_name, image_date)
+                continue
+            bands_by_date.append([bands[band] for band in tile.bands])
+        if not bands_by_date:
+            LOGGER.error("No image of zone %s between %s and %s", tile.zone_name, date_from, date_to)
+            return
+        with MEMORY_BUDGET.reserve(composite_raster_memory(bands_by_date[0][0], len(bands_by_date)), "composite"):
+            with atomic_path(tiff_path) as temporary_path:
+                create_composite_raster(bands_by_date, temporary_path, percentile)
+
+    def produce_image(self, tile):
+        """
+        Produce the big png image then send tile request to tile producer,
+        a tile without file path only request the scene preparation,
+        a mosaic tile only needs the rasters of its scenes
+        """
+        if tile.file_path is not None and os.path.isfile(tile.file_path):
+            SentinelTileProducer.tile_done.notify(tile.file_path)
+            return
+
+        if tile.band_math is not None:
+            with span(tile.trace, "bands", profiled=True):
+                bands = SentinelImageProducer.find_bands(tile)
+            if bands:
+                SentinelTileProducer.produce_request(tile)
+            else:
+                SentinelTileProducer.tile_failed(tile, "bands", "bands not found")
+            return
+
+        if tile.mosaic is not None:
+            with span(tile.trace, "raster", profiled=True):
+                rasters = all([SentinelImageProducer.prepare_raster(scene) for scene in tile.mosaic])
+            if rasters:
+                SentinelTileProducer.produce_request(tile)
+            else:
+                SentinelTileProducer.tile_failed(tile, "raster", "raster of a mosaic scene not produced")
+            return
+
+        with span(tile.trace, "raster", profiled=True):
+            raster = SentinelImageProducer.prepare_raster(tile)
+        if not raster:
+            SentinelTileProducer.tile_failed(tile, "raster", "raster not produced")
+            return
+        tiff_path = tile.raster_path()
+        big_png_path = tile.big_png_path()
+
+        def produce_png():
+            with MEMORY_BUDGET.reserve(stretch_memory(tiff_path), "stretch"):
+                with atomic_path(big_png_path) as temporary_path:
+                    create_png_from_raster(tiff_path, temporary_path, tile.first_clip, tile.second_clip, tile.third_clip)
+
+        if os.path.isfile(big_png_path):
+            SCENE_CACHE.inc(artefact="png", result="hit")
+        else:
+            SCENE_CACHE.inc(artefact="png", result="miss")
+            with span(tile.trace, "png", profiled=True):
+                png = produce_once(big_png_path, produce_png)
+            if not png:
+                LOGGER.error("Image %s not produced", big_png_path)
+                SentinelTileProducer.tile_failed(tile, "png", "image not produced")
+                return
+
+        if MEMMAP_SCENES:
+            with span(tile.trace, "scene_arrays", profiled=True):
+                SentinelImageProducer.produce_scene_arrays(tile)
+
+        if tile.file_path is not None:
+            SentinelTileProducer.produce_request(tile)
+
+    @staticmethod
+    def produce_scene_arrays(tile):
+        """
+        Write the big png and its overviews as raw arrays mapped by the tile producers
+        """
+        array_path = tile.scene_array_path(0)
 
-            for i in range(0,5):
-                tile_producer = SentinelTileProducer()
-                tile_producer.start()
+        def produce_arrays():
+            with MEMORY_BUDGET.reserve(overviews_memory(tile.big_png_path()), "scene_arrays"), \
+                    stage_timer("scene_arrays"):
+                levels = [read_image(tile.big_png_path())]
+                for _ in range(OVERVIEW_LEVELS):
+                    levels.append(downsample_image(levels[-1]))
+                # the full resolution array is written last, its presence tell all levels are written
+                for level in reversed(range(len(levels))):
+                    with atomic_path(tile.scene_array_path(level)) as temporary_path:
+                        write_raw_array(levels[level], temporary_path)
+
+        if os.path.isfile(array_path):
+            SCENE_CACHE.inc(artefact="array", result="hit")
+        else:
+            SCENE_CACHE.inc(artefact="array", result="miss")
+            if not produce_once(array_path, produce_arrays):
+                LOGGER.error("Scene arrays %s not produced, tiles are extracted from the png", array_path)
 
     def run(self):
         """
         Get tiles requests from the queue and treat it
-        Produce the big png image then send tile request to tile producer 
         """
         while True:
+            tile = SentinelImageProducer.tile_to_product.get()
             try:
-                tile = SentinelImageProducer.tile_to_product.get()
-                zone_name = tile.zone_name
-                found_date = tile.found_date
-                file_path = tile.file_path
-                tile_bands = tile.bands
-                first_clip = tile.first_clip
-                second_clip = tile.second_clip
-                third_clip = tile.third_clip
-
-                if not os.path.isfile(file_path):
-                    product_provider = SentinelImageProducer.ProductProviderClass()
-                    bands = product_provider.find_product_in_zone(zone_name, found_date, tile_bands)
-                    tiff_name = zone_name + "_" + \
-                        str(found_date.year) + "_" + \
-                        str(found_date.month) + "_" + str(found_date.day) + \
-                        "_"+str(tile_bands[0])+"_"+str(tile_bands[1])+"_"+str(tile_bands[2])
-                    tiff_path = os.path.join(tempfile.gettempdir(), tiff_name)
-
-                    if not os.path.isfile(tiff_path):
-                        create_raster_from_band(
-                            bands[tile_bands[0]], bands[tile_bands[1]], bands[tile_bands[2]], tiff_path)
-
-                    big_png_name = zone_name + "_" + \
-                        str(found_date.year) + "_" + str(found_date.month) + \
-                        "_" + str(found_date.day) + \
-                        "_"+str(tile_bands[0])+"_"+str(tile_bands[1])+"_"+str(tile_bands[2])+ \
-                        "_"+str(first_clip[0])+"_"+str(first_clip[1])+ \
-                        "_"+str(second_clip[0])+"_"+str(second_clip[1])+ \
-                        "_"+str(third_clip[0])+"_"+str(third_clip[1])+ \
-                        ".png"
-                    big_png_path = os.path.join(
-                        tempfile.gettempdir(), big_png_name)
-                    if not os.path.isfile(big_png_path):
-                        create_png_from_raster(tiff_path, big_png_path, first_clip, second_clip, third_clip)
-
-                    SentinelTileProducer.produce_request(tile)
+                if tile.trace is not None:
+                    tile.trace.dequeued("image")
+                # the stages of the image are profiled one by one
+                with PRODUCER_IN_FLIGHT.track_in_progress(producer="image"), span(tile.trace, "image"):
+                    self.produce_image(tile)
             except Exception as err:
-                LOGGER.error("Something wrong happen during image generation, maybe you should try to develop real code")
+                LOGGER.exception("Something wrong happen during image generation of %s, trace %s",
+                                 tile.file_path, tile.trace_id())
+                SentinelTileProducer.tile_failed(tile, "image", err)
 
 class SentinelTileProducer(Thread):
     """
     Ascync sentinel tile producer, produce tile from a request queue
     """
 
-    tile_to_product = Queue()
+    tile_to_product = PriorityQueue()
+    tile_done = CompletionRegistry()
+    prefetcher = None
+    __sequence = itertools.count()
 
     def __init__(self):
         """
@@ -118,61 +355,218 @@ class SentinelTileProducer(Thread):
         Thread.__init__(self)
 
     @staticmethod
-    def produce_request(tile):
+    def produce_request(tile, priority=REQUEST_PRIORITY):
         """
-        Add a tile request in the queue
+        Add a tile request in the queue, requests of the same priority are produced in order
+        """
+        if tile.trace is not None:
+            tile.trace.queued("tile")
+        SentinelTileProducer.tile_to_product.put((priority, next(SentinelTileProducer.__sequence), tile))
+
+    @staticmethod
+    def tile_failed(tile, stage, reason):
+        """
+        The tile cannot be produced, record the failure in its trace and wake the requests waiting for it,
+        a tile notified without its file is a failure for the listeners
+        """
+        if tile.trace is not None:
+            tile.trace.error(stage, reason)
+        if tile.file_path is not None:
+            SentinelTileProducer.tile_done.notify(tile.file_path)
+
+    @staticmethod
+    def scene_levels(tile):
+        """
+        Return the number of levels of the big png image, the raw arrays when available, else the png
+        """
+        if MEMMAP_SCENES and os.path.isfile(tile.scene_array_path(0)):
+            levels = 1
+            while levels <= OVERVIEW_LEVELS and os.path.isfile(tile.scene_array_path(levels)):
+                levels = levels + 1
+            return levels
+        return 1
+
+    @staticmethod
+    def scene_images(tile):
         """
-        SentinelTileProducer.tile_to_product.put(tile)
+        Return the levels of the big png image, the raw arrays mapped when available,
+        else the full resolution image read from the png
+        """
+        if MEMMAP_SCENES and os.path.isfile(tile.scene_array_path(0)):
+            return [map_raw_array(tile.scene_array_path(level)) for level in range(SentinelTileProducer.scene_levels(tile))]
+        return [read_image(tile.big_png_path())]
+
+    @staticmethod
+    def tile_corners(tile):
+        """
+        Return the corners of the tile in the full resolution image,
+        top left, top right, bottom left, bottom right
+        """
+        bbox = tile.bbox
+        tiff_path = tile.raster_path()
+        return [get_x_y_for_lon_lat(tiff_path, bbox[0][0], bbox[0][1]),
+                get_x_y_for_lon_lat(tiff_path, bbox[0][0], bbox[1][1]),
+                get_x_y_for_lon_lat(tiff_path, bbox[1][0], bbox[0][1]),
+                get_x_y_for_lon_lat(tiff_path, bbox[1][0], bbox[1][1])]
+
+    @staticmethod
+    def select_level(corners, levels, out_size=512):
+        """
+        Return the lowest resolution level still giving out_size pixels on the tile
+        """
+        size = max(corner[0] for corner in corners) - min(corner[0] for corner in corners)
+        level = 0
+        while level + 1 < levels and size / float(1 << (level + 1)) >= out_size:
+            level = level + 1
+        return level
+
+    @staticmethod
+    def level_corners(corners, level):
+        """
+        Return the corners in the image of the given level
+        """
+        return [(int(round(x / float(1 << level))), int(round(y / float(1 << level)))) for x, y in corners]
+
+    @staticmethod
+    def render_tile(tile, images, corners):
+        """
+        Extract the tile from the big png image levels
+        """
+        def produce_tile_file():
+            level = SentinelTileProducer.select_level(corners, len(images))
+            top_left, top_rigth, bottom_left, bottom_right = SentinelTileProducer.level_corners(corners, level)
+            with atomic_path(tile.file_path) as temporary_path:
+                extract_tile_from_image(images[level], top_left, top_rigth,
+                                        bottom_left, bottom_right, temporary_path)
+
+        return produce_once(tile.file_path, produce_tile_file)
+
+    @staticmethod
+    def render_memory(tile, renders):
+        """
+        Return the estimated peak memory of rendering the tiles from the scene,
+        the png decoded in memory and the biggest extracted region. Mapped arrays stay in the page cache
+        """
+        levels = SentinelTileProducer.scene_levels(tile)
+        memory = 0
+        for corners in renders.values():
+            level = SentinelTileProducer.select_level(corners, levels)
+            memory = max(memory, extract_memory(*SentinelTileProducer.level_corners(corners, level)))
+        if not (MEMMAP_SCENES and os.path.isfile(tile.scene_array_path(0))):
+            memory = memory + image_memory(tile.big_png_path())
+        return memory
+
+    @staticmethod
+    def render_band_math_tile(tile):
+        """
+        Render the tile from its band expression, only the tile windows of the bands are read
+        """
+        expression, value_range, colormap = tile.band_math
+        # prefetched tiles come without the bands found by the image producer, the bands are in the cache
+        if tile.bands_path is None and not SentinelImageProducer.find_bands(tile):
+            return False
+
+        def produce_tile_file():
+            with MEMORY_BUDGET.reserve(band_math_memory(len(expression.bands)), "band_math"):
+                with atomic_path(tile.file_path) as temporary_path:
+                    create_tile_from_expression(tile.bands_path, expression, value_range, colormap,
+                                                mercator_bbox_from_xyz(tile.tms_x, tile.tms_y, tile.tms_z),
+                                                temporary_path)
+
+        return produce_once(tile.file_path, produce_tile_file)
+
+    @staticmethod
+    def render_mosaic_tile(tile):
+        """
+        Render the tile from the raster windows of its scenes, no merged scene is written
+        """
+        def produce_tile_file():
+            with MEMORY_BUDGET.reserve(mosaic_memory(), "mosaic"):
+                with atomic_path(tile.file_path) as temporary_path:
+                    create_mosaic_tile([scene.raster_path() for scene in tile.mosaic],
+                                       mercator_bbox_from_xyz(tile.tms_x, tile.tms_y, tile.tms_z), temporary_path,
+                                       tile.first_clip, tile.second_clip, tile.third_clip)
+
+        return produce_once(tile.file_path, produce_tile_file)
+
+    @staticmethod
+    def build_tile_from_children(tile):
+        """
+        Build the tile by downsampling its children
+        """
+        def produce_tile_file():
+            with atomic_path(tile.file_path) as temporary_path:
+                create_tile_from_children([child.file_path for child in tile.children], temporary_path)
+
+        return produce_once(tile.file_path, produce_tile_file)
+
+    def produce_tile(self, tile):
+        """
+        Extract the tile from the big png image,
+        or build it from its children, rendering only the missing children,
+        or render it from its band expression or from the rasters of its mosaic
+        """
+        file_path = tile.file_path
+        if tile.band_math is not None:
+            SentinelTileProducer.render_band_math_tile(tile)
+        elif tile.mosaic is not None:
+            SentinelTileProducer.render_mosaic_tile(tile)
+        elif not os.path.isfile(file_path):
+            if not tile.children_cached():
+                if not os.path.isfile(tile.raster_path()) or not os.path.isfile(tile.big_png_path()):
+                    SentinelTileProducer.tile_failed(tile, "tile", "scene image not found")
+                    return
+
+                if not tile.children:
+                    renders = OrderedDict([(tile, SentinelTileProducer.tile_corners(tile))])
+                else:
+                    renders = OrderedDict((child, SentinelTileProducer.tile_corners(child))
+                                          for child in tile.children if not os.path.isfile(child.file_path))
+                with MEMORY_BUDGET.reserve(SentinelTileProducer.render_memory(tile, renders), "extract_tile"):
+                    images = SentinelTileProducer.scene_images(tile)
+                    for render, corners in renders.items():
+                        if SentinelTileProducer.render_tile(render, images, corners) and render is not tile:
+                            SentinelTileProducer.tile_done.notify(render.file_path)
+                    del images
+
+            if tile.children_cached():
+                SentinelTileProducer.build_tile_from_children(tile)
+        if os.path.isfile(file_path):
+            SentinelTileProducer.tile_done.notify(file_path)
+        else:
+            SentinelTileProducer.tile_failed(tile, "tile", "tile not produced")
 
     def run(self):
         """
         Get tiles requests from the queue and treat it
         """
         while True:
+            priority, _, tile = SentinelTileProducer.tile_to_product.get()
             try:
-                tile = SentinelTileProducer.tile_to_product.get()
-                zone_name = tile.zone_name
-                found_date = tile.found_date
-                bbox = tile.bbox
-                file_path = tile.file_path
-                tile_bands = tile.bands
-                first_clip = tile.first_clip
-                second_clip = tile.second_clip
-                third_clip = tile.third_clip
-
-                if not os.path.isfile(file_path):
-                    tiff_name = zone_name + "_" + \
-                        str(found_date.year) + "_" + \
-                        str(found_date.month) + "_" + str(found_date.day) + \
-                        "_"+str(tile_bands[0])+"_"+str(tile_bands[1])+"_"+str(tile_bands[2])
-                    tiff_path = os.path.join(tempfile.gettempdir(), tiff_name)
-
-                    if not os.path.isfile(tiff_path):
-                        continue
-
-                    big_png_name = zone_name + "_" + \
-                        str(found_date.year) + "_" + str(found_date.month) + \
-                        "_" + str(found_date.day) + \
-                        "_"+str(tile_bands[0])+"_"+str(tile_bands[1])+"_"+str(tile_bands[2])+ \
-                        "_"+str(first_clip[0])+"_"+str(first_clip[1])+ \
-                        "_"+str(second_clip[0])+"_"+str(second_clip[1])+ \
-                        "_"+str(third_clip[0])+"_"+str(third_clip[1])+ \
-                        ".png"
-                    big_png_path = os.path.join(
-                        tempfile.gettempdir(), big_png_name)
-                    if not os.path.isfile(big_png_path):
-                        continue
-
-                    top_left = get_x_y_for_lon_lat(
-                        tiff_path, bbox[0][0], bbox[0][1])
-                    top_rigth = get_x_y_for_lon_lat(
-                        tiff_path, bbox[0][0], bbox[1][1])
-                    bottom_left = get_x_y_for_lon_lat(
-                        tiff_path, bbox[1][0], bbox[0][1])
-                    bottom_right = get_x_y_for_lon_lat(
-                        tiff_path, bbox[1][0], bbox[1][1])
-                    extract_tile(big_png_path, top_left, top_rigth,
-                                bottom_left, bottom_right, file_path)
+                prefetcher = SentinelTileProducer.prefetcher
+                if priority == PREFETCH_PRIORITY:
+                    # real requests are waiting for their scene image, give them the CPU
+                    dropped = SentinelImageProducer.tile_to_product.qsize() > 0
+                    try:
+                        if not dropped:
+                            with PRODUCER_IN_FLIGHT.track_in_progress(producer="prefetch"):
+                                self.produce_tile(tile)
+                    finally:
+                        prefetcher.done(tile, dropped)
+                    continue
+                if tile.trace is not None:
+                    tile.trace.dequeued("tile")
+                with PRODUCER_IN_FLIGHT.track_in_progress(producer="tile"), span(tile.trace, "tile", profiled=True):
+                    self.produce_tile(tile)
+                if prefetcher is not None and os.path.isfile(tile.file_path):
+                    prefetcher.schedule(tile)
             except Exception as err:
-                LOGGER.error("Something wrong happen during tile generation, maybe you should try to develop real code")
+                LOGGER.exception("Something wrong happen during tile generation of %s, trace %s",
+                                 tile.file_path, tile.trace_id())
+                SentinelTileProducer.tile_failed(tile, "tile", err)
+
 
+REGISTRY.gauge("wtmse_image_queue_depth", "Tiles waiting for the image producer",
+               function=SentinelImageProducer.tile_to_product.qsize)
+REGISTRY.gauge("wtmse_tile_queue_depth", "Tiles waiting for the tile producers",
+               function=SentinelTileProducer.tile_to_product.qsize)
@@ -0,0 +1,230 @@
+"""
+Sentinel tile seeder, pre-render tiles in the cache used by the sentinel tile generator
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shapely.geometry import box
+from utils.tms_helper import bbox_from_xyz, tiles_in_bbox
+from utils.exception import DataCannotBeComputed, DataNotYetReady
+from .utils.sentinel_downloader import find_zone, find_zone_by_name
+from .sentinel_tile_generator import ZONES_FEATURES, MIN_ZOOM, MAX_ZOOM, zones_under_tile
+
+
+LOGGER = logging.getLogger("wtmse")
+
+
+class SeedTask:
+    """
+    SeedTask class, represent a tile to pre-render, from the scene of one zone
+    or mosaicked from the scenes of several zones
+    """
+    def __init__(self, zone_names, date_requested, tms_x, tms_y, tms_z, latest_dates=None):
+        self.zone_names = tuple(zone_names)
+        self.date_requested = date_requested
+        self.tms_x = tms_x
+        self.tms_y = tms_y
+        self.tms_z = tms_z
+        # dates of the last images of the zones, the tile of the last image changes with them
+        self.latest_dates = latest_dates
+
+    def is_mosaic(self):
+        """
+        Return True if the tile is mosaicked from several zones
+        """
+        return len(self.zone_names) > 1
+
+    def scene(self):
+        """
+        Return the scene key, tiles of the same scene share the same big raster
+        """
+        return (self.zone_names, self.date_requested)
+
+    def key(self):
+        """
+        Return the key stored in the resume state file, the last image is keyed by its actual dates
+        """
+        if self.date_requested is not None:
+            date_string = self.date_requested.strftime('%Y%m%d')
+        else:
+            date_string = "latest_" + "_".join(latest_date.strftime('%Y%m%d') for latest_date in self.latest_dates)
+        return "{}/{}/{}/{}/{}".format("+".join(self.zone_names), date_string, self.tms_z, self.tms_x, self.tms_y)
+
+
+def zones_for_tile(tms_x, tms_y, tms_z):
+    """
+    Return the names of the zones which will be used to generate the tile as the generator does,
+    one zone or the zones of a mosaic, an empty list if the tile cannot be computed by the generator
+    """
+    bbox = bbox_from_xyz(tms_x, tms_y, tms_z)
+    zone_top = find_zone(ZONES_FEATURES, bbox[0][0], bbox[0][1])
+    zone_bottom = find_zone(ZONES_FEATURES, bbox[1][0], bbox[1][1])
+    if zone_top is None or zone_bottom is None:
+        return []
+    if zone_top.name == zone_bottom.name:
+        return [zone_top.name]
+    return zones_under_tile(bbox)
+
+
+def plan_tiles(min_zoom, max_zoom, zone_names=None, bbox=None, geometry=None):
+    """
+    Plan the tiles to seed, group them by zones: the tiles straddling several zones
+    are grouped by the zones of their mosaic
+    :param zone_names: list of zone names to seed entirely
+    :param bbox: (lon_min, lat_min, lon_max, lat_max) to seed
+    :param geometry: shapely geometry to seed
+    :return OrderedDict tuple of zone names -> list of (tms_x, tms_y, tms_z)
+    """
+    if min_zoom < MIN_ZOOM or max_zoom > MAX_ZOOM or min_zoom > max_zoom:
+        raise DataCannotBeComputed("Zoom shall be between {} and {}".format(MIN_ZOOM, MAX_ZOOM))
+
+    areas = []
+    for zone_name in zone_names or []:
+        zone = find_zone_by_name(ZONES_FEATURES, zone_name)
+        if zone is None:
+            LOGGER.error("Impossible to find zone %s", zone_name)
+            continue
+        areas.append((zone.geometry.bounds, None, zone_name))
+    if bbox is not None:
+        areas.append((bbox, None, None))
+    if geometry is not None:
+        areas.append((geometry.bounds, geometry, None))
+
+    planned = OrderedDict()
+    seen = set()
+    for bounds, area_geometry, requested_zone in areas:
+        for tms_z in range(min_zoom, max_zoom + 1):
+            for tms_x, tms_y in tiles_in_bbox(bounds[0], bounds[1], bounds[2], bounds[3], tms_z):
+                if (tms_x, tms_y, tms_z) in seen:
+                    continue
+                tile_bbox = bbox_from_xyz(tms_x, tms_y, tms_z)
+                if area_geometry is not None and \
+                        not area_geometry.intersects(box(tile_bbox[0][0], tile_bbox[0][1], tile_bbox[1][0], tile_bbox[1][1])):
+                    continue
+                tile_zones = zones_for_tile(tms_x, tms_y, tms_z)
+                if not tile_zones:
+                    continue
+                # the tiles of a zone border are part of the zone
+                if requested_zone is not None and requested_zone not in tile_zones:
+                    continue
+                seen.add((tms_x, tms_y, tms_z))
+                planned.setdefault(tuple(tile_zones), []).append((tms_x, tms_y, tms_z))
+    return planned
+
+
+def build_tasks(planned, dates=None, latest_date=None):
+    """
+    Build the seed tasks from the planned tiles
+    :param dates: dict zone_name -> list of dates, None to seed the last image of each zone,
+    a mosaic is seeded at the dates of all its zones
+    :param latest_date: function returning the date of the last image of a zone, to seed the last image
+    """
+    tasks = []
+    for zone_names, tiles in planned.items():
+        latest_dates = None
+        if dates is None:
+            zone_dates = [None]
+            try:
+                latest_dates = tuple(latest_date(zone_name) for zone_name in zone_names)
+            except DataCannotBeComputed as err:
+                LOGGER.error("Impossible to find the last image of zones %s: %s", ",".join(zone_names), err)
+                continue
+        else:
+            zone_dates = [zone_date for zone_date in dates.get(zone_names[0], [])
+                          if all(zone_date in dates.get(zone_name, []) for zone_name in zone_names[1:])]
+        for date_requested in zone_dates:
+            for tms_x, tms_y, tms_z in tiles:
+                tasks.append(SeedTask(zone_names, date_requested, tms_x, tms_y, tms_z, latest_dates))
+    return tasks
+
+
+class SentinelTileSeeder:
+    """
+    Sentinel tile seeder, render planned tiles with a pool of workers,
+    done tiles are written in a state file to resume after interruption
+    """
+
+    def __init__(self, generator, arguments, workers=4, retries=3, state_file=None):
+        """
+        init
+        """
+        self.generator = generator
+        self.arguments = arguments
+        self.workers = workers
+        self.retries = retries
+        self.state_file = state_file
+        self.__state_lock = threading.Lock()
+
+    def __load_state(self):
+        """
+        Return the keys of the tiles already seeded
+        """
+        if self.state_file is None or not os.path.isfile(self.state_file):
+            return set()
+        with open(self.state_file, 'r') as state:
+            return set(line.strip() for line in state if line.strip())
+
+    def __save_state(self, task):
+        """
+        Append a seeded tile in the state file
+        """
+        if self.state_file is None:
+            return
+        with self.__state_lock:
+            with open(self.state_file, 'a') as state:
+                state.write(task.key() + "\n")
+
+    def seed_tile(self, task):
+        """
+        Render one tile, retry while the data is not yet ready
+        """
+        arguments = dict(self.arguments)
+        # a mosaic is requested without zone, as the server requests it
+        if not task.is_mosaic():
+            arguments['zone'] = task.zone_names[0]
+        if task.date_requested is not None:
+            arguments['date'] = task.date_requested.strftime('%Y%m%d')
+        for _ in range(self.retries + 1):
+            try:
+                self.generator.generate_tile(task.tms_x, task.tms_y, task.tms_z, arguments)
+                self.__save_state(task)
+                return True
+            except DataNotYetReady:
+                LOGGER.debug("Tile %s not yet ready, retry", task.key())
+            except DataCannotBeComputed as err:
+                LOGGER.error("Tile %s cannot be computed: %s", task.key(), err)
+                return False
+        LOGGER.error("Tile %s not ready after %s retries", task.key(), self.retries)
+        return False
+
+    def run(self, tasks):
+        """
+        Seed the tasks, scene after scene
+        :return (seeded, failed) tiles count
+        """
+        done = self.__load_state()
+        scenes = OrderedDict()
+        for task in tasks:
+            if task.key() not in done:
+                scenes.setdefault(task.scene(), []).append(task)
+
+        total = sum(len(scene_tasks) for scene_tasks in scenes.values())
+        LOGGER.info("Seed %s tiles in %s scenes, %s already done", total, len(scenes), len(tasks) - total)
+        seeded = 0
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for (zone_names, date_requested), scene_tasks in scenes.items():
+                LOGGER.info("Seed scene %s %s: %s tiles", ",".join(zone_names), date_requested or "latest", len(scene_tasks))
+                # deepest level first, lower levels are built from their cached children in pyramid mode
+                for tms_z in sorted(set(task.tms_z for task in scene_tasks), reverse=True):
+                    futures = [executor.submit(self.seed_tile, task) for task in scene_tasks if task.tms_z == tms_z]
+                    for future in as_completed(futures):
+                        if future.result():
+                            seeded = seeded + 1
+                        else:
+                            failed = failed + 1
+                        LOGGER.info("Progress %s/%s tiles, %s failed", seeded + failed, total, failed)
+        return seeded, failed
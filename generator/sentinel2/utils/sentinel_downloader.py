@@ -11,7 +11,6 @@ import numpy as np
 from fastkml import kml
 from shapely.geometry import Point, Polygon
 
-logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger("sentinel-downloader")
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 GRANULE_KML_FILE = os.path.join(DIR_PATH, 'data', 'S2A_OPER.kml')
@@ -70,6 +69,18 @@ def find_zone(zones_features, longitude, latitude):
     return None
 
 
+def find_zone_by_name(zones_features, zone_name):
+    """
+    Find zone for its name
+    """
+    for zones_x in zones_features.values():
+        for zones_y in zones_x.values():
+            for zone in zones_y:
+                if zone.name == zone_name:
+                    return zone
+    return None
+
+
 def get_url_for_zone(zone_name):
     """
     Return url for th given zone
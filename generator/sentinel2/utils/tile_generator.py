@@ -1,17 +1,39 @@
 
 import os
 import logging
-import tempfile
-import scipy.misc
 import numpy as np
+from PIL import Image
 from skimage.transform import resize, rotate
 from math import atan, degrees, tan , floor, fabs
 from osgeo import gdal, osr, ogr
+from utils.metrics import timed
+from utils.band_math import apply_colormap
+from utils.composite import composite_block, composite_memory, COMPOSITE_BLOCK_ROWS
+from utils.blob_store import BlobStore, BLOB_STORE
 
-logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger("tile-generator")
-
-
+PNG_COMPRESS_LEVEL = int(os.getenv('WTMSE_PNG_COMPRESS_LEVEL', 3))
+JPEG_QUALITY = int(os.getenv('WTMSE_JPEG_QUALITY', 85))
+WEBP_QUALITY = int(os.getenv('WTMSE_WEBP_QUALITY', 80))
+WEBP_METHOD = int(os.getenv('WTMSE_WEBP_METHOD', 2))
+# peak bytes by pixel of the scene operations, from the arrays they hold at once
+# band stack: the band array and its copy in the GDAL write cache
+BAND_STACK_COPIES = 2
+# stretch: two clipped int64 bands kept while the third one is read (uint16), copied, clipped, shifted,
+# scaled (float32) and converted (int64)
+STRETCH_BYTES_BY_PIXEL = 2 * 8 + (2 + 2 + 2 + 2 + 4 + 8)
+# extract: the uint8 rgb region, its float64 conversion and its float64 rotation, larger than the region
+EXTRACT_BYTES_BY_PIXEL = 3 + 3 * 8 + int(3 * 8 * 1.5)
+# band math: the float32 band windows, the warp buffer and the expression temporaries
+BAND_MATH_BYTES_BY_PIXEL = 4 * 4
+# mosaic: the warped uint16 bands, one band in float32 and the rgb tile
+MOSAIC_BYTES_BY_PIXEL = 3 * 2 + 4 + 3
+# sentinel 2 L1C bands nodata value
+BAND_NODATA = 0
+TILE_BLOBS = BlobStore()
+
+
+@timed("band_stack")
 def create_raster_from_band(red, green, blue, output_file):
     """
     Create a big raster from given bands
@@ -45,6 +67,52 @@ def create_raster_from_band(red, green, blue, output_file):
     LOGGER.debug("Big raster is write in output_file : %s", output_file)
 
 
+def composite_raster_memory(band_file, dates_count, rows_by_block=COMPOSITE_BLOCK_ROWS):
+    """
+    Return the estimated peak memory of create_composite_raster
+    """
+    band_ds = gdal.Open(band_file)
+    columns = band_ds.RasterXSize
+    del band_ds
+    return composite_memory(dates_count, columns, rows_by_block)
+
+
+@timed("composite")
+def create_composite_raster(bands_by_date, output_file, percentile=50., rows_by_block=COMPOSITE_BLOCK_ROWS):
+    """
+    Create a big raster where each pixel is the percentile of the pixel over the dates, nodata excluded.
+    bands_by_date is the list of the (red, green, blue) band files of each date, the bands are processed
+    by blocks of rows: the memory depends on the number of dates and the width of the scene only
+    """
+    LOGGER.debug("Create composite raster of %s dates in output_file : %s", len(bands_by_date), output_file)
+    first_ds = gdal.Open(bands_by_date[0][0])
+    nx = first_ds.RasterXSize
+    ny = first_ds.RasterYSize
+
+    dst_ds = gdal.GetDriverByName('GTiff').Create(
+        output_file, nx, ny, 3, gdal.GDT_UInt16)
+
+    dst_ds.SetGeoTransform(first_ds.GetGeoTransform())
+    dst_ds.SetProjection(first_ds.GetProjection())
+    del first_ds
+
+    for index_band in range(3):
+        LOGGER.debug("Composite band : %s", index_band + 1)
+        dates_ds = [gdal.Open(bands[index_band]) for bands in bands_by_date]
+        for y_start in range(0, ny, rows_by_block):
+            rows = min(rows_by_block, ny - y_start)
+            stack = np.stack([date_ds.GetRasterBand(1).ReadAsArray(0, y_start, nx, rows) for date_ds in dates_ds])
+            block = composite_block(stack, percentile, BAND_NODATA)
+            dst_ds.GetRasterBand(index_band + 1).WriteArray(np.round(block).astype(np.uint16), 0, y_start)
+        del dates_ds
+
+    dst_ds.FlushCache()
+
+    dst_ds = None
+    LOGGER.debug("Composite raster is write in output_file : %s", output_file)
+
+
+@timed("stretch")
 def create_png_from_raster(raster_file, output_file, blue_clip=(0., 2500.), red_clip=(0., 2500.), green_clip=(0., 2500.)):
     """
     Create a big png from the given raster,
@@ -92,13 +160,132 @@ def create_png_from_raster(raster_file, output_file, blue_clip=(0., 2500.), red_
     rgb[..., 1] = green_array
     rgb[..., 2] = blue_array
     LOGGER.debug("Writing png file in %s", output_file)
-    generate_name = tempfile.NamedTemporaryFile().name + ".png"
-    scipy.misc.imsave(generate_name, rgb)
-    os.rename(generate_name, output_file)
+    Image.fromarray(rgb, 'RGB').save(output_file)
     LOGGER.debug("File writed %s", output_file)
     return True
 
 
+def band_stack_memory(band_file):
+    """
+    Return the estimated peak memory of create_raster_from_band
+    """
+    band_ds = gdal.Open(band_file)
+    band = band_ds.GetRasterBand(1)
+    size = band.XSize * band.YSize * (gdal.GetDataTypeSize(band.DataType) // 8) * BAND_STACK_COPIES
+    del band_ds
+    return size
+
+
+def stretch_memory(raster_file):
+    """
+    Return the estimated peak memory of create_png_from_raster
+    """
+    raster_ds = gdal.Open(raster_file)
+    size = raster_ds.RasterXSize * raster_ds.RasterYSize * STRETCH_BYTES_BY_PIXEL
+    del raster_ds
+    return size
+
+
+def image_memory(img_path):
+    """
+    Return the memory of the image decoded by read_image, the size is read from the header
+    """
+    with Image.open(img_path) as image:
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+
+def overviews_memory(img_path, rows_by_block=1024):
+    """
+    Return the estimated peak memory of the image and its overviews built by downsample_image
+    """
+    with Image.open(img_path) as image:
+        size_on_x, size_on_y = image.size
+        channels = len(image.getbands())
+    # the overviews add a third of the image, the float32 block is two rows by block of the image
+    return size_on_x * size_on_y * channels * 4 // 3 + 2 * rows_by_block * size_on_x * channels * 4
+
+
+def extract_memory(top_left, top_right, bottom_left, bottom_right):
+    """
+    Return the estimated peak memory of extract_tile_from_image for the region of the corners
+    """
+    size_on_x = max(top_left[0], top_right[0], bottom_left[0], bottom_right[0]) - \
+        min(top_left[0], top_right[0], bottom_left[0], bottom_right[0])
+    size_on_y = max(top_left[1], top_right[1], bottom_left[1], bottom_right[1]) - \
+        min(top_left[1], top_right[1], bottom_left[1], bottom_right[1])
+    return size_on_x * size_on_y * EXTRACT_BYTES_BY_PIXEL
+
+
+def band_math_memory(bands_count, x_out_size=512, y_out_size=512):
+    """
+    Return the estimated peak memory of create_tile_from_expression
+    """
+    return (bands_count + 1) * x_out_size * y_out_size * BAND_MATH_BYTES_BY_PIXEL
+
+
+def read_band_window(band_file, mercator_bbox, x_out_size=512, y_out_size=512):
+    """
+    Read the band on the tile bbox in web mercator as float32, nodata are nan.
+    Only the source window of the tile is read, from the band overviews when the tile is at a lower resolution
+    """
+    tile_ds = gdal.Warp('', band_file, format='MEM', dstSRS='EPSG:3857',
+                        outputBounds=(mercator_bbox[0][0], mercator_bbox[0][1], mercator_bbox[1][0], mercator_bbox[1][1]),
+                        width=x_out_size, height=y_out_size, resampleAlg='bilinear',
+                        srcNodata=BAND_NODATA, dstNodata=BAND_NODATA, outputType=gdal.GDT_Float32)
+    if tile_ds is None:
+        raise IOError("Impossible to read the window of band {}".format(band_file))
+    array = tile_ds.GetRasterBand(1).ReadAsArray()
+    del tile_ds
+    array[array == BAND_NODATA] = np.nan
+    return array
+
+
+@timed("band_math")
+def create_tile_from_expression(band_files, expression, value_range, colormap, mercator_bbox, out_path,
+                                x_out_size=512, y_out_size=512):
+    """
+    Create a tile from a band expression evaluated on the tile windows of the bands, coloured by the colormap
+    """
+    LOGGER.debug("Create tile %s from expression %s", out_path, expression.expression)
+    arrays = dict((band, read_band_window(band_files[band], mercator_bbox, x_out_size, y_out_size))
+                  for band in expression.bands)
+    encode_tile(apply_colormap(expression.evaluate(arrays), value_range, colormap), out_path)
+    return True
+
+
+def mosaic_memory(x_out_size=512, y_out_size=512):
+    """
+    Return the estimated peak memory of create_mosaic_tile
+    """
+    return x_out_size * y_out_size * MOSAIC_BYTES_BY_PIXEL
+
+
+@timed("mosaic")
+def create_mosaic_tile(raster_files, mercator_bbox, out_path, blue_clip=(0., 2500.), red_clip=(0., 2500.),
+                       green_clip=(0., 2500.), x_out_size=512, y_out_size=512):
+    """
+    Create a tile from the rasters of several zones warped in memory to the tile bbox in web mercator,
+    only the tile window of each raster is read. The first raster wins where the zones overlap,
+    the next ones fill its nodata. The bands are clipped as create_png_from_raster
+    """
+    LOGGER.debug("Create mosaic tile %s from %s", out_path, raster_files)
+    # the sources are warped in order, the winner is written last over the others
+    tile_ds = gdal.Warp('', list(reversed(raster_files)), format='MEM', dstSRS='EPSG:3857',
+                        outputBounds=(mercator_bbox[0][0], mercator_bbox[0][1], mercator_bbox[1][0], mercator_bbox[1][1]),
+                        width=x_out_size, height=y_out_size, resampleAlg='bilinear',
+                        srcNodata=BAND_NODATA, dstNodata=BAND_NODATA)
+    if tile_ds is None:
+        raise IOError("Impossible to warp the rasters {}".format(raster_files))
+    rgb = np.zeros((y_out_size, x_out_size, 3), dtype=np.uint8)
+    for band_index, clip in ((1, red_clip), (2, green_clip), (3, blue_clip)):
+        array = np.clip(tile_ds.GetRasterBand(band_index).ReadAsArray(), clip[0], clip[1])
+        rgb[..., band_index - 1] = ((np.float32(array) - clip[0]) * 255. / (clip[1] - clip[0])).astype(np.uint8)
+    del tile_ds
+    encode_tile(rgb, out_path)
+    return True
+
+
+@timed("corner_projection")
 def get_x_y_for_lon_lat(raster_file, lon, lat):
     """
     Get x, y in the raster for the given lon lat
@@ -148,12 +335,65 @@ def get_x_y_for_lon_lat(raster_file, lon, lat):
 
     return (int(point_x), int(point_y))
 
+@timed("read_image")
+def read_image(img_path):
+    """
+    Read the big png image
+    """
+    LOGGER.debug("Image path : %s", img_path)
+    with Image.open(img_path) as image:
+        return np.array(image)
+
+
+@timed("map_image")
+def map_raw_array(array_path):
+    """
+    Map a raw array written by write_raw_array, the data is read from the page cache without decoding
+    and shared between the threads and processes mapping the same file
+    """
+    return np.load(array_path, mmap_mode='r')
+
+
+def write_raw_array(array, array_path):
+    """
+    Write an array as a raw .npy file which can be memory mapped
+    """
+    output = np.lib.format.open_memmap(array_path, mode='w+', dtype=array.dtype, shape=array.shape)
+    output[...] = array
+    output.flush()
+    del output
+
+
+def downsample_image(img, rows_by_block=1024):
+    """
+    Return the image downsampled by two, each pixel is the mean of a 2x2 block,
+    the image is processed by blocks of rows to bound the memory used
+    """
+    size_on_y = len(img) // 2
+    size_on_x = len(img[0]) // 2
+    overview = np.zeros((size_on_y, size_on_x, img.shape[2]), dtype=img.dtype)
+    for y_start in range(0, size_on_y, rows_by_block):
+        y_end = min(size_on_y, y_start + rows_by_block)
+        block = np.asarray(img[2 * y_start:2 * y_end, :2 * size_on_x, :], dtype=np.float32)
+        block = block.reshape(y_end - y_start, 2, size_on_x, 2, img.shape[2]).mean(axis=(1, 3))
+        overview[y_start:y_end] = np.round(block).astype(img.dtype)
+    return overview
+
+
 def extract_tile(img_path, top_left, top_right, bottom_left, bottom_right, out_path, x_out_size = 512, y_out_size = 512):
     """
     Extract tile from the image
     """
+    return extract_tile_from_image(read_image(img_path), top_left, top_right, bottom_left, bottom_right,
+                                   out_path, x_out_size, y_out_size)
 
 
+@timed("extract_tile")
+def extract_tile_from_image(img, top_left, top_right, bottom_left, bottom_right, out_path, x_out_size = 512, y_out_size = 512):
+    """
+    Extract tile from the image already read, the image can be shared by several tiles
+    """
+
     LOGGER.debug("Top left     : %s", top_left)
     LOGGER.debug("Top right    : %s", top_right)
     LOGGER.debug("Bottom Left  : %s", bottom_left)
@@ -177,14 +417,11 @@ def extract_tile(img_path, top_left, top_right, bottom_left, bottom_right, out_p
     x_clip  = int((x_max - x_min)*tan(rotation_angle_tan))
 
     LOGGER.debug("Extract tile")
-    LOGGER.debug("Image path : %s", img_path)
     LOGGER.debug("Extract data from table")
     LOGGER.debug("Min x : %s", x_min)
     LOGGER.debug("Max x : %s", x_max)
     LOGGER.debug("Min y : %s", y_min)
     LOGGER.debug("Max y : %s", y_max)
-    img = scipy.misc.imread(img_path)
-
 
     y_min = max(0, min(y_min, len(img)))
     y_max = max(0, min(y_max, len(img)))
@@ -237,9 +474,60 @@ def extract_tile(img_path, top_left, top_right, bottom_left, bottom_right, out_p
     rgb_cliped = transformed_img[y_clip:y_max_cliped, x_clip:x_max_cliped, :]
     LOGGER.debug("Size on y after clip: %s", len(rgb_cliped))
     LOGGER.debug("Size on x after clip: %s", len(rgb_cliped[0]))
-    scipy.misc.imsave(out_path, resize(rgb_cliped, (x_out_size,y_out_size)))
+    tile = resize(rgb_cliped, (x_out_size,y_out_size))
+    encode_tile(np.clip(np.round(tile * 255.), 0, 255).astype(np.uint8), out_path)
+    return True
+
+@timed("encode")
+def encode_tile(tile, out_path):
+    """
+    Encode an uint8 RGB tile without rescaling, the format is given by the file extension:
+    png (WTMSE_PNG_COMPRESS_LEVEL), jpg (WTMSE_JPEG_QUALITY) or webp (WTMSE_WEBP_QUALITY, WTMSE_WEBP_METHOD).
+    With the blob store, a tile of one colour (nodata, sea, cloud) is encoded once and linked by the tiles of that colour
+    """
+    extension = os.path.splitext(out_path)[1].lower()
+    if extension in ('.jpg', '.jpeg'):
+        save_format, save_options = 'JPEG', {'quality': JPEG_QUALITY}
+    elif extension == '.webp':
+        save_format, save_options = 'WEBP', {'quality': WEBP_QUALITY, 'method': WEBP_METHOD}
+    else:
+        save_format, save_options = 'PNG', {'compress_level': PNG_COMPRESS_LEVEL}
+
+    uniform_key = None
+    if BLOB_STORE and (tile == tile[0, 0]).all():
+        uniform_key = "uniform_" + "".join("%02x" % value for value in tile[0, 0]) + \
+            "_" + str(tile.shape[1]) + "x" + str(tile.shape[0]) + \
+            "".join("_" + str(save_options[name]) for name in sorted(save_options)) + extension
+        if TILE_BLOBS.get(uniform_key, out_path):
+            return
+    Image.fromarray(tile, 'RGB').save(out_path, save_format, **save_options)
+    if uniform_key is not None:
+        TILE_BLOBS.put(out_path, uniform_key)
+
+
+@timed("pyramid")
+def create_tile_from_children(children_paths, out_path, x_out_size = 512, y_out_size = 512):
+    """
+    Create a tile from its four children tiles of the next zoom level,
+    children are given in the order top left, top right, bottom left, bottom right
+    """
+    LOGGER.debug("Create tile %s from children %s", out_path, children_paths)
+    children = []
+    for child_path in children_paths:
+        with Image.open(child_path) as child:
+            children.append(np.array(child.convert('RGB')))
+    mosaic = np.concatenate([np.concatenate(children[0:2], axis=1),
+                             np.concatenate(children[2:4], axis=1)], axis=0)
+    size_on_y = len(mosaic) // 2 * 2
+    size_on_x = len(mosaic[0]) // 2 * 2
+    mosaic = mosaic[:size_on_y, :size_on_x, :].astype(np.float32)
+    tile = mosaic.reshape(size_on_y // 2, 2, size_on_x // 2, 2, 3).mean(axis=(1, 3))
+    if tile.shape[0] != y_out_size or tile.shape[1] != x_out_size:
+        tile = resize(tile, (y_out_size, x_out_size), preserve_range=True)
+    encode_tile(np.round(tile).astype(np.uint8), out_path)
     return True
 
+
 def main():
     Topleft=(8514, 6139)
     Topright=(8499, 5780)
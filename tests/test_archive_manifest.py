@@ -0,0 +1,55 @@
+import os
+from utils.archive_manifest import ArchiveManifest, parse_band_file
+
+
+def write_band(directory, name):
+    os.makedirs(str(directory), exist_ok=True)
+    path = os.path.join(str(directory), name)
+    with open(path, 'wb') as band_file:
+        band_file.write(b'jp2')
+    return path
+
+
+def test_parse_band_file():
+    assert parse_band_file("T31TCJ_20181120T105329_B04.jp2") == ("31TCJ", "20181120", 4, 10)
+    assert parse_band_file("T31TCJ_20181120T105329_B04_20m.jp2") == ("31TCJ", "20181120", 4, 20)
+    assert parse_band_file("31TCJ_2018_11_2_B03") == ("31TCJ", "20181102", 3, 10)
+    assert parse_band_file("T31TCJ_20181120T105329_TCI.jp2") is None
+
+
+def test_manifest_index_the_finest_bands(tmp_path):
+    img_data = tmp_path / "archive" / "S2A_MSIL2A_20181120.SAFE" / "GRANULE" / "L2A_T31TCJ" / "IMG_DATA"
+    band_10m = write_band(img_data / "R10m", "T31TCJ_20181120T105329_B04_10m.jp2")
+    write_band(img_data / "R20m", "T31TCJ_20181120T105329_B04_20m.jp2")
+    write_band(tmp_path / "archive", "31TCJ_2018_11_22_B04")
+    manifest = ArchiveManifest(str(tmp_path / "archive"), str(tmp_path / "manifest.json"))
+    assert manifest.refresh()
+    assert manifest.bands("31TCJ", "20181120") == {4: band_10m}
+    assert manifest.latest_date("31TCJ") == "20181122"
+    assert manifest.dates("31TCJ") == ["20181120", "20181122"]
+    assert manifest.latest_date("31TCK") is None
+
+
+def test_manifest_is_persisted_and_refreshed(tmp_path):
+    archive = tmp_path / "archive"
+    write_band(archive / "a", "31TCJ_2018_11_20_B04")
+    manifest = ArchiveManifest(str(archive), str(tmp_path / "manifest.json"))
+    manifest.refresh()
+    manifest.save()
+    loaded = ArchiveManifest(str(archive), str(tmp_path / "manifest.json"))
+    assert loaded.load()
+    assert loaded.latest_date("31TCJ") == "20181120"
+    assert not loaded.refresh()
+    write_band(archive / "b", "31TCJ_2018_11_25_B04")
+    assert loaded.refresh()
+    assert loaded.latest_date("31TCJ") == "20181125"
+    assert not ArchiveManifest(str(tmp_path), str(tmp_path / "manifest.json")).load()
+
+
+def test_manifest_skips_link_loops(tmp_path):
+    archive = tmp_path / "archive"
+    write_band(archive / "a", "31TCJ_2018_11_20_B04")
+    os.symlink(str(archive), str(archive / "a" / "loop"))
+    manifest = ArchiveManifest(str(archive), str(tmp_path / "manifest.json"))
+    assert manifest.refresh()
+    assert manifest.dates("31TCJ") == ["20181120"]
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from utils.band_math import BandExpression, apply_colormap, parse_range
+from utils.exception import InvalidExpression
+
+
+def test_ndvi_expression():
+    expression = BandExpression("(B08-B04)/(B08+B04)")
+    assert expression.bands == (4, 8)
+    ndvi = expression.evaluate({4: np.array([[1., 0.]]), 8: np.array([[3., 0.]])})
+    assert ndvi[0, 0] == pytest.approx(0.5)
+    assert np.isnan(ndvi[0, 1])
+    assert expression.key() == BandExpression("( B08 - B04 ) / ( B08 + B04 )").key()
+
+
+def test_functions_and_numbers():
+    expression = BandExpression("max(B02, B03, 2) + sqrt(abs(-B02))")
+    result = expression.evaluate({2: np.array([4.]), 3: np.array([1.])})
+    assert result[0] == pytest.approx(6.)
+
+
+@pytest.mark.parametrize("text", ["__import__('os')", "B04.real", "B04[0]", "open(B04)", "lambda: 1",
+                                  "B04 if B03 else B02", "sqrt(B04, B03)", "1 + 2", "B04 +"])
+def test_rejected_expressions(text):
+    with pytest.raises(InvalidExpression):
+        BandExpression(text)
+
+
+def test_apply_colormap():
+    rgb = apply_colormap(np.array([[-1., 1., np.nan]]), parse_range("-1,1"), "gray")
+    assert rgb.dtype == np.uint8
+    assert rgb[0].tolist() == [[0, 0, 0], [255, 255, 255], [0, 0, 0]]
+    with pytest.raises(InvalidExpression):
+        apply_colormap(np.zeros((1, 1)), (0., 1.), "unknown")
+    with pytest.raises(InvalidExpression):
+        parse_range("1,0")
@@ -0,0 +1,98 @@
+import os
+import json
+import pytest
+from generator.generator_factory import Generator
+from utils.exception import BadBatchRequest, DataCannotBeComputed
+from utils.batch import parse_batch_request, batch_order, BatchJob, TILE_READY, TILE_NOT_READY, TILE_CANNOT_BE_COMPUTED
+
+
+class BatchGenerator(Generator):
+    PRODUCT_TYPE = "batch"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.listeners = {}
+
+    def check_arguments(self, arguments):
+        list(map(int, arguments.get("bands", "4,3,2").split(",")))
+
+    def prepare_tile(self, tms_x, tms_y, tms_z, arguments):
+        if tms_x == 0:
+            raise DataCannotBeComputed("out of zone")
+        if tms_x == 9:
+            raise RuntimeError("unexpected")
+        file_path = os.path.join(self.directory, "{}_{}_{}.png".format(tms_x, tms_y, tms_z))
+        return file_path, os.path.isfile(file_path)
+
+    def generate_tile(self, tms_x, tms_y, tms_z, arguments):
+        return self.prepare_tile(tms_x, tms_y, tms_z, arguments)[0]
+
+    def add_tile_listener(self, tile_path, callback):
+        self.listeners[tile_path] = callback
+
+    def remove_tile_listener(self, tile_path, callback):
+        self.listeners.pop(tile_path, None)
+
+    def product_type(self):
+        return BatchGenerator.PRODUCT_TYPE
+
+    def get_error_file(self):
+        return "error"
+
+    def get_data_not_yet_ready_file(self):
+        return "blank"
+
+
+def test_parse_batch_request():
+    content = json.dumps({"tiles": [[1, 2, 12], [1, 2, 12]], "range": {"z": 13, "x": [2, 3], "y": [4, 4]},
+                          "params": {"date": "20180620"}})
+    tiles, params = parse_batch_request(content.encode('utf-8'), {"bands": "4,3,2", "date": "20180101"})
+    assert tiles == [(1, 2, 12), (2, 4, 13), (3, 4, 13)]
+    assert params == {"bands": "4,3,2", "date": "20180620"}
+    with pytest.raises(BadBatchRequest):
+        parse_batch_request(b"not json")
+    with pytest.raises(BadBatchRequest):
+        parse_batch_request(json.dumps({"range": {"z": 12, "x": [0, 9], "y": [0, 9]}}), max_tiles=10)
+
+
+def test_batch_order_group_tiles_by_ancestor():
+    assert batch_order([(3, 0, 2), (1, 0, 1), (0, 0, 1), (2, 0, 2), (0, 1, 2)]) == \
+        [(0, 1, 2), (0, 0, 1), (2, 0, 2), (3, 0, 2), (1, 0, 1)]
+
+
+def test_batch_job(tmpdir):
+    generator = BatchGenerator(str(tmpdir))
+    tmpdir.join("1_1_12.png").write_binary(b"ready")
+    notified = []
+    job = BatchJob(generator, [(1, 1, 12), (2, 1, 12), (3, 1, 12), (0, 1, 12)], {})
+    results = job.schedule(notified.append)
+    assert sorted((tile, status) for tile, status, _ in results) == \
+        [((0, 1, 12), TILE_CANNOT_BE_COMPUTED), ((1, 1, 12), TILE_READY)]
+    assert job.pending() == 2
+
+    tmpdir.join("2_1_12.png").write_binary(b"done")
+    generator.listeners[str(tmpdir.join("2_1_12.png"))]()
+    assert job.complete(notified[0]) == [((2, 1, 12), TILE_READY, str(tmpdir.join("2_1_12.png")))]
+    assert job.poll() == []
+    assert job.remaining() == [((3, 1, 12), TILE_NOT_READY, None)]
+    job.close()
+    assert generator.listeners == {}
+
+
+def test_batch_tile_notified_without_file_cannot_be_computed(tmpdir):
+    generator = BatchGenerator(str(tmpdir))
+    notified = []
+    job = BatchJob(generator, [(2, 1, 12)], {})
+    assert job.schedule(notified.append) == []
+    generator.listeners[str(tmpdir.join("2_1_12.png"))]()
+    assert job.complete(notified[0]) == [((2, 1, 12), TILE_CANNOT_BE_COMPUTED, None)]
+    assert job.pending() == 0
+
+
+def test_batch_job_check_params_and_tiles_fail_alone(tmpdir):
+    generator = BatchGenerator(str(tmpdir))
+    with pytest.raises(BadBatchRequest):
+        BatchJob(generator, [(2, 1, 12)], {"bands": "a"})
+    job = BatchJob(generator, [(9, 1, 12), (2, 1, 12)], {"bands": "4,3,2"})
+    assert job.schedule([].append) == [((9, 1, 12), TILE_CANNOT_BE_COMPUTED, None)]
+    assert job.pending() == 1
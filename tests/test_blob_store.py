@@ -0,0 +1,52 @@
+import os
+import time
+from utils.blob_store import BlobStore, BlobPruner
+
+
+def write(path, content):
+    with open(path, 'wb') as tile_file:
+        tile_file.write(content)
+
+
+def test_identical_tiles_share_one_blob(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")))
+    first = str(tmpdir.join("first.png"))
+    second = str(tmpdir.join("second.png"))
+    write(first, b"ocean")
+    write(second, b"ocean")
+    key = store.put(first)
+    assert store.put(second) == key
+    assert os.path.samefile(first, second)
+    assert os.stat(store.blob_path(key)).st_nlink == 3
+    assert key.endswith(".png")
+
+
+def test_named_blob_and_prune(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")))
+    tile = str(tmpdir.join("tile.png"))
+    assert not store.get("uniform", tile)
+    write(tile, b"nodata")
+    assert store.put(tile, "uniform") == "uniform"
+    other = str(tmpdir.join("other.png"))
+    assert store.get("uniform", other)
+    with open(other, 'rb') as other_file:
+        assert other_file.read() == b"nodata"
+    assert store.prune() == 0
+    os.remove(tile)
+    os.remove(other)
+    assert store.prune() == 1
+
+
+def test_pruner_removes_orphaned_blobs(tmpdir):
+    store = BlobStore(str(tmpdir.join("blobs")))
+    tile = str(tmpdir.join("tile.png"))
+    write(tile, b"sea")
+    store.put(tile, "uniform")
+    os.remove(tile)
+    pruner = BlobPruner(store, interval=0.01)
+    pruner.start()
+    for _ in range(100):
+        if not os.path.exists(store.blob_path("uniform")):
+            break
+        time.sleep(0.01)
+    assert not os.path.exists(store.blob_path("uniform"))
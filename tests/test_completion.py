@@ -0,0 +1,23 @@
+from utils.completion import CompletionRegistry
+
+
+def test_notify_call_listeners_once():
+    registry = CompletionRegistry()
+    calls = []
+    registry.add_listener("tile", lambda: calls.append("first"))
+    registry.add_listener("tile", lambda: calls.append("second"))
+    registry.notify("tile")
+    registry.notify("tile")
+    assert calls == ["first", "second"]
+    assert registry.pending() == 0
+
+
+def test_removed_listener_is_not_called():
+    registry = CompletionRegistry()
+    calls = []
+    callback = lambda: calls.append("called")
+    registry.add_listener("tile", callback)
+    registry.remove_listener("tile", callback)
+    registry.notify("tile")
+    assert calls == []
+    assert registry.pending() == 0
@@ -0,0 +1,15 @@
+from datetime import date
+import numpy as np
+from utils.composite import composite_dates, composite_block
+
+
+def test_composite_block_ignores_nodata():
+    stack = np.array([[[10, 0, 0]], [[30, 20, 0]], [[20, 40, 0]]], dtype=np.uint16)
+    block = composite_block(stack, 50.)
+    assert block.tolist() == [[20., 30., 0.]]
+
+
+def test_composite_dates_keep_the_most_recent():
+    dates = [date(2018, 6, day) for day in (25, 5, 15, 5, 10)]
+    assert composite_dates(dates, 2) == [date(2018, 6, 15), date(2018, 6, 25)]
+    assert len(composite_dates(dates, 0)) == 4
@@ -0,0 +1,51 @@
+from shapely.geometry import Polygon
+from utils.coverage import CoverageMask
+from utils.tms_helper import xyz_from_lon_lat
+
+
+def test_coverage_mask():
+    mask = CoverageMask(9, 14)
+    mask.add_bounds(0.5, 43.2, 1.9, 44.2)
+    assert mask.covers(*(xyz_from_lon_lat(1.44, 43.6, 14) + (14,)))
+    assert mask.covers(*(xyz_from_lon_lat(1.44, 43.6, 9) + (9,)))
+    assert not mask.covers(*(xyz_from_lon_lat(-30., 40., 12) + (12,)))
+    assert not mask.covers(*(xyz_from_lon_lat(1.44, 43.6, 8) + (8,)))
+    assert not mask.covers(*(xyz_from_lon_lat(1.44, 43.6, 15) + (15,)))
+    assert not mask.covers(1 << 14, 0, 14)
+
+
+def test_known_empty_tiles():
+    mask = CoverageMask(9, 14, known_empty_size=1)
+    mask.add_bounds(0.5, 43.2, 1.9, 44.2)
+    first = xyz_from_lon_lat(1.44, 43.6, 14) + (14,)
+    second = xyz_from_lon_lat(1.0, 43.5, 14) + (14,)
+    mask.mark_empty(*first)
+    assert not mask.covers(*first)
+    mask.mark_empty(*second)
+    assert mask.covers(*first)
+    assert not mask.covers(*second)
+
+
+def test_coverage_mask_from_geometry():
+    mask = CoverageMask(9, 14)
+    # a triangle, the tiles of the empty corner of its bounds are not covered
+    mask.add_geometry(Polygon([(0., 40.), (10., 40.), (0., 50.)]))
+    assert mask.covers(*(xyz_from_lon_lat(1., 41., 12) + (12,)))
+    assert not mask.covers(*(xyz_from_lon_lat(9., 49., 12) + (12,)))
+
+
+def test_coverage_mask_built_in_background(tmp_path):
+    cache_path = str(tmp_path.joinpath("coverage.bin"))
+    triangle = Polygon([(0., 40.), (10., 40.), (0., 50.)])
+    mask = CoverageMask(9, 14)
+    mask.built = False
+    # every tile is covered until the bitmap is built
+    assert mask.covers(*(xyz_from_lon_lat(9., 49., 12) + (12,)))
+    mask.build_in_background([triangle], cache_path).join(5)
+    assert mask.built
+    assert not mask.covers(*(xyz_from_lon_lat(9., 49., 12) + (12,)))
+    # the next build reads the saved bitmap
+    cached = CoverageMask(9, 14)
+    cached.build([], cache_path)
+    assert cached.covers(*(xyz_from_lon_lat(1., 41., 12) + (12,)))
+    assert not cached.covers(*(xyz_from_lon_lat(9., 49., 12) + (12,)))
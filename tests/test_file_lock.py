@@ -0,0 +1,84 @@
+import os
+import json
+import socket
+import threading
+from utils.file_lock import FileLease, produce_once, atomic_path
+
+
+def test_lease_is_exclusive(tmpdir):
+    path = str(tmpdir.join("raster"))
+    first = FileLease(path)
+    second = FileLease(path)
+    assert first.acquire()
+    assert not second.acquire()
+    assert not second.break_stale()
+    first.release()
+    assert second.acquire()
+    second.release()
+    assert not os.path.exists(path + ".lock")
+
+
+def test_stale_lease_of_dead_process_is_broken(tmpdir):
+    path = str(tmpdir.join("raster"))
+    with open(path + ".lock", 'w') as lock:
+        lock.write(json.dumps({"host": socket.gethostname(), "pid": 2 ** 22 + 1, "token": "dead"}))
+    lease = FileLease(path)
+    assert lease.is_stale()
+    assert lease.break_stale()
+    assert lease.acquire()
+    lease.release()
+
+
+def test_produce_once(tmpdir):
+    path = str(tmpdir.join("tile.png"))
+    calls = []
+
+    def produce():
+        calls.append(1)
+        with atomic_path(path) as temporary_path:
+            assert temporary_path.endswith(".png")
+            with open(temporary_path, 'wb') as tile:
+                tile.write(b"tile")
+
+    threads = [threading.Thread(target=produce_once, args=(path, produce, 10, 0.01)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [1]
+    with open(path, 'rb') as tile:
+        assert tile.read() == b"tile"
+    assert os.listdir(str(tmpdir)) == ["tile.png"]
+
+
+def test_atomic_path_remove_temporary_on_error(tmpdir):
+    path = str(tmpdir.join("tile.png"))
+    try:
+        with atomic_path(path) as temporary_path:
+            with open(temporary_path, 'wb') as tile:
+                tile.write(b"partial")
+            raise IOError("encode failed")
+    except IOError:
+        pass
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_lease_acquired_again_is_not_broken(tmpdir):
+    path = str(tmpdir.join("raster"))
+    with open(path + ".lock", 'w') as lock:
+        lock.write(json.dumps({"host": socket.gethostname(), "pid": 2 ** 22 + 1, "token": "dead"}))
+    lease = FileLease(path)
+    other = FileLease(path)
+    real_is_stale = lease.is_stale
+
+    def acquired_meanwhile():
+        # another replica breaks the stale lease and acquires it between the check and the removal
+        stale = real_is_stale()
+        os.remove(path + ".lock")
+        assert other.acquire()
+        return stale
+    lease.is_stale = acquired_meanwhile
+    assert not lease.break_stale()
+    assert other.owner()["token"] == other.token
+    assert sorted(os.listdir(str(tmpdir))) == ["raster.lock"]
+    other.release()
@@ -0,0 +1,61 @@
+import sys
+import pytest
+from generator.generator_factory import GeneratorFactory
+from utils.exception import GeneratorNotFound
+
+FAKE_GENERATOR_MODULE = '''
+from generator.generator_factory import Generator, GeneratorFactory
+
+class FakeGenerator(Generator):
+    PRODUCT_TYPE = "fake"
+    built = 0
+
+    def __init__(self):
+        FakeGenerator.built = FakeGenerator.built + 1
+
+    def generate_tile(self, tms_x, tms_y, tms_z, arguments):
+        return "tile"
+
+    def product_type(self):
+        return FakeGenerator.PRODUCT_TYPE
+
+    def get_error_file(self):
+        return "error"
+
+    def get_data_not_yet_ready_file(self):
+        return "blank"
+
+GeneratorFactory.get_instance().register_generator(FakeGenerator)
+'''
+
+
+@pytest.fixture
+def fake_generator_module(tmpdir, monkeypatch):
+    tmpdir.join("wtmse_fake_generator.py").write(FAKE_GENERATOR_MODULE)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(GeneratorFactory, "instance", GeneratorFactory())
+    yield "wtmse_fake_generator"
+    sys.modules.pop("wtmse_fake_generator", None)
+
+
+def test_generator_module_is_imported_on_first_build(fake_generator_module):
+    factory = GeneratorFactory.get_instance()
+    factory.declare_generator("fake", fake_generator_module)
+    assert fake_generator_module not in sys.modules
+
+    generator = factory.build_generator("fake")
+    assert fake_generator_module in sys.modules
+    assert factory.build_generator("fake") is generator
+    assert type(generator).built == 1
+
+
+def test_unknown_generator(fake_generator_module):
+    with pytest.raises(GeneratorNotFound):
+        GeneratorFactory.get_instance().build_generator("unknown")
+
+
+def test_generator_packages_are_declared_without_import(fake_generator_module, tmpdir):
+    factory = GeneratorFactory.get_instance()
+    factory.declare_generators([str(tmpdir)], "")
+    assert factory.generator_modules["wtmse_fake_generator"] == fake_generator_module
+    assert fake_generator_module not in sys.modules
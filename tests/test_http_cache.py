@@ -0,0 +1,41 @@
+import os
+from utils.http_cache import ETagIndex, request_key, cache_control
+
+
+def test_request_key_ignore_argument_order():
+    first = request_key("sentinel2", 1, 2, 12, {"bands": "4,3,2", "date": "20180620"})
+    second = request_key("sentinel2", 1, 2, 12, {"date": "20180620", "bands": "4,3,2"})
+    assert first == second
+
+
+def test_cache_control():
+    assert "immutable" in cache_control({"date": "20180620"})
+    assert "immutable" not in cache_control({})
+    assert "immutable" in cache_control({"date_from": "20180601", "date_to": "20180630"})
+    assert "immutable" not in cache_control({"date_from": "20180601"})
+
+
+def test_etag_index(tmpdir):
+    tile = tmpdir.join("tile.png")
+    tile.write_binary(b"first")
+    index = ETagIndex(size=1)
+    entry = index.put("key", str(tile), {"date": "20180620"})
+    assert index.get("key").etag == entry.etag
+
+    tile.write_binary(b"second")
+    os.utime(str(tile), (entry.last_modified + 10, entry.last_modified + 10))
+    assert index.put("key", str(tile), {"date": "20180620"}).etag != entry.etag
+
+    index.put("other", str(tile), {"date": "20180620"})
+    assert index.get("key") is None
+
+
+def test_etag_index_remove(tmpdir):
+    tile = tmpdir.join("tile.png")
+    tile.write_binary(b"first")
+    index = ETagIndex()
+    entry = index.put("key", str(tile), {"date": "20180620"})
+    tile.write_binary(b"second, rendered again")
+    assert not entry.is_current()
+    index.remove("key")
+    assert index.get("key") is None
@@ -0,0 +1,37 @@
+import threading
+import time
+from utils.memory_budget import MemoryBudget
+
+
+def test_operations_wait_for_the_budget():
+    budget = MemoryBudget(100)
+    first = budget.acquire(60)
+    admitted = threading.Event()
+
+    def second_operation():
+        with budget.reserve(60, "test"):
+            admitted.set()
+
+    thread = threading.Thread(target=second_operation)
+    thread.start()
+    time.sleep(0.05)
+    assert not admitted.is_set()
+    budget.release(first)
+    thread.join(1)
+    assert admitted.is_set()
+    assert budget.reserved() == 0
+
+
+def test_operation_bigger_than_the_budget_is_admitted_alone():
+    budget = MemoryBudget(100)
+    with budget.reserve(1000, "test") as reserved:
+        assert reserved == 100
+        assert budget.reserved() == 100
+    assert budget.reserved() == 0
+
+
+def test_disabled_budget_admits_everything():
+    budget = MemoryBudget(0)
+    assert budget.acquire(1000) == 0
+    assert budget.acquire(1000) == 0
+    assert budget.reserved() == 0
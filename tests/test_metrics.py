@@ -0,0 +1,29 @@
+import pytest
+from utils.metrics import MetricsRegistry, STAGE_DURATION, STAGE_ERRORS, REGISTRY, timed
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter("tiles_total", "Tiles", ["result"]).inc(result="hit")
+    registry.gauge("queue_depth", "Queue", function=lambda: 3)
+    histogram = registry.histogram("duration_seconds", "Duration", buckets=(1., 10.))
+    histogram.observe(0.5)
+    histogram.observe(5.)
+    text = registry.render()
+    assert 'tiles_total{result="hit"} 1.0' in text
+    assert "queue_depth 3.0" in text
+    assert 'duration_seconds_bucket{le="1.0"} 1.0' in text
+    assert 'duration_seconds_bucket{le="+Inf"} 2.0' in text
+    assert "duration_seconds_count 2.0" in text
+    assert "# TYPE duration_seconds histogram" in text
+
+
+def test_timed_stage_count_errors():
+    @timed("test_stage")
+    def failing_stage():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        failing_stage()
+    assert STAGE_ERRORS.value(stage="test_stage") == 1
+    assert 'wtmse_stage_duration_seconds_count{stage="test_stage"} 1.0' in REGISTRY.render()
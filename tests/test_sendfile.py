@@ -0,0 +1,17 @@
+import os
+import tempfile
+from utils import sendfile
+
+
+def test_accel_redirect_header(monkeypatch):
+    monkeypatch.setattr(sendfile, "SENDFILE_MODE", "x-accel-redirect")
+    monkeypatch.setattr(sendfile, "ACCEL_REDIRECT_PREFIX", "/wtmse-cache/")
+    monkeypatch.setattr(sendfile, "ACCEL_REDIRECT_ROOT", tempfile.gettempdir())
+    tile = os.path.join(tempfile.gettempdir(), "31TCJ_2018_6_20_1 2.png")
+    assert sendfile.offload_headers(tile) == {"X-Accel-Redirect": "/wtmse-cache/31TCJ_2018_6_20_1%202.png"}
+    assert sendfile.offload_headers("/elsewhere/error.jpg") is None
+
+
+def test_in_process_by_default(monkeypatch):
+    monkeypatch.setattr(sendfile, "SENDFILE_MODE", "")
+    assert sendfile.offload_headers("/tmp/tile.png") is None
@@ -0,0 +1,45 @@
+import time
+from utils.http_cache import ETagIndex
+from utils.tile_cache import HotTileCache
+
+
+def test_hot_tile_cache_budget(tmpdir):
+    index = ETagIndex()
+    cache = HotTileCache(budget=10, max_tile_size=8)
+    for name, content in (("first", b"12345"), ("second", b"67890"), ("big", b"123456789")):
+        tile = tmpdir.join(name + ".png")
+        tile.write_binary(content)
+        cache.put(name, index.put(name, str(tile), {"date": "20180620"}), {"date": "20180620"})
+    assert cache.get("first").body == b"12345"
+    assert cache.get("second").body == b"67890"
+    assert cache.get("big") is None
+    assert cache.size() == 10
+
+    third = tmpdir.join("third.png")
+    third.write_binary(b"abc")
+    cache.put("third", index.put("third", str(third), {"date": "20180620"}), {"date": "20180620"})
+    assert cache.get("first") is None
+    assert cache.get("second") is not None
+    assert cache.size() == 8
+
+
+def test_hot_tile_cache_latest_expire(tmpdir):
+    tile = tmpdir.join("tile.png")
+    tile.write_binary(b"tile")
+    cache = HotTileCache(budget=100)
+    cached = cache.put("latest", ETagIndex().put("latest", str(tile), {}), {})
+    assert cache.get("latest") is cached
+    cached.expires_at = time.time() - 1
+    assert cache.get("latest") is None
+    assert cache.size() == 0
+
+
+def test_hot_tile_cache_drop_tile_rendered_again(tmpdir):
+    tile = tmpdir.join("tile.png")
+    tile.write_binary(b"tile")
+    cache = HotTileCache(budget=100)
+    cache.put("tile", ETagIndex().put("tile", str(tile), {"date": "20180620"}), {"date": "20180620"})
+    assert cache.get("tile").body == b"tile"
+    tile.write_binary(b"rendered again")
+    assert cache.get("tile") is None
+    assert cache.size() == 0
@@ -0,0 +1,29 @@
+from utils.tile_format import format_from_extension, format_from_accept, negotiate_format, mimetype_for_path
+
+
+def test_format_from_extension():
+    assert format_from_extension("PNG") == "png"
+    assert format_from_extension("jpeg") == "jpg"
+    assert format_from_extension("gif") is None
+
+
+def test_format_from_accept():
+    assert format_from_accept(None) == "png"
+    assert format_from_accept("*/*") == "png"
+    assert format_from_accept("image/avif,image/webp,image/apng,image/*,*/*;q=0.8") == "webp"
+    assert format_from_accept("image/png,image/jpeg;q=0.9") == "png"
+    assert format_from_accept("image/png;q=0.5,image/jpeg") == "jpg"
+    assert format_from_accept("image/webp;q=0,image/jpeg;q=0.2") == "jpg"
+
+
+def test_negotiate_format():
+    assert negotiate_format("jpeg", "webp", "image/webp", ("png", "jpg")) == "jpg"
+    assert negotiate_format(None, "webp", None, ("png", "jpg")) is None
+    assert negotiate_format(None, None, "image/webp", ("png", "jpg")) == "png"
+    assert negotiate_format(None, None, "image/webp", ("png", "jpg", "webp")) == "webp"
+
+
+def test_mimetype_for_path():
+    assert mimetype_for_path("/tmp/tile.webp") == "image/webp"
+    assert mimetype_for_path("/tmp/tile.jpg") == "image/jpeg"
+    assert mimetype_for_path("/tmp/tile") == "image/png"
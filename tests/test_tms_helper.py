@@ -0,0 +1,21 @@
+import pytest
+from utils.tms_helper import bbox_from_xyz, xyz_from_lon_lat, tiles_in_bbox
+
+
+@pytest.mark.parametrize("tms_x,tms_y,tms_z", [
+    (16540, 11963, 15),
+    (4108, 3017, 13),
+    (258, 186, 9)
+]
+)
+def test_xyz_from_lon_lat(tms_x, tms_y, tms_z):
+    bbox = bbox_from_xyz(tms_x, tms_y, tms_z)
+    center_lon = (bbox[0][0] + bbox[1][0]) / 2
+    center_lat = (bbox[0][1] + bbox[1][1]) / 2
+    assert xyz_from_lon_lat(center_lon, center_lat, tms_z) == (tms_x, tms_y)
+
+
+def test_tiles_in_bbox():
+    bbox = bbox_from_xyz(4108, 3017, 13)
+    tiles = list(tiles_in_bbox(bbox[0][0] + 1e-6, bbox[0][1] + 1e-6, bbox[1][0] - 1e-6, bbox[1][1] - 1e-6, 14))
+    assert sorted(tiles) == [(8216, 6034), (8216, 6035), (8217, 6034), (8217, 6035)]
@@ -0,0 +1,48 @@
+import os
+import pstats
+import threading
+from utils.tracing import Trace, new_trace, span
+
+
+def test_spans_record_the_queue_wait_and_the_execution():
+    trace = Trace()
+    trace.queued("image")
+
+    def producer():
+        trace.dequeued("image")
+        with span(trace, "image"):
+            pass
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    thread.join(1)
+    assert [name for name, _, _ in trace.spans()] == ["queue_image", "image"]
+    assert "queue_image" in trace.breakdown()
+    with span(None, "nothing recorded"):
+        pass
+
+
+def test_client_trace_id_is_kept_when_valid():
+    assert Trace("abc-123").trace_id == "abc-123"
+    assert Trace("bad id\n").trace_id != "bad id\n"
+    assert not new_trace(profile_argument="1", profile_requests=False, sample_rate=0).profile
+    assert new_trace(profile_argument="1", profile_requests=True).profile
+
+
+def test_profiled_trace_dumps_its_stats(tmp_path):
+    trace = Trace(profile=True, profile_dir=str(tmp_path))
+    with trace.span("tile", profiled=True):
+        sum(range(1000))
+    path = trace.dump_profile()
+    assert os.path.isfile(path)
+    assert pstats.Stats(path).total_calls > 0
+    assert trace.dump_profile() is None
+
+
+def test_stage_ending_after_the_request_is_dumped(tmp_path):
+    trace = Trace(profile=True, profile_dir=str(tmp_path))
+    with trace.span("raster", profiled=True):
+        sum(range(1000))
+        trace.finish("/sentinel2/1/2/3")
+    path = str(tmp_path.joinpath(trace.trace_id + ".pstats"))
+    assert os.path.isfile(path)
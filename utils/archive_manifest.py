@@ -0,0 +1,182 @@
+"""
+Archive manifest helper, index the Sentinel-2 band files of a local archive by zone, date and band.
+The manifest is persisted in a JSON file and refreshed incrementally from the directories modification times
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+from utils.file_lock import atomic_path
+
+LOGGER = logging.getLogger("wtmse")
+MANIFEST_VERSION = 1
+# band of a SAFE product: T31TCJ_20181120T105329_B04.jp2, T31TCJ_20181120T105329_B04_10m.jp2 for L2A products
+SAFE_BAND = re.compile(r'^T(\d{2}[A-Z]{3})_(\d{8})T\d{6}_B(\d{2})(?:_(\d+)m)?\.jp2$')
+# band downloaded by the sentinel product downloader: 31TCJ_2018_11_20_B04
+DOWNLOADED_BAND = re.compile(r'^(\d{2}[A-Z]{3})_(\d{4})_(\d{1,2})_(\d{1,2})_B(\d{2})$')
+DOWNLOADED_RESOLUTION = 10
+
+
+def parse_band_file(name):
+    """
+    Return the (zone, date string, band, resolution) of a band file name, None if the file is not a band
+    """
+    match = SAFE_BAND.match(name)
+    if match is not None:
+        zone_name, date_string, band, resolution = match.groups()
+        return zone_name, date_string, int(band), int(resolution or DOWNLOADED_RESOLUTION)
+    match = DOWNLOADED_BAND.match(name)
+    if match is not None:
+        zone_name, year, month, day, band = match.groups()
+        return zone_name, "%04d%02d%02d" % (int(year), int(month), int(day)), int(band), DOWNLOADED_RESOLUTION
+    return None
+
+
+def build_index(directories):
+    """
+    Return the (products, latest dates) index of the scanned directories,
+    zone -> date string -> band -> path of the finest resolution and zone -> latest date string
+    """
+    products = {}
+    resolutions = {}
+    for directory in directories.values():
+        for zone_name, date_string, band, resolution, path in directory["bands"]:
+            key = (zone_name, date_string, band)
+            if key in resolutions and resolutions[key] <= resolution:
+                continue
+            resolutions[key] = resolution
+            products.setdefault(zone_name, {}).setdefault(date_string, {})[band] = path
+    return products, dict((zone_name, max(dates)) for zone_name, dates in products.items())
+
+
+class ArchiveManifest:
+    """
+    Archive manifest, zone -> date string (YYYYMMDD) -> band -> path of the finest resolution band file.
+    The directories are kept with their modification time, their subdirectories and their band files:
+    a refresh only lists the directories modified since the previous one.
+    The index is built aside and swapped, lookups read the last built index and never touch the file system
+    """
+
+    def __init__(self, root, manifest_path):
+        """
+        init
+        """
+        self.root = os.path.abspath(root)
+        self.manifest_path = manifest_path
+        self.__directories = {}
+        self.__products = {}
+        self.__latest = {}
+        self.__lock = threading.Lock()
+        self.__refresh_lock = threading.Lock()
+
+    def __swap(self, directories):
+        """
+        Replace the directories and their index
+        """
+        products, latest = build_index(directories)
+        with self.__lock:
+            self.__directories, self.__products, self.__latest = directories, products, latest
+
+    def load(self):
+        """
+        Load the persisted manifest, return False if there is none for the archive
+        """
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                content = json.load(manifest_file)
+        except (OSError, ValueError) as err:
+            LOGGER.info("No archive manifest loaded from %s: %s", self.manifest_path, err)
+            return False
+        if content.get("version") != MANIFEST_VERSION or content.get("root") != self.root:
+            LOGGER.info("Archive manifest %s is not the manifest of %s", self.manifest_path, self.root)
+            return False
+        self.__swap(content.get("directories", {}))
+        return True
+
+    def save(self):
+        """
+        Persist the manifest
+        """
+        with self.__lock:
+            content = {"version": MANIFEST_VERSION, "root": self.root, "directories": self.__directories}
+        try:
+            with atomic_path(self.manifest_path) as temporary_path:
+                with open(temporary_path, 'w') as manifest_file:
+                    json.dump(content, manifest_file)
+        except OSError as err:
+            LOGGER.error("Impossible to write archive manifest %s: %s", self.manifest_path, err)
+
+    def refresh(self):
+        """
+        Scan the directories modified since the last refresh, return True if the manifest changed
+        """
+        with self.__refresh_lock:
+            with self.__lock:
+                known = self.__directories
+            directories = {}
+            changed = ArchiveManifest.scan(self.root, known, directories, set())
+            if changed or set(directories) != set(known):
+                self.__swap(directories)
+                return True
+        return False
+
+    @staticmethod
+    def scan(path, known, directories, visited):
+        """
+        Add the directory and its subdirectories to directories, list them again only when modified since known,
+        return True if a directory was listed. Directories already visited through a link are skipped
+        """
+        real_path = os.path.realpath(path)
+        if real_path in visited:
+            return False
+        visited.add(real_path)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        directory = known.get(path)
+        listed = directory is None or directory["mtime"] != mtime
+        if listed:
+            subdirectories = []
+            bands = []
+            try:
+                entries = list(os.scandir(path))
+            except OSError as err:
+                LOGGER.error("Impossible to list archive directory %s: %s", path, err)
+                entries = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    subdirectories.append(entry.path)
+                    continue
+                band_file = parse_band_file(entry.name)
+                if band_file is not None:
+                    bands.append(list(band_file) + [entry.path])
+            directory = {"mtime": mtime, "subdirectories": sorted(subdirectories), "bands": bands}
+        directories[path] = directory
+        for subdirectory in directory["subdirectories"]:
+            listed = ArchiveManifest.scan(subdirectory, known, directories, visited) or listed
+        return listed
+
+    def latest_date(self, zone_name):
+        """
+        Return the latest date string of the zone, None if the zone is not in the archive
+        """
+        return self.__latest.get(zone_name)
+
+    def dates(self, zone_name):
+        """
+        Return the date strings of the zone
+        """
+        return sorted(self.__products.get(zone_name, {}))
+
+    def bands(self, zone_name, date_string):
+        """
+        Return the band -> path of the zone at the date, None if there is no product
+        """
+        return self.__products.get(zone_name, {}).get(date_string)
@@ -0,0 +1,155 @@
+"""
+Band math helper, parse and evaluate safe arithmetic expressions over band references
+and colour the result with a colormap
+"""
+
+import re
+import ast
+import hashlib
+import numpy as np
+from utils.exception import InvalidExpression
+
+BAND_NAME = re.compile(r'^B(\d{1,2})$')
+MAX_EXPRESSION_LENGTH = 256
+BINARY_OPERATORS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+                    ast.Div: np.true_divide, ast.Pow: np.power}
+UNARY_OPERATORS = {ast.USub: np.negative, ast.UAdd: np.positive}
+FUNCTIONS = {"sqrt": np.sqrt, "abs": np.abs, "log": np.log}
+# functions of two or more arguments
+REDUCE_FUNCTIONS = {"min": np.minimum, "max": np.maximum}
+# colormaps control points, position between 0 and 1 and rgb colour
+COLORMAPS = {
+    "gray": [(0., (0, 0, 0)), (1., (255, 255, 255))],
+    "ndvi": [(0., (165, 0, 38)), (0.25, (244, 109, 67)), (0.5, (255, 255, 191)),
+             (0.75, (102, 189, 99)), (1., (0, 104, 55))],
+    "water": [(0., (247, 251, 255)), (0.5, (107, 174, 214)), (1., (8, 48, 107))],
+    "viridis": [(0., (68, 1, 84)), (0.25, (59, 82, 139)), (0.5, (33, 145, 140)),
+                (0.75, (94, 201, 98)), (1., (253, 231, 37))],
+}
+DEFAULT_COLORMAP = "gray"
+DEFAULT_RANGE = (-1., 1.)
+NODATA_COLOR = (0, 0, 0)
+
+
+class BandExpression:
+    """
+    Band expression, an arithmetic expression over the bands B01 to B12:
+    numbers, + - * / **, sqrt, abs, log, min and max. Anything else is rejected before evaluation
+    """
+
+    def __init__(self, expression):
+        """
+        init
+        """
+        if len(expression) > MAX_EXPRESSION_LENGTH:
+            raise InvalidExpression("Expression longer than {} characters".format(MAX_EXPRESSION_LENGTH))
+        try:
+            self.__tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError as err:
+            raise InvalidExpression("Invalid expression {}: {}".format(expression, err))
+        self.expression = expression
+        bands = set()
+        self.__check(self.__tree, bands)
+        if not bands:
+            raise InvalidExpression("Expression {} shall use at least one band".format(expression))
+        self.bands = tuple(sorted(bands))
+
+    def __check(self, node, bands):
+        """
+        Check the node is allowed and collect the bands used
+        """
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            self.__check(node.left, bands)
+            self.__check(node.right, bands)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            self.__check(node.operand, bands)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords and \
+                ((node.func.id in FUNCTIONS and len(node.args) == 1) or
+                 (node.func.id in REDUCE_FUNCTIONS and len(node.args) >= 2)):
+            for argument in node.args:
+                self.__check(argument, bands)
+        elif isinstance(node, ast.Name) and BAND_NAME.match(node.id):
+            bands.add(int(BAND_NAME.match(node.id).group(1)))
+        elif self.__number(node) is None:
+            raise InvalidExpression("{} not allowed in expression {}".format(type(node).__name__, self.expression))
+
+    @staticmethod
+    def __number(node):
+        """
+        Return the value of a number node, None if the node is not a number
+        """
+        value = getattr(node, 'value', None) if type(node).__name__ == 'Constant' else getattr(node, 'n', None)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return value
+
+    def key(self):
+        """
+        Return a short key of the expression, the same for expressions written differently
+        """
+        return hashlib.sha1(ast.dump(self.__tree).encode('utf-8')).hexdigest()[:16]
+
+    def evaluate(self, arrays):
+        """
+        Evaluate the expression on the band arrays given by band number,
+        divisions by zero give nan
+        """
+        def evaluate_node(node):
+            if isinstance(node, ast.BinOp):
+                return BINARY_OPERATORS[type(node.op)](evaluate_node(node.left), evaluate_node(node.right))
+            if isinstance(node, ast.UnaryOp):
+                return UNARY_OPERATORS[type(node.op)](evaluate_node(node.operand))
+            if isinstance(node, ast.Call) and node.func.id in FUNCTIONS:
+                return FUNCTIONS[node.func.id](evaluate_node(node.args[0]))
+            if isinstance(node, ast.Call):
+                result = evaluate_node(node.args[0])
+                for argument in node.args[1:]:
+                    result = REDUCE_FUNCTIONS[node.func.id](result, evaluate_node(argument))
+                return result
+            if isinstance(node, ast.Name):
+                return np.asarray(arrays[int(BAND_NAME.match(node.id).group(1))], dtype=np.float32)
+            return np.float32(self.__number(node))
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            result = np.asarray(evaluate_node(self.__tree), dtype=np.float32)
+        result[~np.isfinite(result)] = np.nan
+        return result
+
+
+def parse_range(range_string):
+    """
+    Return the (min, max) range of a "min,max" string
+    """
+    try:
+        value_min, value_max = map(float, range_string.split(','))
+    except ValueError:
+        raise InvalidExpression("Range {} shall be min,max".format(range_string))
+    if value_min >= value_max:
+        raise InvalidExpression("Range minimum shall be lower than the maximum")
+    return value_min, value_max
+
+
+def colormap_lut(colormap):
+    """
+    Return the 256 colours lookup table of the colormap
+    """
+    if colormap not in COLORMAPS:
+        raise InvalidExpression("Colormap {} not supported".format(colormap))
+    positions = [position for position, _ in COLORMAPS[colormap]]
+    indexes = np.linspace(0., 1., 256)
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    for channel in range(3):
+        colors = [color[channel] for _, color in COLORMAPS[colormap]]
+        lut[:, channel] = np.round(np.interp(indexes, positions, colors)).astype(np.uint8)
+    return lut
+
+
+def apply_colormap(values, value_range=DEFAULT_RANGE, colormap=DEFAULT_COLORMAP):
+    """
+    Return the uint8 rgb image of the values scaled on the range through the colormap, nan are nodata
+    """
+    nodata = np.isnan(values)
+    scaled = (np.nan_to_num(values) - value_range[0]) * (255. / (value_range[1] - value_range[0]))
+    rgb = colormap_lut(colormap)[np.clip(np.round(scaled), 0, 255).astype(np.uint8)]
+    rgb[nodata] = NODATA_COLOR
+    return rgb
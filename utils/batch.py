@@ -0,0 +1,242 @@
+"""
+Batch helper, parse batch tile requests, schedule their tiles and encode the multipart response
+"""
+
+import os
+import json
+import uuid
+import logging
+import functools
+import threading
+from utils.exception import DataCannotBeComputed, DataNotYetReady, BadBatchRequest
+from utils.tile_format import mimetype_for_path
+
+LOGGER = logging.getLogger("wtmse")
+BATCH_MAX_TILES = int(os.getenv('WTMSE_BATCH_MAX_TILES', 1024))
+BATCH_MAXIMUM_WAIT = float(os.getenv('WTMSE_BATCH_MAXIMUM_WAIT', 60))
+BATCH_POLL_INTERVAL = float(os.getenv('WTMSE_BATCH_POLL_INTERVAL', 1))
+TILE_READY = 200
+TILE_CANNOT_BE_COMPUTED = 404
+TILE_NOT_READY = 503
+
+
+def parse_batch_request(content, arguments=None, max_tiles=BATCH_MAX_TILES):
+    """
+    Parse a batch request body:
+    {"tiles": [[x, y, z], ...], "range": {"z": z, "x": [x_min, x_max], "y": [y_min, y_max]}, "params": {...}}
+    range can be a list of ranges, params are the render arguments shared by the tiles
+    and override the query string arguments
+    :return (tiles, params) the list of distinct (x, y, z) and the arguments dict
+    """
+    try:
+        request = json.loads(content.decode('utf-8') if isinstance(content, bytes) else content)
+    except ValueError as err:
+        raise BadBatchRequest("Batch request shall be JSON: {}".format(err))
+    if not isinstance(request, dict):
+        raise BadBatchRequest("Batch request shall be a JSON object")
+
+    tiles = []
+    seen = set()
+
+    def add_tile(tms_x, tms_y, tms_z):
+        if (tms_x, tms_y, tms_z) in seen:
+            return
+        if len(tiles) >= max_tiles:
+            raise BadBatchRequest("Batch request is limited to {} tiles".format(max_tiles))
+        seen.add((tms_x, tms_y, tms_z))
+        tiles.append((tms_x, tms_y, tms_z))
+
+    try:
+        for tms_x, tms_y, tms_z in request.get('tiles', []):
+            add_tile(int(tms_x), int(tms_y), int(tms_z))
+        ranges = request.get('range', [])
+        for tile_range in [ranges] if isinstance(ranges, dict) else ranges:
+            tms_z = int(tile_range['z'])
+            x_min, x_max = map(int, tile_range['x'])
+            y_min, y_max = map(int, tile_range['y'])
+            for tms_x in range(x_min, x_max + 1):
+                for tms_y in range(y_min, y_max + 1):
+                    add_tile(tms_x, tms_y, tms_z)
+    except (TypeError, ValueError, KeyError) as err:
+        raise BadBatchRequest("Invalid tiles in batch request: {}".format(err))
+    if not tiles:
+        raise BadBatchRequest("Batch request without tile")
+
+    params = dict(arguments or {})
+    if not isinstance(request.get('params', {}), dict):
+        raise BadBatchRequest("Batch params shall be a JSON object")
+    params.update((str(name), str(value)) for name, value in request.get('params', {}).items())
+    return tiles, params
+
+
+def batch_order(tiles):
+    """
+    Order the tiles scene by scene: tiles sharing the same ancestor at the lowest zoom
+    of the batch are scheduled together, the deepest levels first
+    """
+    base_zoom = min(tms_z for _, _, tms_z in tiles)
+
+    def scene_key(tile):
+        tms_x, tms_y, tms_z = tile
+        shift = tms_z - base_zoom
+        return (tms_x >> shift, tms_y >> shift, -tms_z, tms_x, tms_y)
+    return sorted(tiles, key=scene_key)
+
+
+def new_boundary():
+    """
+    Return a multipart boundary
+    """
+    return "wtmse-" + uuid.uuid4().hex
+
+
+def multipart_content_type(boundary):
+    """
+    Return the Content-Type of a multipart batch response
+    """
+    return "multipart/mixed; boundary={}".format(boundary)
+
+
+def multipart_part(boundary, headers, body=b''):
+    """
+    Encode a part of a multipart response
+    """
+    head = "--{}\r\n".format(boundary)
+    for name, value in headers:
+        head = head + "{}: {}\r\n".format(name, value)
+    head = head + "Content-Length: {}\r\n\r\n".format(len(body))
+    return head.encode('latin-1') + body + b"\r\n"
+
+
+def multipart_end(boundary):
+    """
+    Encode the end of a multipart response
+    """
+    return "--{}--\r\n".format(boundary).encode('latin-1')
+
+
+def result_part(boundary, generator_name, result):
+    """
+    Encode the part of a tile result (tile, status, file path), the tile file is read
+    """
+    (tms_x, tms_y, tms_z), status, file_path = result
+    headers = [("Content-Location", "/{}/{}/{}/{}".format(generator_name, tms_x, tms_y, tms_z)),
+               ("X-Tile-Status", status)]
+    body = b''
+    if status == TILE_READY:
+        with open(file_path, 'rb') as tile_file:
+            body = tile_file.read()
+        headers.append(("Content-Type", mimetype_for_path(file_path)))
+    elif status == TILE_NOT_READY:
+        headers.append(("X-WTMSE-Status", "not-ready"))
+    return multipart_part(boundary, headers, body)
+
+
+class BatchJob:
+    """
+    Batch job, schedule the tiles of a batch request in the generator
+    and follow their completion, results are (tile, status, file path).
+    The arguments are checked and made canonical once for the tiles, before the response starts
+    """
+
+    def __init__(self, generator, tiles, arguments):
+        """
+        init
+        """
+        try:
+            generator.check_arguments(arguments)
+        except (ValueError, DataCannotBeComputed) as err:
+            raise BadBatchRequest("Invalid batch params: {}".format(err))
+        self.generator = generator
+        self.tiles = batch_order(tiles)
+        self.arguments = generator.canonical_arguments(arguments)
+        self.__pending = {}
+        self.__listeners = {}
+        self.__lock = threading.Lock()
+
+    def schedule(self, notify):
+        """
+        Request every tile without waiting, notify(file_path) is called from the producers
+        when a pending tile is done
+        :return the results of the tiles already known
+        """
+        results = []
+        for tile in self.tiles:
+            tms_x, tms_y, tms_z = tile
+            if self.generator.is_tile_empty(tms_x, tms_y, tms_z):
+                results.append((tile, TILE_CANNOT_BE_COMPUTED, None))
+                continue
+            try:
+                file_path, ready = self.generator.prepare_tile(tms_x, tms_y, tms_z, self.arguments)
+            except DataCannotBeComputed:
+                results.append((tile, TILE_CANNOT_BE_COMPUTED, None))
+                continue
+            except DataNotYetReady:
+                results.append((tile, TILE_NOT_READY, None))
+                continue
+            except Exception as err:
+                # the response is already started, the tile fails alone
+                LOGGER.exception("Impossible to prepare batch tile %s: %s", tile, err)
+                results.append((tile, TILE_CANNOT_BE_COMPUTED, None))
+                continue
+            if ready:
+                results.append((tile, TILE_READY, file_path))
+                continue
+            with self.__lock:
+                self.__pending.setdefault(file_path, []).append(tile)
+                if file_path in self.__listeners:
+                    continue
+                self.__listeners[file_path] = functools.partial(notify, file_path)
+            self.generator.add_tile_listener(file_path, self.__listeners[file_path])
+        return results + self.poll()
+
+    def pending(self):
+        """
+        Return the number of tiles not yet done
+        """
+        with self.__lock:
+            return sum(len(tiles) for tiles in self.__pending.values())
+
+    def complete(self, file_path, notified=True):
+        """
+        Return the results of the tiles of the file path if done,
+        a file path notified by the generator without its file cannot be computed
+        """
+        ready = os.path.isfile(file_path)
+        if not ready and not notified:
+            return []
+        with self.__lock:
+            tiles = self.__pending.pop(file_path, [])
+        if not ready:
+            return [(tile, TILE_CANNOT_BE_COMPUTED, None) for tile in tiles]
+        return [(tile, TILE_READY, file_path) for tile in tiles]
+
+    def poll(self):
+        """
+        Return the results of the pending tiles produced without notification
+        """
+        with self.__lock:
+            file_paths = list(self.__pending)
+        results = []
+        for file_path in file_paths:
+            results.extend(self.complete(file_path, notified=False))
+        return results
+
+    def remaining(self):
+        """
+        Return the not ready results of the pending tiles
+        """
+        with self.__lock:
+            pending = list(self.__pending.values())
+            self.__pending.clear()
+        return [(tile, TILE_NOT_READY, None) for tiles in pending for tile in tiles]
+
+    def close(self):
+        """
+        Remove the listeners of the job
+        """
+        with self.__lock:
+            listeners = list(self.__listeners.items())
+            self.__listeners.clear()
+        for file_path, listener in listeners:
+            self.generator.remove_tile_listener(file_path, listener)
@@ -0,0 +1,136 @@
+"""
+Blob store, keep the tiles bytes once by content, the tile files are hard links to the blobs
+"""
+
+import os
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+from utils.file_lock import temporary_path
+from utils.metrics import REGISTRY
+
+LOGGER = logging.getLogger("wtmse")
+BLOB_STORE = os.getenv('WTMSE_BLOB_STORE', '0').lower() in ('1', 'true', 'yes')
+BLOB_STORE_DIR = os.getenv('WTMSE_BLOB_STORE_DIR', os.path.join(tempfile.gettempdir(), "wtmse_blobs"))
+BLOB_PRUNE_INTERVAL = float(os.getenv('WTMSE_BLOB_PRUNE_INTERVAL', 3600))
+BLOBS = REGISTRY.counter("wtmse_blob_store_total", "Tiles stored in the blob store", ["result"])
+BLOBS_PRUNED = REGISTRY.counter("wtmse_blob_store_pruned_total", "Blobs removed from the blob store")
+
+
+class BlobStore:
+    """
+    Blob store, content addressed files in a directory of the tiles file system.
+    A tile file is replaced by a hard link to the blob of the same content, or becomes that blob:
+    byte identical tiles use the storage of one. A blob not linked by any tile anymore can be pruned
+    """
+
+    def __init__(self, root=BLOB_STORE_DIR):
+        """
+        init
+        """
+        self.root = root
+
+    def blob_path(self, key):
+        """
+        Return the path of the blob of the key
+        """
+        return os.path.join(self.root, key[:2], key)
+
+    @staticmethod
+    def content_key(path):
+        """
+        Return the content key of the file, its sha256 and its extension
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as content:
+            for chunk in iter(lambda: content.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest() + os.path.splitext(path)[1]
+
+    def get(self, key, path):
+        """
+        Link the blob of the key at the path, return False if there is no such blob
+        """
+        blob = self.blob_path(key)
+        link = temporary_path(path)
+        try:
+            os.link(blob, link)
+        except OSError:
+            return False
+        try:
+            os.replace(link, path)
+        except OSError:
+            os.remove(link)
+            raise
+        BLOBS.inc(result="reused")
+        return True
+
+    def put(self, path, key=None):
+        """
+        Store the file, the content key by default, the file is linked to the blob already stored
+        with the same key or becomes the blob. Return the key, None if the file cannot be linked
+        """
+        key = key or BlobStore.content_key(path)
+        blob = self.blob_path(key)
+        try:
+            if self.get(key, path):
+                return key
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            link = temporary_path(blob)
+            os.link(path, link)
+            # a blob stored meanwhile is the same content
+            os.replace(link, blob)
+        except OSError as err:
+            BLOBS.inc(result="error")
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                LOGGER.error("Impossible to store %s in blob store %s: %s", path, self.root, err)
+            return None
+        BLOBS.inc(result="stored")
+        return key
+
+    def prune(self):
+        """
+        Remove the blobs not linked by any tile, return the number of blobs removed
+        """
+        removed = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                blob = os.path.join(directory, name)
+                try:
+                    if os.stat(blob).st_nlink == 1:
+                        os.remove(blob)
+                        removed = removed + 1
+                except OSError:
+                    pass
+        BLOBS_PRUNED.inc(removed)
+        return removed
+
+
+class BlobPruner(threading.Thread):
+    """
+    Blob pruner, remove the blobs not linked by any tile anymore every interval seconds
+    """
+
+    def __init__(self, store, interval=BLOB_PRUNE_INTERVAL):
+        """
+        init
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.store = store
+        self.interval = interval
+
+    def run(self):
+        """
+        Prune the store forever
+        """
+        while True:
+            time.sleep(self.interval)
+            try:
+                removed = self.store.prune()
+            except Exception as err:
+                LOGGER.error("Impossible to prune blob store %s: %s", self.store.root, err)
+                continue
+            LOGGER.info("%s blobs pruned from blob store %s", removed, self.store.root)
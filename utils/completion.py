@@ -0,0 +1,53 @@
+"""
+Completion registry, notify listeners waiting for a produced data
+"""
+
+import threading
+
+
+class CompletionRegistry:
+    """
+    Completion registry keep the callbacks waiting for a key,
+    callbacks are called once, from the thread which notify the key
+    """
+
+    def __init__(self):
+        """
+        init
+        """
+        self.__listeners = {}
+        self.__lock = threading.Lock()
+
+    def add_listener(self, key, callback):
+        """
+        Call callback when the key is notified
+        """
+        with self.__lock:
+            self.__listeners.setdefault(key, []).append(callback)
+
+    def remove_listener(self, key, callback):
+        """
+        Remove a callback not yet called
+        """
+        with self.__lock:
+            callbacks = self.__listeners.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.__listeners.pop(key, None)
+
+    def pending(self):
+        """
+        Return the number of keys waited
+        """
+        with self.__lock:
+            return len(self.__listeners)
+
+    def notify(self, key):
+        """
+        Call and remove the callbacks waiting for the key
+        """
+        with self.__lock:
+            callbacks = self.__listeners.pop(key, [])
+        for callback in callbacks:
+            callback()
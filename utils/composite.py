@@ -0,0 +1,41 @@
+"""
+Composite helper, reduce the acquisitions of a zone to one scene, pixel by pixel
+"""
+
+import os
+import warnings
+import numpy as np
+
+COMPOSITE_MAX_DATES = int(os.getenv('WTMSE_COMPOSITE_MAX_DATES', 12))
+COMPOSITE_BLOCK_ROWS = int(os.getenv('WTMSE_COMPOSITE_BLOCK_ROWS', 256))
+DEFAULT_PERCENTILE = 50.
+
+
+def composite_dates(dates, max_dates=COMPOSITE_MAX_DATES):
+    """
+    Return the dates used by the composite, the most recent max_dates dates in chronological order
+    """
+    return sorted(set(dates))[-max_dates:] if max_dates > 0 else sorted(set(dates))
+
+
+def composite_block(stack, percentile=DEFAULT_PERCENTILE, nodata=0):
+    """
+    Return the percentile over the first axis of a (dates, rows, columns) block,
+    nodata values are ignored and pixels without data stay nodata
+    """
+    stack = stack.astype(np.float32)
+    stack[stack == nodata] = np.nan
+    with warnings.catch_warnings():
+        # pixels without data on all the dates
+        warnings.simplefilter("ignore", RuntimeWarning)
+        block = np.nanpercentile(stack, percentile, axis=0)
+    block[np.isnan(block)] = nodata
+    return block
+
+
+def composite_memory(dates_count, columns, rows_by_block=COMPOSITE_BLOCK_ROWS):
+    """
+    Return the estimated peak memory of composite_block for a block of rows:
+    the read block, its float32 copy and the sorted copy of the percentile
+    """
+    return dates_count * rows_by_block * columns * (2 + 4 + 4)
@@ -0,0 +1,129 @@
+"""
+Coverage mask, tell quickly if a tile can be produced by a generator
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from shapely.geometry import box
+from shapely.prepared import prep
+from utils.tms_helper import tiles_in_bbox, bbox_from_xyz
+from utils.file_lock import atomic_path
+
+LOGGER = logging.getLogger("wtmse")
+KNOWN_EMPTY_SIZE = int(os.getenv('WTMSE_KNOWN_EMPTY_TILES', 100000))
+
+
+class CoverageMask:
+    """
+    Coverage mask, a bitmap of the tiles covered by data at the base zoom level,
+    computed from the zones geometries. A tile of a deeper level is covered if its ancestor
+    at the base level is covered, tiles found empty by the generator are remembered in a bounded index.
+    While the bitmap is built in background every tile of the zoom levels is covered.
+    """
+
+    def __init__(self, min_zoom, max_zoom, base_zoom=None, known_empty_size=KNOWN_EMPTY_SIZE):
+        """
+        init
+        """
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.base_zoom = min_zoom if base_zoom is None else base_zoom
+        self.known_empty_size = known_empty_size
+        self.__size = 1 << self.base_zoom
+        self.__bitmap = bytearray((self.__size * self.__size + 7) // 8)
+        self.__known_empty = OrderedDict()
+        self.__lock = threading.Lock()
+        self.built = True
+
+    def add_bounds(self, lon_min, lat_min, lon_max, lat_max):
+        """
+        Mark the tiles intersecting the bounds as covered
+        """
+        for tms_x, tms_y in tiles_in_bbox(lon_min, lat_min, lon_max, lat_max, self.base_zoom):
+            self.__mark(tms_x, tms_y)
+
+    def add_geometry(self, geometry):
+        """
+        Mark the tiles intersecting the geometry as covered, not the whole bounds of the geometry
+        """
+        prepared = prep(geometry)
+        for tms_x, tms_y in tiles_in_bbox(*(geometry.bounds + (self.base_zoom,))):
+            corner, opposite = bbox_from_xyz(tms_x, tms_y, self.base_zoom)
+            if prepared.intersects(box(min(corner[0], opposite[0]), min(corner[1], opposite[1]),
+                                       max(corner[0], opposite[0]), max(corner[1], opposite[1]))):
+                self.__mark(tms_x, tms_y)
+
+    def build(self, geometries, cache_path=None):
+        """
+        Build the bitmap of the geometries aside and swap it, the bitmap is read from cache_path
+        when saved there by a previous build
+        """
+        bitmap = None
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as cache_file:
+                bitmap = bytearray(cache_file.read())
+            if len(bitmap) != len(self.__bitmap):
+                LOGGER.warning("Coverage bitmap %s ignored, not a bitmap of zoom %s", cache_path, self.base_zoom)
+                bitmap = None
+        if bitmap is None:
+            mask = CoverageMask(self.min_zoom, self.max_zoom, self.base_zoom)
+            for geometry in geometries:
+                mask.add_geometry(geometry)
+            bitmap = mask.__bitmap
+            if cache_path is not None:
+                try:
+                    with atomic_path(cache_path) as temporary_path:
+                        with open(temporary_path, 'wb') as cache_file:
+                            cache_file.write(bitmap)
+                except OSError as err:
+                    LOGGER.error("Impossible to write coverage bitmap %s: %s", cache_path, err)
+        with self.__lock:
+            self.__bitmap = bitmap
+            self.built = True
+
+    def build_in_background(self, geometries, cache_path=None):
+        """
+        Build the bitmap of the geometries in a background thread, return the thread
+        """
+        self.built = False
+
+        def build():
+            try:
+                self.build(geometries, cache_path)
+            except Exception as err:
+                LOGGER.exception("Impossible to build the coverage bitmap: %s", err)
+        thread = threading.Thread(target=build, daemon=True)
+        thread.start()
+        return thread
+
+    def __mark(self, tms_x, tms_y):
+        """
+        Mark the tile of the base level as covered
+        """
+        index = tms_y * self.__size + tms_x
+        self.__bitmap[index >> 3] |= 1 << (index & 7)
+
+    def mark_empty(self, tms_x, tms_y, tms_z):
+        """
+        Remember a tile which cannot be produced
+        """
+        with self.__lock:
+            self.__known_empty[(tms_x, tms_y, tms_z)] = True
+            while len(self.__known_empty) > self.known_empty_size:
+                self.__known_empty.popitem(last=False)
+
+    def covers(self, tms_x, tms_y, tms_z):
+        """
+        Return False if the tile is known to be empty
+        """
+        if tms_z < self.min_zoom or tms_z > self.max_zoom:
+            return False
+        if tms_x < 0 or tms_y < 0 or tms_x >= (1 << tms_z) or tms_y >= (1 << tms_z):
+            return False
+        shift = tms_z - self.base_zoom
+        index = (tms_y >> shift) * self.__size + (tms_x >> shift)
+        if self.built and not self.__bitmap[index >> 3] & (1 << (index & 7)):
+            return False
+        return (tms_x, tms_y, tms_z) not in self.__known_empty
@@ -9,4 +9,13 @@ class DataCannotBeComputed(Exception):
     pass
 class GeneratorNotFound(Exception):
     """Base class for all exceptions in storm engine"""
-    pass
\ No newline at end of file
+    pass
+class TileOutOfCoverage(DataCannotBeComputed):
+    """Tile outside the zoom levels or the area covered by the generator"""
+    pass
+class BadBatchRequest(Exception):
+    """Batch request which cannot be parsed"""
+    pass
+class InvalidExpression(DataCannotBeComputed):
+    """Band math expression, range or colormap which cannot be rendered"""
+    pass
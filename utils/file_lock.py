@@ -0,0 +1,208 @@
+"""
+File lock helper, coordinate the work between processes and nodes sharing the cache directory
+"""
+
+import os
+import time
+import json
+import uuid
+import errno
+import shutil
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger("wtmse")
+LEASE_TIMEOUT = float(os.getenv('WTMSE_LEASE_TIMEOUT', 120))
+LEASE_POLL_INTERVAL = float(os.getenv('WTMSE_LEASE_POLL_INTERVAL', 0.5))
+
+
+class FileLease:
+    """
+    File lease, own the work producing a path through a lock file created next to it.
+    The lease is kept alive by its owner, a lease not refreshed for timeout seconds
+    or owned by a dead process of the same host is stale and can be broken
+    """
+
+    def __init__(self, path, timeout=LEASE_TIMEOUT):
+        """
+        init
+        """
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        self.__keep_alive = None
+
+    def acquire(self):
+        """
+        Try to acquire the lease without waiting, return True if acquired
+        """
+        owner = json.dumps({"host": socket.gethostname(), "pid": os.getpid(),
+                            "token": self.token, "created": time.time()})
+        try:
+            lock_file = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            return False
+        with os.fdopen(lock_file, 'w') as lock:
+            lock.write(owner)
+        return True
+
+    def owner(self, lock_path=None):
+        """
+        Return the owner of the lease written in the lock file, None if the lease is free
+        """
+        try:
+            with open(lock_path or self.lock_path, 'r') as lock:
+                return json.loads(lock.read())
+        except (OSError, ValueError):
+            return None
+
+    def is_stale(self):
+        """
+        Return True if the lease is held by a dead owner
+        """
+        try:
+            refreshed = os.stat(self.lock_path).st_mtime
+        except OSError:
+            return False
+        if time.time() - refreshed > self.timeout:
+            return True
+        owner = self.owner()
+        if owner is None or owner.get("host") != socket.gethostname():
+            return False
+        try:
+            os.kill(owner["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def break_stale(self):
+        """
+        Remove the lock file of a stale lease, return True if removed.
+        The lock file is first moved aside: the lease may have been broken and acquired again since it was read,
+        the moved file is removed only if it is still the stale one, else it is put back
+        """
+        owner = self.owner()
+        if not self.is_stale():
+            return False
+        broken_path = temporary_path(self.lock_path)
+        try:
+            os.rename(self.lock_path, broken_path)
+        except OSError:
+            return False
+        try:
+            # an unreadable lock file is the stale one only if it was not refreshed either
+            still_stale = self.owner(broken_path) == owner and \
+                (owner is not None or time.time() - os.stat(broken_path).st_mtime > self.timeout)
+        except OSError:
+            still_stale = False
+        if not still_stale:
+            try:
+                # never replace a lock file created meanwhile
+                os.link(broken_path, self.lock_path)
+            except OSError as err:
+                LOGGER.error("Impossible to restore lease %s: %s", self.lock_path, err)
+            os.remove(broken_path)
+            return False
+        LOGGER.warning("Break stale lease %s owned by %s", self.lock_path, owner)
+        os.remove(broken_path)
+        return True
+
+    def refresh(self):
+        """
+        Show the owner is alive
+        """
+        try:
+            os.utime(self.lock_path, None)
+        except OSError:
+            pass
+
+    def release(self):
+        """
+        Release the lease if still owned
+        """
+        self.stop_keep_alive()
+        owner = self.owner()
+        if owner is not None and owner.get("token") == self.token:
+            try:
+                os.remove(self.lock_path)
+            except OSError:
+                pass
+
+    def start_keep_alive(self):
+        """
+        Refresh the lease in background until released
+        """
+        stop = threading.Event()
+
+        def keep_alive():
+            while not stop.wait(self.timeout / 3.):
+                self.refresh()
+        thread = threading.Thread(target=keep_alive, daemon=True)
+        thread.start()
+        self.__keep_alive = stop
+
+    def stop_keep_alive(self):
+        """
+        Stop the background refresh
+        """
+        if self.__keep_alive is not None:
+            self.__keep_alive.set()
+            self.__keep_alive = None
+
+
+def produce_once(path, produce, timeout=LEASE_TIMEOUT, poll_interval=LEASE_POLL_INTERVAL):
+    """
+    Produce the path once between all the processes sharing it:
+    the lease owner call produce, the others wait for the path or for a stale lease.
+    Return True if the path exists at the end
+    """
+    lease = FileLease(path, timeout)
+    while not os.path.exists(path):
+        if lease.acquire():
+            lease.start_keep_alive()
+            try:
+                if not os.path.exists(path):
+                    produce()
+            finally:
+                lease.release()
+            break
+        if not lease.break_stale():
+            time.sleep(poll_interval)
+            if not os.path.exists(lease.lock_path) and not os.path.exists(path):
+                LOGGER.debug("Lease %s released without %s", lease.lock_path, path)
+                break
+    return os.path.exists(path)
+
+
+def temporary_path(path):
+    """
+    Return a temporary path next to the path, with the same extension
+    """
+    directory, name = os.path.split(path)
+    extension = os.path.splitext(name)[1]
+    return os.path.join(directory, "." + name + "." + uuid.uuid4().hex + ".tmp" + extension)
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Give a temporary path to write, renamed to the path at the end of the with block,
+    the path is never seen partially written. The temporary path is removed on error
+    """
+    temporary = temporary_path(path)
+    try:
+        yield temporary
+        if os.path.exists(temporary):
+            os.replace(temporary, path)
+    finally:
+        if os.path.isdir(temporary):
+            shutil.rmtree(temporary, ignore_errors=True)
+        elif os.path.exists(temporary):
+            os.remove(temporary)
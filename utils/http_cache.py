@@ -0,0 +1,157 @@
+"""
+HTTP cache helper provide ETag and Cache-Control computation for served tiles
+"""
+
+import os
+import hashlib
+import threading
+import time
+from datetime import date
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+IMMUTABLE_MAX_AGE = int(os.getenv('WTMSE_IMMUTABLE_TILE_MAX_AGE', 365 * 24 * 3600))
+LATEST_MAX_AGE = int(os.getenv('WTMSE_LATEST_TILE_MAX_AGE', 3600))
+EMPTY_MAX_AGE = int(os.getenv('WTMSE_EMPTY_TILE_MAX_AGE', 24 * 3600))
+ETAG_INDEX_SIZE = int(os.getenv('WTMSE_ETAG_INDEX_SIZE', 100000))
+
+
+def request_key(generator_name, tms_x, tms_y, tms_z, arguments):
+    """
+    Return the key identifying a tile request
+    """
+    items = sorted((name, arguments.get(name)) for name in arguments)
+    return "{}/{}/{}/{}?{}".format(generator_name, tms_x, tms_y, tms_z, urlencode(items))
+
+
+def is_immutable(arguments):
+    """
+    A tile requested for a given date or a composite up to a past date never change,
+    without date the tile follow the last image of the zone
+    """
+    return 'date' in arguments or arguments.get('date_to', '99999999') < date.today().strftime('%Y%m%d')
+
+
+def max_age(arguments):
+    """
+    Return the max age of the tile in seconds
+    """
+    return IMMUTABLE_MAX_AGE if is_immutable(arguments) else LATEST_MAX_AGE
+
+
+def cache_control(arguments):
+    """
+    Return the Cache-Control header value for the tile
+    """
+    if is_immutable(arguments):
+        return "public, max-age={}, immutable".format(IMMUTABLE_MAX_AGE)
+    return "public, max-age={}".format(LATEST_MAX_AGE)
+
+
+def empty_cache_control():
+    """
+    Return the Cache-Control header value for a tile out of the generator coverage
+    """
+    return "public, max-age={}".format(EMPTY_MAX_AGE)
+
+
+def compute_etag(key, file_path):
+    """
+    Compute a strong ETag from the tile key and the tile content
+    """
+    digest = hashlib.sha1(key.encode("utf-8"))
+    with open(file_path, 'rb') as tile_file:
+        for chunk in iter(lambda: tile_file.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ETagEntry:
+    """
+    ETag entry, the validators of a served tile
+    """
+    def __init__(self, etag, file_path, last_modified, expires_at, size=None):
+        self.etag = etag
+        self.file_path = file_path
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+        self.size = size
+
+    def is_current(self):
+        """
+        Return True if the file is still the one the validators were computed for
+        """
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return False
+        return stat.st_mtime == self.last_modified and stat.st_size == self.size
+
+
+class ETagIndex:
+    """
+    ETag index keep the ETag of served tiles by request key,
+    it allows to answer conditional requests without the generator
+    """
+
+    def __init__(self, size=ETAG_INDEX_SIZE):
+        """
+        init
+        """
+        self.size = size
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the entry of the key, None if unknown or expired
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at is not None and entry.expires_at < time.time():
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return entry
+
+    def remove(self, key):
+        """
+        Forget the entry of the key
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def put(self, key, file_path, arguments):
+        """
+        Compute and store the validators of a tile, the ETag is computed only when the file changed
+        """
+        stat = os.stat(file_path)
+        entry = self.get(key)
+        if entry is None or entry.file_path != file_path or entry.last_modified != stat.st_mtime:
+            expires_at = None if is_immutable(arguments) else time.time() + LATEST_MAX_AGE
+            entry = ETagEntry(compute_etag(key, file_path), file_path, stat.st_mtime, expires_at, stat.st_size)
+            with self.__lock:
+                self.__entries[key] = entry
+                self.__entries.move_to_end(key)
+                while len(self.__entries) > self.size:
+                    self.__entries.popitem(last=False)
+        return entry
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Return True if the If-None-Match header value match the ETag
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
@@ -0,0 +1,89 @@
+"""
+Memory budget helper, admit the full scene operations against a memory budget in bytes
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from utils.metrics import REGISTRY
+
+LOGGER = logging.getLogger("wtmse")
+MEMORY_BUDGET_BYTES = int(os.getenv('WTMSE_MEMORY_BUDGET_BYTES', 4 * 1024 * 1024 * 1024))
+MEMORY_RESERVED = REGISTRY.gauge("wtmse_memory_reserved_bytes", "Memory reserved by the running scene operations")
+MEMORY_WAIT = REGISTRY.histogram("wtmse_memory_wait_seconds", "Time waited for the memory budget", ["stage"])
+
+
+class MemoryBudget:
+    """
+    Memory budget, a semaphore weighted in bytes.
+    Operations are admitted in order while their estimated peak memory fits in the budget,
+    an operation bigger than the budget is admitted alone. A budget of 0 admits everything
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET_BYTES):
+        """
+        init
+        """
+        self.budget = budget
+        self.__reserved = 0
+        self.__waiting = deque()
+        self.__condition = threading.Condition()
+
+    def reserved(self):
+        """
+        Return the bytes reserved by the admitted operations
+        """
+        with self.__condition:
+            return self.__reserved
+
+    def acquire(self, size):
+        """
+        Wait until the size fits in the budget and reserve it, return the reserved size
+        """
+        if self.budget <= 0:
+            return 0
+        size = max(0, min(int(size), self.budget))
+        ticket = object()
+        with self.__condition:
+            self.__waiting.append(ticket)
+            while self.__waiting[0] is not ticket or self.__reserved + size > self.budget:
+                self.__condition.wait()
+            self.__waiting.popleft()
+            self.__reserved = self.__reserved + size
+            # the next operation may fit in what is left
+            self.__condition.notify_all()
+        MEMORY_RESERVED.inc(size)
+        return size
+
+    def release(self, size):
+        """
+        Give back a size reserved by acquire
+        """
+        if size <= 0:
+            return
+        with self.__condition:
+            self.__reserved = self.__reserved - size
+            self.__condition.notify_all()
+        MEMORY_RESERVED.dec(size)
+
+    @contextmanager
+    def reserve(self, size, stage):
+        """
+        Reserve the estimated peak memory of a stage for the duration of the with block
+        """
+        start = time.time()
+        reserved = self.acquire(size)
+        waited = time.time() - start
+        MEMORY_WAIT.observe(waited, stage=stage)
+        if waited > 1.:
+            LOGGER.info("Stage %s waited %.1fs for %s bytes of memory", stage, waited, size)
+        try:
+            yield reserved
+        finally:
+            self.release(reserved)
+
+
+MEMORY_BUDGET = MemoryBudget()
@@ -0,0 +1,277 @@
+"""
+Metrics helper, collect counters, gauges and histograms
+and render them in the Prometheus text format
+"""
+
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300., 600.)
+
+
+def format_labels(label_names, label_values, extra=None):
+    """
+    Return the labels string of a sample
+    """
+    labels = list(zip(label_names, label_values))
+    if extra is not None:
+        labels.append(extra)
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in labels) + "}"
+
+
+def format_value(value):
+    """
+    Return the sample value string
+    """
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Metric base class, hold the samples by labels values
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        """
+        init
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        """
+        Return the labels values tuple
+        """
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self):
+        """
+        Return the list of (name, labels string, value)
+        """
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, format_labels(self.label_names, key), value) for key, value in sorted(values)]
+
+    def render(self):
+        """
+        Render the metric in Prometheus text format
+        """
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, labels, format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Counter, a value which only increase
+    """
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase the counter
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """
+        Return the counter value
+        """
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    Gauge, a value which can go up and down,
+    or which is read from a function when rendered
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), function=None):
+        """
+        init
+        """
+        Metric.__init__(self, name, documentation, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        """
+        Set the gauge value
+        """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase the gauge
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """
+        Decrease the gauge
+        """
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        """
+        Increase the gauge during the with block
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, "", self.function())]
+        return Metric.samples(self)
+
+
+class Histogram(Metric):
+    """
+    Histogram, count observations in buckets
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        init
+        """
+        Metric.__init__(self, name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """
+        Add an observation
+        """
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] = counts[index] + 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, (counts, total) in sorted(values):
+            for bound, count in zip(self.buckets, counts):
+                labels = format_labels(self.label_names, key, ("le", format_value(bound)))
+                samples.append((self.name + "_bucket", labels, count))
+            labels = format_labels(self.label_names, key)
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, counts[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Metrics registry, keep the metrics by name
+    """
+
+    def __init__(self):
+        """
+        init
+        """
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def __register(self, metric_class, name, *args, **kwargs):
+        """
+        Return the metric of the given name, create it if needed
+        """
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = metric_class(name, *args, **kwargs)
+            return self.__metrics[name]
+
+    def counter(self, name, documentation, label_names=()):
+        """
+        Return the counter of the given name
+        """
+        return self.__register(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=(), function=None):
+        """
+        Return the gauge of the given name
+        """
+        return self.__register(Gauge, name, documentation, label_names, function)
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        Return the histogram of the given name
+        """
+        return self.__register(Histogram, name, documentation, label_names, buckets)
+
+    def render(self):
+        """
+        Render all the metrics in Prometheus text format
+        """
+        with self.__lock:
+            metrics = [self.__metrics[name] for name in sorted(self.__metrics)]
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_DURATION = REGISTRY.histogram("wtmse_stage_duration_seconds", "Duration of the pipeline stages", ["stage"])
+STAGE_ERRORS = REGISTRY.counter("wtmse_stage_errors_total", "Errors raised by the pipeline stages", ["stage"])
+STAGE_IN_PROGRESS = REGISTRY.gauge("wtmse_stage_in_progress", "Pipeline stages in progress", ["stage"])
+HTTP_IN_FLIGHT = REGISTRY.gauge("wtmse_http_requests_in_flight", "HTTP requests in progress")
+HTTP_RESPONSES = REGISTRY.counter("wtmse_http_responses_total", "HTTP responses sent", ["status"])
+HTTP_DURATION = REGISTRY.histogram("wtmse_http_request_duration_seconds", "HTTP requests duration")
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Time the with block as the given pipeline stage
+    """
+    start = time.time()
+    STAGE_IN_PROGRESS.inc(stage=stage)
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_IN_PROGRESS.dec(stage=stage)
+        STAGE_DURATION.observe(time.time() - start, stage=stage)
+
+
+def timed(stage):
+    """
+    Decorator timing the function as the given pipeline stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
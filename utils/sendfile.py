@@ -0,0 +1,28 @@
+"""
+Sendfile helper, let the front end proxy stream the cached files
+instead of reading them in python
+"""
+
+import os
+import tempfile
+from urllib.parse import quote
+
+# '' to stream the file from the server, 'x-sendfile' or 'x-accel-redirect' to let the proxy stream it
+SENDFILE_MODE = os.getenv('WTMSE_SENDFILE_MODE', '').lower()
+ACCEL_REDIRECT_PREFIX = os.getenv('WTMSE_ACCEL_REDIRECT_PREFIX', '/wtmse-cache/')
+ACCEL_REDIRECT_ROOT = os.getenv('WTMSE_ACCEL_REDIRECT_ROOT', tempfile.gettempdir())
+
+
+def offload_headers(file_path):
+    """
+    Return the headers asking the front end proxy to stream the file,
+    None if the file shall be streamed by the server
+    """
+    if SENDFILE_MODE == 'x-accel-redirect':
+        relative_path = os.path.relpath(file_path, ACCEL_REDIRECT_ROOT)
+        if relative_path.startswith(os.pardir):
+            return None
+        return {'X-Accel-Redirect': ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relative_path.replace(os.sep, '/'))}
+    if SENDFILE_MODE == 'x-sendfile':
+        return {'X-Sendfile': file_path}
+    return None
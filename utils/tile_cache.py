@@ -0,0 +1,109 @@
+"""
+Hot tile cache, keep the bytes of the most requested tiles in memory
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from utils.http_cache import is_immutable, LATEST_MAX_AGE
+from utils.metrics import REGISTRY
+from utils.tile_format import mimetype_for_path
+
+HOT_CACHE_BYTES = int(os.getenv('WTMSE_HOT_CACHE_BYTES', 64 * 1024 * 1024))
+HOT_CACHE_MAX_TILE_BYTES = int(os.getenv('WTMSE_HOT_CACHE_MAX_TILE_BYTES', 1024 * 1024))
+HOT_CACHE_REQUESTS = REGISTRY.counter("wtmse_hot_tile_cache_total", "Tiles requests answered by the hot tile cache",
+                                      ["result"])
+HOT_CACHE_SIZE = REGISTRY.gauge("wtmse_hot_tile_cache_bytes", "Bytes of the tiles in the hot tile caches")
+
+
+class HotTile:
+    """
+    HotTile, the bytes and validators of a tile kept in memory with the ETag entry of its file
+    """
+    def __init__(self, body, etag, last_modified, expires_at, content_type="image/png", entry=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+        self.content_type = content_type
+        self.entry = entry
+
+
+class HotTileCache:
+    """
+    Hot tile cache, LRU of tiles bytes by request key bounded by a memory budget,
+    tiles of the last image of a zone expire as their HTTP cache max age
+    and tiles whose file was rendered again or replaced are dropped
+    """
+
+    def __init__(self, budget=HOT_CACHE_BYTES, max_tile_size=HOT_CACHE_MAX_TILE_BYTES):
+        """
+        init
+        """
+        self.budget = budget
+        self.max_tile_size = max_tile_size
+        self.__tiles = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def size(self):
+        """
+        Return the bytes used by the cached tiles
+        """
+        return self.__size
+
+    def get(self, key):
+        """
+        Return the tile of the key, None if not cached, expired or if its file changed
+        """
+        with self.__lock:
+            tile = self.__tiles.get(key)
+            if tile is not None and tile.expires_at is not None and tile.expires_at < time.time():
+                self.__remove(key)
+                tile = None
+        # the file is checked out of the lock, the other requests do not wait for the stat
+        if tile is not None and tile.entry is not None and not tile.entry.is_current():
+            with self.__lock:
+                if self.__tiles.get(key) is tile:
+                    self.__remove(key)
+            tile = None
+        if tile is not None:
+            with self.__lock:
+                if key in self.__tiles:
+                    self.__tiles.move_to_end(key)
+        HOT_CACHE_REQUESTS.inc(result="miss" if tile is None else "hit")
+        return tile
+
+    def put(self, key, entry, arguments):
+        """
+        Keep the tile of an ETag entry in memory, return the cached tile, None if not cacheable
+        """
+        if self.budget <= 0 or entry.size is None or entry.size > min(self.max_tile_size, self.budget):
+            return None
+        try:
+            with open(entry.file_path, 'rb') as tile_file:
+                body = tile_file.read()
+        except OSError:
+            return None
+        if len(body) != entry.size or not entry.is_current():
+            return None
+        expires_at = None if is_immutable(arguments) else time.time() + LATEST_MAX_AGE
+        tile = HotTile(body, entry.etag, entry.last_modified, expires_at, mimetype_for_path(entry.file_path), entry)
+        with self.__lock:
+            if key in self.__tiles:
+                self.__remove(key)
+            self.__tiles[key] = tile
+            self.__size = self.__size + len(body)
+            HOT_CACHE_SIZE.inc(len(body))
+            while self.__size > self.budget:
+                self.__remove(next(iter(self.__tiles)))
+        return tile
+
+    def __remove(self, key):
+        """
+        Remove a tile, the lock shall be held
+        """
+        tile = self.__tiles.pop(key)
+        self.__size = self.__size - len(tile.body)
+        HOT_CACHE_SIZE.dec(len(tile.body))
@@ -0,0 +1,66 @@
+"""
+Tile format helper, negotiate the tile format from the route extension or the Accept header
+"""
+
+import os
+
+DEFAULT_FORMAT = "png"
+# formats by server preference when the client accept several of them with the same quality
+TILE_FORMATS = ("webp", "png", "jpg")
+MIMETYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+EXTENSIONS = {"png": "png", "jpg": "jpg", "jpeg": "jpg", "webp": "webp"}
+
+
+def format_from_extension(extension):
+    """
+    Return the tile format of a route extension, None if not supported
+    """
+    return EXTENSIONS.get(extension.lower())
+
+
+def format_from_accept(accept_header, formats=TILE_FORMATS):
+    """
+    Return the tile format preferred by the client among the given formats ordered by server preference,
+    only formats listed explicitly in the Accept header are chosen, the default format otherwise
+    """
+    best_format = DEFAULT_FORMAT if DEFAULT_FORMAT in formats else formats[0]
+    best_quality = 0.
+    for media_range in (accept_header or "").split(','):
+        parameters = media_range.strip().split(';')
+        media_type = parameters[0].strip().lower()
+        quality = 1.
+        for parameter in parameters[1:]:
+            name, _, value = parameter.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        for tile_format in formats:
+            if MIMETYPES[tile_format] != media_type or quality <= 0.:
+                continue
+            if quality > best_quality or \
+                    (quality == best_quality and formats.index(tile_format) < formats.index(best_format)):
+                best_format = tile_format
+                best_quality = quality
+    return best_format
+
+
+def negotiate_format(extension, requested_format, accept_header, supported_formats):
+    """
+    Return the tile format from the route extension, else from the format argument,
+    else from the Accept header. None if the extension or the format argument is not supported
+    """
+    formats = tuple(tile_format for tile_format in TILE_FORMATS if tile_format in supported_formats)
+    if extension is not None or requested_format is not None:
+        tile_format = format_from_extension(extension if extension is not None else requested_format)
+        return tile_format if tile_format in formats else None
+    return format_from_accept(accept_header, formats)
+
+
+def mimetype_for_path(file_path):
+    """
+    Return the mimetype of a tile file from its extension
+    """
+    extension = os.path.splitext(file_path)[1][1:]
+    return MIMETYPES.get(format_from_extension(extension) or DEFAULT_FORMAT)
@@ -5,13 +5,13 @@ TMS helper provide a function helper to compute bbox from tms_x,tms_y,tms_z data
 import math
 
 
-def bbox_from_xyz(tms_x, tms_y, tms_z):
+def mercator_bbox_from_xyz(tms_x, tms_y, tms_z):
     """
-    bbox_from_xyz, return bbox from tms_x, tms_y, tms_z data
+    mercator_bbox_from_xyz, return the bbox in web mercator meters from tms_x, tms_y, tms_z data
     :param tms_x: tms_x in TMS format
     :param tms_y: tms_y in TMS format
     :param tms_z: tms_z in TMS format
-    :return bbox: bbox as a tab
+    :return bbox: bbox as a tab [[x_min, y_min], [x_max, y_max]]
     """
     tile_size = 256
     zoom_zero_resolution = 2 * math.pi * 6378137 / tile_size
@@ -25,11 +25,20 @@ def bbox_from_xyz(tms_x, tms_y, tms_z):
         """
         return meter_by_pixels * (index * tile_size) - origin
 
-    x_min = tile_index_to_meter(tms_x)
-    y_min = tile_index_to_meter(tms_y)
+    return [[tile_index_to_meter(tms_x), tile_index_to_meter(tms_y)],
+            [tile_index_to_meter(tms_x + 1), tile_index_to_meter(tms_y + 1)]]
 
-    x_max = tile_index_to_meter(tms_x + 1)
-    y_max = tile_index_to_meter(tms_y + 1)
+
+def bbox_from_xyz(tms_x, tms_y, tms_z):
+    """
+    bbox_from_xyz, return bbox from tms_x, tms_y, tms_z data
+    :param tms_x: tms_x in TMS format
+    :param tms_y: tms_y in TMS format
+    :param tms_z: tms_z in TMS format
+    :return bbox: bbox as a tab
+    """
+    origin = 2 * math.pi * 6378137 / 2.0
+    (x_min, y_min), (x_max, y_max) = mercator_bbox_from_xyz(tms_x, tms_y, tms_z)
 
     def meter_to_lat_lon(x_meter, y_meter):
         """
@@ -46,6 +55,37 @@ def bbox_from_xyz(tms_x, tms_y, tms_z):
     return bounding_box
 
 
+def xyz_from_lon_lat(longitude, latitude, tms_z):
+    """
+    xyz_from_lon_lat, return the tile containing the given lon/lat,
+    inverse of bbox_from_xyz
+    :param longitude: longitude in degrees
+    :param latitude: latitude in degrees
+    :param tms_z: tms_z in TMS format
+    :return (tms_x, tms_y): tile coordinates in the same format as bbox_from_xyz
+    """
+    tiles_count = 1 << tms_z
+    latitude = max(-85.0511, min(85.0511, latitude))
+    lat_rad = math.radians(latitude)
+    tms_x = int((longitude + 180.0) / 360.0 * tiles_count)
+    tms_y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * tiles_count)
+    tms_x = max(0, min(tiles_count - 1, tms_x))
+    tms_y = max(0, min(tiles_count - 1, tms_y))
+    return tms_x, tms_y
+
+
+def tiles_in_bbox(lon_min, lat_min, lon_max, lat_max, tms_z):
+    """
+    tiles_in_bbox, yield every tile of the level tms_z intersecting the bbox
+    :return generator of (tms_x, tms_y)
+    """
+    x_min, y_min = xyz_from_lon_lat(lon_min, lat_max, tms_z)
+    x_max, y_max = xyz_from_lon_lat(lon_max, lat_min, tms_z)
+    for tms_x in range(x_min, x_max + 1):
+        for tms_y in range(y_min, y_max + 1):
+            yield tms_x, tms_y
+
+
 if __name__ == '__main__':
     print(bbox_from_xyz(16540.0, 11963.0, 15))  # 1.71410,43.61998
     print(bbox_from_xyz(16540.0, 11964.0, 15))  # 1.71410,43.61998
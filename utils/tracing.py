@@ -0,0 +1,196 @@
+"""
+Tracing helper, follow a tile request through the producers queues
+with queue wait and execution spans, log the slow requests and profile the render path on demand
+"""
+
+import os
+import re
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from utils.metrics import REGISTRY
+
+LOGGER = logging.getLogger("wtmse")
+TRACE_SLOW_SECONDS = float(os.getenv('WTMSE_TRACE_SLOW_SECONDS', 5))
+PROFILE_REQUESTS = os.getenv('WTMSE_PROFILE_REQUESTS', '').lower() in ('1', 'true', 'yes')
+PROFILE_SAMPLE_RATE = float(os.getenv('WTMSE_PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('WTMSE_PROFILE_DIR', os.path.join(tempfile.gettempdir(), "wtmse_profiles"))
+TRACE_ID = re.compile(r'^[0-9A-Za-z_-]{1,64}$')
+QUEUE_WAIT = REGISTRY.histogram("wtmse_queue_wait_seconds", "Time waited by the requested tiles in the producers queues",
+                                ["queue"])
+SLOW_REQUESTS = REGISTRY.counter("wtmse_slow_requests_total", "Tile requests slower than the slow request threshold")
+# one profiler at a time, the profilers of the python versions using sys.monitoring are not per thread
+PROFILE_LOCK = threading.Lock()
+
+
+class Trace:
+    """
+    Trace of a tile request, identified by its trace id and carried by the tile through the producers.
+    Spans are (name, start, duration) recorded by the threads handling the request,
+    a profiled trace profiles the producers stages and dumps the pstats when finished,
+    a stage ending after the request is finished adds its profile to the dump
+    """
+
+    def __init__(self, trace_id=None, profile=False, profile_dir=PROFILE_DIR):
+        """
+        init
+        """
+        self.trace_id = trace_id if trace_id is not None and TRACE_ID.match(trace_id) else uuid.uuid4().hex[:16]
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.start = time.time()
+        self.errors = []
+        self.finished = False
+        self.__spans = []
+        self.__queued = {}
+        self.__profiles = []
+        self.__lock = threading.Lock()
+
+    def add_span(self, name, start, end):
+        """
+        Record a span of the request
+        """
+        with self.__lock:
+            self.__spans.append((name, start, end - start))
+
+    def spans(self):
+        """
+        Return the spans in start order
+        """
+        with self.__lock:
+            return sorted(self.__spans, key=lambda span: span[1])
+
+    @contextmanager
+    def span(self, name, profiled=False):
+        """
+        Record the with block as a span, profile it when profiled and the trace is profiled
+        """
+        start = time.time()
+        profiler = self.__start_profiler() if profiled and self.profile else None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                PROFILE_LOCK.release()
+                with self.__lock:
+                    self.__profiles.append(profiler)
+                    finished = self.finished
+                if finished:
+                    self.dump_profile()
+            self.add_span(name, start, time.time())
+
+    def __start_profiler(self):
+        """
+        Return a started profiler, None if another trace is being profiled
+        """
+        if not PROFILE_LOCK.acquire(False):
+            LOGGER.debug("Trace %s not profiled, another profile is running", self.trace_id)
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as err:
+            PROFILE_LOCK.release()
+            LOGGER.debug("Trace %s not profiled: %s", self.trace_id, err)
+            return None
+        return profiler
+
+    def queued(self, queue):
+        """
+        The request entered the queue
+        """
+        with self.__lock:
+            self.__queued[queue] = time.time()
+
+    def dequeued(self, queue):
+        """
+        The request left the queue, record its wait
+        """
+        end = time.time()
+        with self.__lock:
+            start = self.__queued.pop(queue, None)
+        if start is not None:
+            self.add_span("queue_" + queue, start, end)
+            QUEUE_WAIT.observe(end - start, queue=queue)
+
+    def error(self, stage, err):
+        """
+        Record an error raised by a stage of the request
+        """
+        with self.__lock:
+            self.errors.append("{}: {!r}".format(stage, err))
+
+    def breakdown(self):
+        """
+        Return the spans as text, each span with its start offset from the request start
+        """
+        return ", ".join("{} {:.3f}s (+{:.3f}s)".format(name, duration, start - self.start)
+                         for name, start, duration in self.spans())
+
+    def finish(self, description, slow_seconds=TRACE_SLOW_SECONDS):
+        """
+        End of the request, log it when slow or failed and dump its profile, return its duration
+        """
+        duration = time.time() - self.start
+        with self.__lock:
+            self.finished = True
+        if self.errors:
+            LOGGER.error("Trace %s %s failed after %.3fs: %s, errors: %s",
+                         self.trace_id, description, duration, self.breakdown(), "; ".join(self.errors))
+        elif duration > slow_seconds:
+            SLOW_REQUESTS.inc()
+            LOGGER.warning("Trace %s %s slow, %.3fs: %s", self.trace_id, description, duration, self.breakdown())
+        elif LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Trace %s %s %.3fs: %s", self.trace_id, description, duration, self.breakdown())
+        self.dump_profile()
+        return duration
+
+    def dump_profile(self):
+        """
+        Write the profiles of the trace in one pstats file named by the trace id, return its path,
+        the profiles already dumped for the trace are kept
+        """
+        with self.__lock:
+            profiles, self.__profiles = self.__profiles, []
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profiler in profiles[1:]:
+            stats.add(profiler)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, self.trace_id + ".pstats")
+        if os.path.isfile(path):
+            stats.add(path)
+        stats.dump_stats(path)
+        LOGGER.info("Profile of trace %s written to %s", self.trace_id, path)
+        return path
+
+
+def new_trace(trace_id=None, profile_argument=None, sample_rate=PROFILE_SAMPLE_RATE, profile_requests=PROFILE_REQUESTS):
+    """
+    Return the trace of a new request, the trace id of the client is kept when valid.
+    The request is profiled when it asks it with profile=1 and the profile requests are allowed,
+    or when sampled
+    """
+    profile = (profile_requests and profile_argument in ('1', 'true', 'yes')) or \
+        (sample_rate > 0 and random.random() < sample_rate)
+    return Trace(trace_id, profile)
+
+
+@contextmanager
+def span(trace, name, profiled=False):
+    """
+    Record the with block as a span of the trace, nothing is recorded without trace
+    """
+    if trace is None:
+        yield
+        return
+    with trace.span(name, profiled):
+        yield
@@ -4,39 +4,202 @@ wtmse, worst tms ever is a TMS server which handle TMS generator.
 TMS generator, generates tiles to serve the data at the client.
 """
 
+import os
+import time
+import queue
 import logging
 from flask import Flask
+from flask import Response
 from flask import send_file
 from flask import request
 from flask import abort
+from flask import g
+from werkzeug.wsgi import wrap_file
 from generator.generator_factory import GeneratorFactory
-from utils.exception import DataCannotBeComputed, DataNotYetReady, GeneratorNotFound
+from utils.exception import DataCannotBeComputed, DataNotYetReady, GeneratorNotFound, TileOutOfCoverage, BadBatchRequest
+from utils.http_cache import ETagIndex, request_key, cache_control, empty_cache_control
+from utils.sendfile import offload_headers
+from utils.tile_cache import HotTileCache
+from utils.tile_format import negotiate_format, mimetype_for_path
+from utils.batch import BatchJob, parse_batch_request, new_boundary, multipart_content_type, result_part, multipart_end
+from utils.batch import BATCH_MAXIMUM_WAIT, BATCH_POLL_INTERVAL
+from utils.metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE, HTTP_IN_FLIGHT, HTTP_RESPONSES, HTTP_DURATION
+from utils.tracing import new_trace
 
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv('WTMSE_LOG_LEVEL', 'INFO').upper())
 LOGGER = logging.getLogger("wtmse")
 APP = Flask(__name__)
+ETAG_INDEX = ETagIndex()
+HOT_CACHE = HotTileCache()
+
+
+@APP.before_request
+def start_request_metrics():
+    """
+    Count the request in progress
+    """
+    g.request_start = time.time()
+    HTTP_IN_FLIGHT.inc()
+
+
+@APP.after_request
+def record_request_metrics(response):
+    """
+    Record the request duration and its status
+    """
+    HTTP_RESPONSES.inc(status=response.status_code)
+    HTTP_DURATION.observe(time.time() - g.request_start)
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers['X-Trace-Id'] = trace.trace_id
+        trace.finish(request.path)
+    return response
+
+
+@APP.teardown_request
+def end_request_metrics(exception):
+    """
+    The request is not in progress anymore
+    """
+    HTTP_IN_FLIGHT.dec()
+
+
+@APP.route('/metrics', methods=['GET'])
+def get_metrics_handler():
+    """
+    Expose the metrics in Prometheus text format
+    """
+    return Response(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def not_modified_response(etag, arguments):
+    """
+    Return a 304 response for the given ETag
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control(arguments)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+
+def empty_tile_response():
+    """
+    Return the cacheable 404 response of a tile out of the generator coverage
+    """
+    response = Response(status=404)
+    response.headers['Cache-Control'] = empty_cache_control()
+    return response
+
+
+def file_response(entry, arguments):
+    """
+    Return the tile file response, the file is streamed by the front end proxy
+    when configured, else by the WSGI server file wrapper (sendfile when supported)
+    """
+    mimetype = mimetype_for_path(entry.file_path)
+    headers = offload_headers(entry.file_path)
+    if headers is not None:
+        response = Response(mimetype=mimetype, headers=headers)
+    else:
+        tile_file = open(entry.file_path, 'rb')
+        response = Response(wrap_file(request.environ, tile_file), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = entry.size
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.headers['Cache-Control'] = cache_control(arguments)
+    response.headers['Vary'] = 'Accept'
+    return response.make_conditional(request)
+
+
+def hot_tile_response(hot_tile, arguments):
+    """
+    Return the response of a tile kept in memory
+    """
+    response = Response(hot_tile.body, mimetype=hot_tile.content_type)
+    response.set_etag(hot_tile.etag)
+    response.last_modified = hot_tile.last_modified
+    response.headers['Cache-Control'] = cache_control(arguments)
+    response.headers['Vary'] = 'Accept'
+    return response.make_conditional(request)
+
+
+def entry_response(key, entry, arguments):
+    """
+    Return the response of a tile file, keep the tile in memory when it fits in the hot cache
+    """
+    hot_tile = HOT_CACHE.put(key, entry, arguments)
+    if hot_tile is not None:
+        return hot_tile_response(hot_tile, arguments)
+    return file_response(entry, arguments)
+
+
+def tile_response(key, tile, arguments):
+    """
+    Return the tile response with its validators,
+    answer 304 if the client already have the tile
+    """
+    return entry_response(key, ETAG_INDEX.put(key, tile, arguments), arguments)
+
+
+def cached_tile_response(key, arguments):
+    """
+    Return the response of a tile already served and still in the cache,
+    None if the generator is needed
+    """
+    hot_tile = HOT_CACHE.get(key)
+    if hot_tile is not None:
+        return hot_tile_response(hot_tile, arguments)
+    entry = ETAG_INDEX.get(key)
+    if entry is None:
+        return None
+    # a tile rendered again has a new ETag, the client copy is not current anymore
+    if not entry.is_current():
+        ETAG_INDEX.remove(key)
+        return None
+    if entry.etag in request.if_none_match:
+        return not_modified_response(entry.etag, arguments)
+    return entry_response(key, entry, arguments)
+
 
 @APP.route('/<string:generator_name>/<int:x_coordinate>/<int:y_coordinate>/<int:z_coordinate>', methods=['GET'])
-def get_request_handler(generator_name, x_coordinate, y_coordinate, z_coordinate):
+@APP.route('/<string:generator_name>/<int:x_coordinate>/<int:y_coordinate>/<int:z_coordinate>.<string:extension>',
+           methods=['GET'])
+def get_request_handler(generator_name, x_coordinate, y_coordinate, z_coordinate, extension=None):
     """
     Handle TMS request and dispatch it between generators.
+    The tile format comes from the route extension, the format argument or the Accept header
     """
-    LOGGER.debug("Data requested for:")
-    LOGGER.debug("X coordinate  : %s", x_coordinate)
-    LOGGER.debug("Y coordinate  : %s", y_coordinate)
-    LOGGER.debug("Z coordinate  : %s", z_coordinate)
-    LOGGER.debug("Generator name: %s", generator_name)
-    LOGGER.debug("Request args  : %s", request.args)
+    trace = g.trace = new_trace(request.headers.get('X-Trace-Id'), request.args.get('profile'))
     try:
         generator = GeneratorFactory.get_instance().build_generator(generator_name)
     except GeneratorNotFound as err:
-        LOGGER.error("Impossible to find generator", generator_name)
+        LOGGER.error("Impossible to find generator %s", generator_name)
+        return abort(404)
+    tile_format = negotiate_format(extension, request.args.get('format'), request.headers.get('Accept'),
+                                   generator.TILE_FORMATS)
+    if tile_format is None:
         return abort(404)
+    arguments = request.args.to_dict()
+    arguments['format'] = tile_format
+    arguments = generator.canonical_arguments(arguments)
+    key = request_key(generator_name, x_coordinate, y_coordinate, z_coordinate, arguments)
+    response = cached_tile_response(key, arguments)
+    if response is not None:
+        return response
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("Data requested for: generator %s x %s y %s z %s args %s",
+                     generator_name, x_coordinate, y_coordinate, z_coordinate, arguments)
+    if generator.is_tile_empty(x_coordinate, y_coordinate, z_coordinate):
+        return empty_tile_response()
     try:
-        tile = generator.generate_tile(x_coordinate, y_coordinate, z_coordinate, request.args)
+        tile = generator.generate_tile(x_coordinate, y_coordinate, z_coordinate, arguments, trace)
         LOGGER.debug("File found, file %s", tile)
-        return send_file(tile, mimetype='image/png')
+        return tile_response(key, tile, arguments)
+    except TileOutOfCoverage as err:
+        LOGGER.debug("Tile out of coverage: %s", err)
+        return empty_tile_response()
     except DataCannotBeComputed as err:
         tile = generator.get_error_file()
         LOGGER.debug("File cannot be found, return error file %s", tile)
@@ -44,11 +207,57 @@ def get_request_handler(generator_name, x_coordinate, y_coordinate, z_coordinate
     except DataNotYetReady as err:
         tile = generator.get_data_not_yet_ready_file()
         LOGGER.debug("File not yet ready, return error file %s", tile)
-        return send_file(tile, mimetype='image/png', cache_timeout=10)
+        response = send_file(tile, mimetype='image/png', cache_timeout=10)
+        response.headers['X-WTMSE-Status'] = 'not-ready'
+        return response
     except Exception as err:
+        LOGGER.exception("Something wrong happen during tile request, trace %s", trace.trace_id)
+        trace.error("request", err)
+        return abort(404)
+
+
+@APP.route('/<string:generator_name>/batch', methods=['POST'])
+def post_batch_handler(generator_name):
+    """
+    Handle a batch of TMS requests, tiles are streamed in a multipart response in completion order
+    """
+    try:
+        tiles, arguments = parse_batch_request(request.get_data(), request.args)
+    except BadBatchRequest as err:
+        return Response(str(err), status=400, mimetype='text/plain')
+    try:
+        generator = GeneratorFactory.get_instance().build_generator(generator_name)
+    except GeneratorNotFound as err:
+        LOGGER.error("Impossible to find generator %s", generator_name)
         return abort(404)
+    try:
+        job = BatchJob(generator, tiles, arguments)
+    except BadBatchRequest as err:
+        return Response(str(err), status=400, mimetype='text/plain')
+    LOGGER.debug("Batch of %s tiles requested for generator %s args %s", len(tiles), generator_name, job.arguments)
+    boundary = new_boundary()
+
+    def stream():
+        done = queue.Queue()
+        try:
+            for result in job.schedule(done.put):
+                yield result_part(boundary, generator_name, result)
+            deadline = time.time() + BATCH_MAXIMUM_WAIT
+            while job.pending() and time.time() < deadline:
+                try:
+                    results = job.complete(done.get(timeout=max(0, min(BATCH_POLL_INTERVAL, deadline - time.time()))))
+                except queue.Empty:
+                    results = job.poll()
+                for result in results:
+                    yield result_part(boundary, generator_name, result)
+            for result in job.remaining():
+                yield result_part(boundary, generator_name, result)
+            yield multipart_end(boundary)
+        finally:
+            job.close()
+
+    return Response(stream(), content_type=multipart_content_type(boundary))
 
 
 if __name__ == '__main__':
-    LOGGER.setLevel(logging.DEBUG)
     APP.run(host= '0.0.0.0')
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+"""
+wtmse asgi, asyncio serving mode of the worst tms ever.
+Requests waiting for a tile are coroutines, they don't hold a thread,
+generator calls are dispatched to the event loop executor.
+Serve it with any ASGI server: uvicorn wtmse_asgi:APP
+"""
+
+import os
+import re
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qsl
+from generator.generator_factory import GeneratorFactory
+from utils.exception import DataCannotBeComputed, GeneratorNotFound, TileOutOfCoverage, BadBatchRequest
+from utils.http_cache import ETagIndex, request_key, cache_control, empty_cache_control, etag_matches
+from utils.sendfile import offload_headers
+from utils.tile_cache import HotTileCache
+from utils.tile_format import negotiate_format, mimetype_for_path
+from utils.batch import BatchJob, parse_batch_request, new_boundary, multipart_content_type, result_part, multipart_end
+from utils.batch import BATCH_MAXIMUM_WAIT, BATCH_POLL_INTERVAL
+from utils.metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE, HTTP_IN_FLIGHT, HTTP_RESPONSES, HTTP_DURATION
+from utils.tracing import new_trace, span
+
+
+logging.basicConfig(level=os.getenv('WTMSE_LOG_LEVEL', 'INFO').upper())
+LOGGER = logging.getLogger("wtmse")
+TILE_ROUTE = re.compile(r'^/([^/]+)/(\d+)/(\d+)/(\d+)(?:\.(\w+))?$')
+BATCH_ROUTE = re.compile(r'^/([^/]+)/batch$')
+MAXIMUM_WAIT = float(os.getenv('WTMSE_ASYNC_MAXIMUM_WAIT', 60))
+POLL_INTERVAL = float(os.getenv('WTMSE_ASYNC_POLL_INTERVAL', 5))
+NOT_YET_READY_MAX_AGE = 10
+ETAG_INDEX = ETagIndex()
+HOT_CACHE = HotTileCache()
+
+
+def request_headers(scope):
+    """
+    Return the request headers by lower case name
+    """
+    return dict((name.decode('latin-1').lower(), value.decode('latin-1')) for name, value in scope['headers'])
+
+
+def read_file(file_path):
+    """
+    Read the whole file
+    """
+    with open(file_path, 'rb') as tile_file:
+        return tile_file.read()
+
+
+async def send_response_start(send, status, content_length, headers=None):
+    """
+    Send the status and headers of an HTTP response through the ASGI send callable,
+    a response without content length is streamed
+    """
+    HTTP_RESPONSES.inc(status=status)
+    raw_headers = []
+    if content_length is not None:
+        raw_headers.append((b'content-length', str(content_length).encode('latin-1')))
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode('latin-1'), str(value).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+
+
+def traced_send(send, trace):
+    """
+    Return the ASGI send callable adding the trace id header to the response
+    """
+    async def send_traced(message):
+        if message['type'] == 'http.response.start':
+            headers = list(message.get('headers', [])) + [(b'x-trace-id', trace.trace_id.encode('latin-1'))]
+            message = dict(message, headers=headers)
+        await send(message)
+    return send_traced
+
+
+async def send_response(send, status, body=b'', headers=None):
+    """
+    Send an HTTP response through the ASGI send callable
+    """
+    await send_response_start(send, status, len(body), headers)
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_file_response(scope, send, entry, arguments, request_headers):
+    """
+    Send the tile file, streamed by the front end proxy when configured,
+    with the zero copy extension of the ASGI server when available, else read in the executor
+    """
+    headers = {'ETag': '"{}"'.format(entry.etag), 'Cache-Control': cache_control(arguments), 'Vary': 'Accept'}
+    if etag_matches(request_headers.get('if-none-match'), entry.etag):
+        return await send_response(send, 304, headers=headers)
+    headers['Content-Type'] = mimetype_for_path(entry.file_path)
+    offload = offload_headers(entry.file_path)
+    if offload is not None:
+        headers.update(offload)
+        return await send_response(send, 200, headers=headers)
+    if 'http.response.zerocopysend' in scope.get('extensions', {}):
+        with open(entry.file_path, 'rb') as tile_file:
+            await send_response_start(send, 200, entry.size, headers)
+            await send({'type': 'http.response.zerocopysend', 'file': tile_file})
+        return
+    body = await asyncio.get_event_loop().run_in_executor(None, read_file, entry.file_path)
+    return await send_response(send, 200, body, headers)
+
+
+async def send_hot_tile_response(send, hot_tile, arguments, request_headers):
+    """
+    Send a tile kept in memory
+    """
+    headers = {'ETag': '"{}"'.format(hot_tile.etag), 'Cache-Control': cache_control(arguments), 'Vary': 'Accept'}
+    if etag_matches(request_headers.get('if-none-match'), hot_tile.etag):
+        return await send_response(send, 304, headers=headers)
+    headers['Content-Type'] = hot_tile.content_type
+    return await send_response(send, 200, hot_tile.body, headers)
+
+
+async def send_entry_response(scope, send, key, entry, arguments, request_headers):
+    """
+    Send a tile file, keep the tile in memory when it fits in the hot cache
+    """
+    hot_tile = await asyncio.get_event_loop().run_in_executor(None, HOT_CACHE.put, key, entry, arguments)
+    if hot_tile is not None:
+        return await send_hot_tile_response(send, hot_tile, arguments, request_headers)
+    return await send_file_response(scope, send, entry, arguments, request_headers)
+
+
+async def wait_tile(generator, file_path, trace=None):
+    """
+    Wait for the tile without holding a thread,
+    the generator notify the tile completion, the path is polled for tiles produced elsewhere.
+    The wait ends early when the producers failed, a notification without the tile is a failure
+    """
+    loop = asyncio.get_event_loop()
+    tile_done = asyncio.Event()
+
+    def notify():
+        loop.call_soon_threadsafe(tile_done.set)
+
+    generator.add_tile_listener(file_path, notify)
+    try:
+        deadline = loop.time() + MAXIMUM_WAIT
+        while not os.path.isfile(file_path):
+            if trace is not None and trace.errors:
+                return False
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(tile_done.wait(), min(remaining, POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                continue
+            # the listener is called once, the producers are done with the tile
+            return os.path.isfile(file_path)
+        return True
+    finally:
+        generator.remove_tile_listener(file_path, notify)
+
+
+async def handle_tile_request(scope, send, trace):
+    """
+    Handle TMS request and dispatch it between generators.
+    The tile format comes from the route extension, the format argument or the Accept header
+    """
+    match = TILE_ROUTE.match(scope['path'])
+    if match is None:
+        return await send_response(send, 404)
+    if scope['method'] != 'GET':
+        return await send_response(send, 405)
+    generator_name = match.group(1)
+    x_coordinate, y_coordinate, z_coordinate = (int(match.group(index)) for index in (2, 3, 4))
+    arguments = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+    headers = request_headers(scope)
+    try:
+        generator = GeneratorFactory.get_instance().build_generator(generator_name)
+    except GeneratorNotFound:
+        LOGGER.error("Impossible to find generator %s", generator_name)
+        return await send_response(send, 404)
+    tile_format = negotiate_format(match.group(5), arguments.get('format'), headers.get('accept'), generator.TILE_FORMATS)
+    if tile_format is None:
+        return await send_response(send, 404)
+    arguments['format'] = tile_format
+    arguments = generator.canonical_arguments(arguments)
+    key = request_key(generator_name, x_coordinate, y_coordinate, z_coordinate, arguments)
+    hot_tile = HOT_CACHE.get(key)
+    if hot_tile is not None:
+        return await send_hot_tile_response(send, hot_tile, arguments, headers)
+    entry = ETAG_INDEX.get(key)
+    if entry is not None and not entry.is_current():
+        ETAG_INDEX.remove(key)
+        entry = None
+    if entry is not None and etag_matches(headers.get('if-none-match'), entry.etag):
+        return await send_file_response(scope, send, entry, arguments, headers)
+    if entry is not None:
+        return await send_entry_response(scope, send, key, entry, arguments, headers)
+    LOGGER.debug("Data requested for: generator %s x %s y %s z %s args %s",
+                 generator_name, x_coordinate, y_coordinate, z_coordinate, arguments)
+
+    loop = asyncio.get_event_loop()
+    if generator.is_tile_empty(x_coordinate, y_coordinate, z_coordinate):
+        return await send_response(send, 404, headers={'Cache-Control': empty_cache_control()})
+    try:
+        with span(trace, "prepare"):
+            tile, ready = await loop.run_in_executor(None, generator.prepare_tile,
+                                                     x_coordinate, y_coordinate, z_coordinate, arguments, trace)
+        if not ready:
+            with span(trace, "wait"):
+                ready = await wait_tile(generator, tile, trace)
+        if not ready:
+            tile = generator.get_data_not_yet_ready_file()
+            LOGGER.debug("File not yet ready, return error file %s", tile)
+            body = await loop.run_in_executor(None, read_file, tile)
+            return await send_response(send, 200, body, {'Content-Type': 'image/png',
+                                                         'Cache-Control': 'public, max-age={}'.format(NOT_YET_READY_MAX_AGE),
+                                                         'X-WTMSE-Status': 'not-ready'})
+        entry = await loop.run_in_executor(None, ETAG_INDEX.put, key, tile, arguments)
+        return await send_entry_response(scope, send, key, entry, arguments, headers)
+    except TileOutOfCoverage:
+        LOGGER.debug("Tile out of coverage")
+        return await send_response(send, 404, headers={'Cache-Control': empty_cache_control()})
+    except DataCannotBeComputed:
+        LOGGER.debug("File cannot be found")
+        return await send_response(send, 404)
+    except Exception as err:
+        LOGGER.exception("Something wrong happen during tile request, trace %s", trace.trace_id)
+        trace.error("request", err)
+        return await send_response(send, 404)
+
+
+async def read_body(receive):
+    """
+    Read the whole request body
+    """
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body = body + message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def handle_batch_request(scope, receive, send, generator_name):
+    """
+    Handle a batch of TMS requests, tiles are streamed in a multipart response in completion order
+    """
+    if scope['method'] != 'POST':
+        return await send_response(send, 405)
+    arguments = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+    try:
+        tiles, arguments = parse_batch_request(await read_body(receive), arguments)
+    except BadBatchRequest as err:
+        return await send_response(send, 400, str(err).encode('utf-8'), {'Content-Type': 'text/plain'})
+    try:
+        generator = GeneratorFactory.get_instance().build_generator(generator_name)
+    except GeneratorNotFound:
+        LOGGER.error("Impossible to find generator %s", generator_name)
+        return await send_response(send, 404)
+    try:
+        job = BatchJob(generator, tiles, arguments)
+    except BadBatchRequest as err:
+        return await send_response(send, 400, str(err).encode('utf-8'), {'Content-Type': 'text/plain'})
+    LOGGER.debug("Batch of %s tiles requested for generator %s args %s", len(tiles), generator_name, job.arguments)
+
+    loop = asyncio.get_event_loop()
+    done = asyncio.Queue()
+    boundary = new_boundary()
+
+    def notify(file_path):
+        loop.call_soon_threadsafe(done.put_nowait, file_path)
+
+    async def send_results(results):
+        for result in results:
+            part = await loop.run_in_executor(None, result_part, boundary, generator_name, result)
+            await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+
+    await send_response_start(send, 200, None, {'Content-Type': multipart_content_type(boundary)})
+    try:
+        await send_results(await loop.run_in_executor(None, job.schedule, notify))
+        deadline = loop.time() + BATCH_MAXIMUM_WAIT
+        while job.pending() and loop.time() < deadline:
+            try:
+                file_path = await asyncio.wait_for(done.get(), max(0, min(BATCH_POLL_INTERVAL, deadline - loop.time())))
+                results = job.complete(file_path)
+            except asyncio.TimeoutError:
+                results = await loop.run_in_executor(None, job.poll)
+            await send_results(results)
+        await send_results(job.remaining())
+        await send({'type': 'http.response.body', 'body': multipart_end(boundary)})
+    finally:
+        job.close()
+
+
+async def APP(scope, receive, send):
+    """
+    ASGI application
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    elif scope['type'] == 'http' and scope['path'] == '/metrics':
+        await send_response(send, 200, REGISTRY.render().encode('utf-8'), {'Content-Type': PROMETHEUS_CONTENT_TYPE})
+    elif scope['type'] == 'http':
+        start = time.time()
+        batch = BATCH_ROUTE.match(scope['path'])
+        with HTTP_IN_FLIGHT.track_in_progress():
+            if batch is not None:
+                await handle_batch_request(scope, receive, send, batch.group(1))
+            else:
+                headers = request_headers(scope)
+                arguments = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+                trace = new_trace(headers.get('x-trace-id'), arguments.get('profile'))
+                try:
+                    await handle_tile_request(scope, traced_send(send, trace), trace)
+                finally:
+                    trace.finish(scope['path'])
+        HTTP_DURATION.observe(time.time() - start)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        LOGGER.error("uvicorn is required to run the asgi server: pip install uvicorn")
+        exit(1)
+    uvicorn.run(APP, host='0.0.0.0', port=5000)
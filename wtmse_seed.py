@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+"""
+wtmse seed, pre-render sentinel2 tiles in the wtmse cache.
+Tiles are planned from a zone list, a bbox or a GeoJSON file,
+then rendered by a pool of workers in the cache read by the wtmse server.
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import hashlib
+import tempfile
+import datetime
+from shapely.geometry import shape
+from shapely.ops import unary_union
+from generator.generator_factory import GeneratorFactory
+from generator.sentinel2.sentinel_tile_seeder import SentinelTileSeeder, plan_tiles, build_tasks
+from generator.sentinel2.sentinel_tile_seeder import MIN_ZOOM, MAX_ZOOM
+
+
+logging.basicConfig(level=os.getenv('WTMSE_LOG_LEVEL', 'INFO').upper())
+LOGGER = logging.getLogger("wtmse")
+
+
+def read_geojson(geojson_path):
+    """
+    Read a GeoJSON file and return the union of its geometries
+    """
+    with open(geojson_path, 'r') as geojson_file:
+        geojson = json.load(geojson_file)
+    if geojson.get('type') == 'FeatureCollection':
+        geometries = [shape(feature['geometry']) for feature in geojson.get('features', [])]
+    elif geojson.get('type') == 'Feature':
+        geometries = [shape(geojson['geometry'])]
+    else:
+        geometries = [shape(geojson)]
+    return unary_union(geometries)
+
+
+def parse_date(date_string):
+    """
+    Parse date as the wtmse server
+    """
+    return datetime.datetime.strptime(date_string, '%Y%m%d').date()
+
+
+def parse_command_line():
+    """
+    Parse the command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Pre-render sentinel2 tiles in the wtmse cache")
+    parser.add_argument('--zone', action='append', default=[], help="zone to seed, can be repeated (31TCJ)")
+    parser.add_argument('--bbox', help="bbox to seed: lon_min,lat_min,lon_max,lat_max")
+    parser.add_argument('--geojson', help="GeoJSON file of the area to seed")
+    parser.add_argument('--min-zoom', type=int, default=MIN_ZOOM)
+    parser.add_argument('--max-zoom', type=int, default=MAX_ZOOM)
+    parser.add_argument('--date', action='append', default=[], type=parse_date, help="date to seed YYYYMMDD, can be repeated")
+    parser.add_argument('--date-from', type=parse_date, help="seed every acquisition from this date YYYYMMDD")
+    parser.add_argument('--date-to', type=parse_date, help="seed every acquisition until this date YYYYMMDD")
+    parser.add_argument('--bands', help="bands used, as the server bands argument (4,3,2)")
+    parser.add_argument('--first-clip', help="clip of the first band, as the server first_clip argument (0,2500)")
+    parser.add_argument('--second-clip', help="clip of the second band, as the server second_clip argument")
+    parser.add_argument('--third-clip', help="clip of the third band, as the server third_clip argument")
+    parser.add_argument('--workers', type=int, default=4, help="number of tiles rendered in parallel")
+    parser.add_argument('--retries', type=int, default=3, help="retries for tiles not yet ready")
+    parser.add_argument('--state', help="state file used to resume an interrupted seed")
+    parser.add_argument('--pyramid', action='store_true', help="build lower zoom tiles from their cached children")
+    arguments = parser.parse_args()
+
+    if not arguments.zone and arguments.bbox is None and arguments.geojson is None:
+        parser.error("--zone, --bbox or --geojson is required")
+    if arguments.min_zoom < MIN_ZOOM or arguments.max_zoom > MAX_ZOOM or arguments.min_zoom > arguments.max_zoom:
+        parser.error("zoom shall be between {} and {}".format(MIN_ZOOM, MAX_ZOOM))
+    if (arguments.date_from is None) != (arguments.date_to is None):
+        parser.error("--date-from and --date-to shall be used together")
+    return arguments
+
+
+def main():
+    """
+    Plan and seed the tiles
+    """
+    arguments = parse_command_line()
+    zones = []
+    for zone in arguments.zone:
+        zones.extend(zone.split(','))
+    bbox = tuple(map(float, arguments.bbox.split(','))) if arguments.bbox else None
+    geometry = read_geojson(arguments.geojson) if arguments.geojson else None
+
+    render_arguments = {}
+    for name, value in (('bands', arguments.bands), ('first_clip', arguments.first_clip),
+                        ('second_clip', arguments.second_clip), ('third_clip', arguments.third_clip)):
+        if value is not None:
+            render_arguments[name] = value
+
+    generator = GeneratorFactory.get_instance().build_generator("sentinel2")
+    generator.pyramid = generator.pyramid or arguments.pyramid
+    planned = plan_tiles(arguments.min_zoom, arguments.max_zoom, zones, bbox, geometry)
+    LOGGER.info("Planned %s tiles in %s zones and zone borders", sum(len(tiles) for tiles in planned.values()), len(planned))
+
+    dates = None
+    if arguments.date or arguments.date_from:
+        dates = {}
+        for zone_name in set(zone_name for zone_names in planned for zone_name in zone_names):
+            dates[zone_name] = list(arguments.date)
+            if arguments.date_from:
+                # one catalogue search for the whole range
+                dates[zone_name].extend(generator.product_provider.image_dates_for_zone(
+                    zone_name, arguments.date_from, arguments.date_to))
+    tasks = build_tasks(planned, dates, generator.latest_date)
+
+    state_file = arguments.state
+    if state_file is None:
+        plan_hash = hashlib.sha1(" ".join(sorted(task.key() for task in tasks) +
+                                          sorted("{}={}".format(*item) for item in render_arguments.items()))
+                                 .encode("utf-8")).hexdigest()
+        state_file = os.path.join(tempfile.gettempdir(), "wtmse_seed_" + plan_hash[:16] + ".state")
+    LOGGER.info("Seed state file: %s", state_file)
+
+    seeder = SentinelTileSeeder(generator, render_arguments, arguments.workers, arguments.retries, state_file)
+    seeded, failed = seeder.run(tasks)
+    LOGGER.info("Seed done, %s tiles seeded, %s failed", seeded, failed)
+    return 0 if failed == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())